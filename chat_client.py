@@ -6,7 +6,7 @@ import time
 from threading import Thread
 
 from client_utils import gui
-from essentials import file_handler, protocols, chatsocket
+from essentials import download_manager, file_handler, manifests, protocols, chatsocket
 
 CLIENT_THREAD_TIMEOUT = 3
 GUI_WAIT_TIME = 0.2  # seconds to wait while the gui is initializing
@@ -14,6 +14,7 @@ NICKNAME_REG = re.compile('^[a-zA-Z]([a-zA-Z0-9])*$')
 QUIT_MSG = '?quit'
 DL_DIR = 'client_dl'
 FILE_FIN_MSG = 'file: {} has finished downloading.'
+FILE_FAILED_MSG = 'file: {} could not be saved.'
 
 
 def get_nick():
@@ -35,8 +36,10 @@ class ChatClient(object):
         """
         self.client = chatsocket.ChatSocket()
         self.protocols = protocols.Protocol(self.handle_regular_msg, self.close, self.send_file, None,
-                                            self.process_file_chunk, self.file_end, self.request_file)
-        self.downloads = dict()
+                                            self.process_file_chunk, self.file_end, self.request_file,
+                                            file_start=self.file_start, file_credit=self.file_credit,
+                                            file_resume=self.file_resume)
+        self.downloads = download_manager.DownloadManager(DL_DIR)
 
     def exit(self):
         self.client.send_regular_msg(QUIT_MSG)
@@ -65,14 +68,50 @@ class ChatClient(object):
         else:
             self.client.send_file(path)
 
+    def file_start(self, name, msg):
+        """
+        Accepts a flow controlled download (a resumable download first skips the chunks an earlier download saved).
+        :param name: the file's name.
+        :param msg: the message.
+        """
+        size, manifest = manifests.parse_start(msg.data)
+        download = self.downloads.start(name, size, msg.stream, manifest)
+        if download.resumed:
+            self.client.send_resume(name, download.resumed, msg.stream)
+        self.client.start_receiving(name, msg.stream)
+
+    def file_resume(self, name, msg):
+        """
+        Handles the chunks the server already has of a resumable upload.
+        :param name: the file's name.
+        :param msg: the message.
+        """
+        self.client.resume_transfer(name, msg.data, msg.stream)
+
+    def file_credit(self, name, msg):
+        """
+        Handles the credits the server grants an upload.
+        :param name: the file's name.
+        :param msg: the message.
+        """
+        self.client.grant_credit(name, msg.data, msg.stream)
+
     def process_file_chunk(self, name, msg):
         """
         Processes a file chunk.
+        A chunk which could not be written is still credited - the sender waits for the credits, and the transfer
+        ends (as failed) once the sender sent all of its chunks.
         :param name: the file's name.
         :param msg: the message.
         """
         if msg.data:
-            file_handler.create_file(file_handler.get_location(DL_DIR, name), msg.data)
+            failed = (msg.stream, name) in self.downloads.failed
+            try:
+                self.downloads.write(name, msg.data, msg.stream)
+            except (IOError, OSError):
+                if not failed:
+                    self.gui.display_message(FILE_FAILED_MSG.format(name))
+        self.client.chunk_consumed(name, msg.stream)
 
     def file_end(self, name, msg):
         """
@@ -80,6 +119,15 @@ class ChatClient(object):
         :param name: the file's name.
         :param msg: the message.
         """
+        self.client.finish_receiving(name, msg.stream)
+        if (msg.stream, name) in self.downloads.failed:
+            self.downloads.finish(name, msg.stream)
+            return  # the failure was reported when the transfer failed
+        try:
+            self.downloads.finish(name, msg.stream)
+        except (IOError, OSError):
+            self.gui.display_message(FILE_FAILED_MSG.format(name))
+            return
         self.gui.display_message(FILE_FIN_MSG.format(name))
 
     def handle_regular_msg(self, msg):
@@ -106,8 +154,9 @@ class ChatClient(object):
             self.gui.display_connection_status(False)
             quit()
         self.gui.display_connection_status(True)
-        self.client.send_str(nickname)
+        self.client.handshake(nickname)
         self.receive_messages()
+        self.downloads.suspend_all()  # the transfers which did not end will not, the resumable ones are kept
         if self.gui.running:
             self.gui.display_connection_status(False)
 
@@ -2,13 +2,20 @@
 This module contains the server (main script for the server host)
 The server follows the communication protocol: send size of data - then the data itself
 """
-import select
+import argparse
+import collections
+import functools
+import os
+import socket
 
-from essentials import file_handler, protocols, chatsocket
-from server_utils import commands, user
+from essentials import download_manager, file_handler, frame_reader, manifests, protocols, chatsocket, wire
+from server_utils import admission, chat_log, cluster, commands, event_loop, handshake, history, outbound, relay, \
+    rooms, search, store, user, writer_pool
 
 DL_DIR = 'dl'
-MAX_CONNECTIONS = 5
+ACCEPT_BATCH = 64  # the maximum number of connections accepted per wakeup
+MAX_WRITE_BACKLOG = 16777216  # the bytes of a user's uploads waiting for the disk before their socket is not read
+CHAT_LOG_JOBS = 'chat log'  # the writer pool key of the chat log's writes
 
 
 class Server(object):
@@ -16,22 +23,86 @@ class Server(object):
     This class is a chat server
     It is used to set up the server
     """
-    def __init__(self):
+    def __init__(self, outbound_policy=outbound.DROP, high_watermark=outbound.DEF_HIGH_WATERMARK,
+                 low_watermark=outbound.DEF_LOW_WATERMARK, outbound_memory_cap=outbound.DEF_MEMORY_CAP,
+                 relay_cache_size=relay.DEF_CACHE_SIZE, fsync_policy=download_manager.FSYNC_FINISH,
+                 writers=writer_pool.DEF_WRITERS, coalesce_window=outbound.DEF_COALESCE_WINDOW, limits=None,
+                 history_size=history.DEF_HISTORY_SIZE, history_bytes=history.DEF_HISTORY_BYTES, worker=None):
         """
         The class constructor
-        """
-        self.server = chatsocket.ChatSocket()
-        self.users_by_nick = dict()
-        self.users_by_client = dict()
-        self.downloads = dict()
+        :param outbound_policy: what to do with a client whose outbound queue is overloaded (see outbound.POLICIES)
+        :param high_watermark: the size (bytes) at which a client's outbound queue is overloaded
+        :param low_watermark: the size (bytes) at which an overloaded outbound queue recovers
+        :param outbound_memory_cap: the maximum number of bytes queued for all the clients together
+        :param relay_cache_size: the maximum number of bytes of file chunks cached for downloads
+        :param fsync_policy: when uploaded files are forced to the disk (see download_manager.FSYNC_POLICIES)
+        :param writers: the number of threads which write the uploaded files
+        :param coalesce_window: the seconds frames wait to be written together with later frames
+        (0 - until the event loop iteration ends, negative - they are written right away)
+        :param limits: the connection and rate limits (admission.Limits), None for the defaults
+        :param history_size: the number of chat messages each room replays to the users who join it
+        :param history_bytes: the bytes of the chat messages each room replays to the users who join it
+        :param worker: the index of the server's worker process (see cluster.Supervisor), None if it runs alone
+        """
+        self.limits = limits or admission.Limits()
+        self.server = chatsocket.ChatSocket(listen=self.limits.backlog, max_frame_size=self.limits.max_frame_size)
+        self.event_loop = event_loop.create_event_loop()
+        self.users = user.UserRegistry()
+        self.fsync_policy = fsync_policy
+        # the uploaded files, stored once per content
+        self.store = store.Store(DL_DIR)
+        # the proofs asked of the uploads whose content was already stored (store.Challenge objects),
+        # by (nickname, stream id, file name)
+        self.deduplicated = dict()
+        # the disk work of the uploads runs on the writer threads, so the event loop never waits for the disk
+        self.writers = writer_pool.WriterPool(self.event_loop.call_soon_threadsafe, writers)
+        # runs the users' commands (blocking commands on worker threads)
+        self.router = commands.Router(self, self.event_loop.call_soon_threadsafe)
+        self.paused_readers = set()  # the sockets which are not read until their uploads catch up
+        # connections which have not sent their nickname yet
+        self.pending = set()
+        self.connections = collections.Counter()  # the number of connections from each IP address
+        self.accepting = True  # whether the listening socket is watched (not while too many handshakes are pending)
+        self.throttled = set()  # the sockets which are not read until their users' rate limits refill
+        self.throttles = 0  # the number of times users ran out of their rate limits
+        self.outbound_policy = outbound_policy
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.outbound_budget = outbound.MemoryBudget(outbound_memory_cap)
+        self.coalesce_window = coalesce_window
+        self.send_stats = outbound.SendStats()  # the writes of all the outbound queues
+        self.rooms = rooms.RoomRegistry(history_size, history_bytes)  # the rooms' members and last messages
+        # the chat messages and whispers on the disk (every worker logs all the chat messages it broadcasts)
+        self.chat_log = chat_log.ChatLog(chat_log.LOG_DIR if worker is None else
+                                         os.path.join(chat_log.LOG_DIR, 'worker-{}'.format(worker)))
+        # the words of the chat log, saved next to it (the records logged since it was saved are indexed again)
+        self.search_index = search.SearchIndex(os.path.join(self.chat_log.directory, search.INDEX_FILE))
+        self.search_index.add(self.chat_log.records_after(self.search_index.last_id))
+        # serves the uploaded files
+        self.relay = relay.Relay(self.store, self.writers.submit, cache_size=relay_cache_size)
+        # the link to the other workers (cluster.Bus) when the server runs as one of several processes
+        self.bus = None
         self._init_messages()
         self.protocols = protocols.Protocol(self.handle_regular_msg, self.disconnect_user, self.send_file,
-                                            self.file_not_found, self.process_file_chunk, self.file_end)
+                                            self.file_not_found, self.process_file_chunk, self.file_end,
+                                            file_start=self.file_start, file_credit=self.file_credit,
+                                            file_resume=self.file_resume)
 
     def _init_messages(self):
         self.connect_message = '{} connected'
         self.disconnect_message = '{} disconnected.'
         self.invalid_nick_message = 'Nickname: {} is taken.'
+        self.logged_message = '[{}] {}'
+        self.logged_whisper_message = '[{}] {} whispered to {}: {}'
+        self.no_history_message = 'No messages were found.'
+        self.invalid_time_message = 'Invalid time: {}'
+        self.invalid_search_message = 'Nothing to search for.'
+        self.room_joined_message = '{} joined #{}'
+        self.room_left_message = '{} left #{}'
+        self.already_in_room_message = 'You are already in #{}.'
+        self.rooms_message = 'Rooms: {}'
+        self.room_entry_message = '#{} ({})'
+        self.server_full_message = 'The server is full ({} users), try again later.'
         self.no_permission_message = 'You have no permission to use this command!'
         self.whisper_message = '{} whispered: {}'
         self.kick_message_whisper = 'You were kicked from the server.'
@@ -41,12 +112,19 @@ class Server(object):
         self.unmute_message = 'You are no longer muted.'
         self.commands_message = 'Allowed commands: {}'
         self.admins_message = 'Admins: {}'
+        self.stats_message = 'Sent {} frames in {} send calls ({:.2f} frames per call), {} bytes.'
+        self.commands_stats_message = 'Commands: {}'
+        self.throttles_message = 'Rate limited users {} times, {} throttled now.'
+        self.users_stats_message = 'Users: {} connected, {} admins, {} muted, {} uploading ({} bytes to write).'
+        self.command_stats_message = '{} {} calls (avg {:.2f} ms, max {:.2f} ms)'
+        self.command_failed_message = 'The command {} failed.'
         self.promote_message = 'You are now an admin.'
         self.demote_message = 'You are now a regular.'
         self.user_not_found = 'User {} not found.'
         self.upload_start_msg = 'Attempting to upload file: {}'
-        self.already_uploading_msg = 'You can only upload one file at a time.'
+        self.already_uploading_msg = 'File {} is already being uploaded.'
         self.upload_finished_msg = '{} has finished uploading!'
+        self.upload_failed_msg = 'Uploading {} failed.'
         self.file_send_started = 'Attempting to send you: {}'
         self.file_not_found_msg = 'file: {} was not found.'
 
@@ -58,13 +136,24 @@ class Server(object):
         """
         print 'IP:', self.server.server_ip, 'Port:', self.server.port
         self.server.initialize_server_socket()
+        self.server.setblocking(False)
+        self.serve()
+
+    def serve(self):
+        """
+        Runs the event loop on an initialized (listening, non-blocking) server socket
+        """
+        self.event_loop.register(self.server)
+        if self.bus:
+            self.event_loop.register(self.bus.link)
         while True:
-            inputs = self.get_client_list() + [self.server]
-            readable, writable, exceptional = select.select(inputs, [], [])
-            self.handle_inputs(readable)
+            ready = self.event_loop.poll(self.event_loop.next_timeout())
+            self.handle_outputs([sock for sock, events in ready if events & event_loop.WRITE])
+            self.handle_inputs([sock for sock, events in ready if events & event_loop.READ])
+            self.event_loop.run_callbacks()
 
     def get_client_list(self):
-        return self.users_by_client.keys()
+        return [user.client for user in self.users]
 
     def handle_inputs(self, readable):
         """
@@ -73,22 +162,219 @@ class Server(object):
         """
         for sock in readable:
             if sock is self.server:
-                if len(self.users_by_nick) < MAX_CONNECTIONS:
-                    self.accept_new_user(sock)
+                self.accept_new_user(sock)
+            elif sock in self.pending:
+                self.continue_handshake(sock)
+            elif self.bus and sock is self.bus.link:
+                self.bus.receive()
             else:
-                self.handle_client(self.users_by_client[sock])
+                # the user may have been disconnected while handling an earlier socket
+                user = self.users.find_client(sock)
+                if user:
+                    self.handle_client(user)
+
+    def handle_outputs(self, writable):
+        """
+        Flushes the outbound queues of the writable clients
+        :param writable: list of writable sockets
+        """
+        for sock in writable:
+            if sock.outbound is not None:
+                sock.outbound.flush()
+
+    def set_write_interest(self, client, waiting):
+        """
+        Watches (or stops watching) a client's socket for writability
+        :param client: the client's socket
+        :param waiting: whether the client's outbound queue has frames to write
+        """
+        events = 0 if client in self.paused_readers or client in self.throttled else event_loop.READ
+        self.event_loop.modify(client, events | event_loop.WRITE if waiting else events)
+
+    def pause_reading(self, client):
+        """
+        Stops reading a client's socket (backpressure)
+        :param client: the client's socket
+        """
+        self.paused_readers.add(client)
+        self.set_write_interest(client, client.outbound.waiting)
+
+    def resume_reading(self, client):
+        """
+        Resumes reading a client's socket
+        A frame held back by the rate limit is handled right away, as the socket may not become readable again
+        :param client: the client's socket
+        """
+        self.paused_readers.discard(client)
+        self.set_write_interest(client, client.outbound.waiting)
+        user = self.users.find_client(client)
+        if client.reader.held and client not in self.throttled and user:
+            self.event_loop.call_soon(self.unthrottle, user)
+
+    def throttle(self, user):
+        """
+        Stops reading a user's socket until their rate limits refill
+        The frame which exceeded the limits waits (undecoded) in the socket's read buffer, and the frames after it
+        wait in the kernel's buffers, so the flooding client is slowed down by TCP itself
+        :param user: the User object
+        """
+        client = user.client
+        self.throttled.add(client)
+        self.throttles += 1
+        self.set_write_interest(client, client.outbound.waiting)
+        self.event_loop.call_later(user.limiter.delay(), self.unthrottle, user)
+
+    def unthrottle(self, user):
+        """
+        Resumes reading a throttled user's socket, starting with the frame which was held back
+        :param user: the User object
+        """
+        client = user.client
+        self.throttled.discard(client)
+        if not user.connected:
+            return
+        self.set_write_interest(client, client.outbound.waiting)
+        if client not in self.paused_readers:
+            self.handle_client(user)
+
+    def schedule_flush(self, flush):
+        """
+        Runs an outbound queue's flush once the coalescing window ends
+        :param flush: the queue's flush callback
+        """
+        if self.coalesce_window:
+            self.event_loop.call_later(self.coalesce_window, flush)
+        else:
+            self.event_loop.call_soon(flush)
+
+    def outbound_failed(self, client):
+        """
+        Schedules the disconnection of a client whose outbound queue failed
+        The client is disconnected after the current wakeup, as the failure may happen mid-broadcast
+        :param client: the client's socket
+        """
+        self.event_loop.call_soon(self.disconnect_failed_client, client)
+
+    def disconnect_failed_client(self, client):
+        """
+        Disconnects a client whose outbound queue failed (overloaded or broken connection)
+        :param client: the client's socket
+        """
+        user = self.users.find_client(client)
+        if user and user.connected:
+            self.disconnect_user(user)
+            self.broadcast(self.disconnect_message.format(user.display_name), user.room)
 
     def accept_new_user(self, sock):
         """
-        Accepts the chatsocket socket connection and creates a User object
+        Accepts the waiting chatsocket socket connections
+        The connections are tracked as pending until they finish the handshake
         :param sock: connection listener
         """
-        client, address = sock.accept()
-        nick = client.receive()
-        if nick in self.users_by_nick:
-            client.send_regular_msg(self.invalid_nick_message.format(nick))
+        for _ in xrange(ACCEPT_BATCH):
+            if len(self.pending) >= self.limits.max_pending:
+                break
+            try:
+                client, address = sock.accept()
+            except socket.error as e:
+                if e.args[0] in handshake.WOULD_BLOCK:
+                    break
+                raise
+            if self.connections[address[0]] >= self.limits.max_per_address:
+                client.close()
+                continue
+            self.connections[address[0]] += 1
+            connection = handshake.PendingConnection(client, address)
+            connection.timer = self.event_loop.call_later(handshake.DEF_HANDSHAKE_TIMEOUT, self.expire_handshake,
+                                                          connection)
+            self.pending.add(connection)
+            self.event_loop.register(connection)
+        self.update_accepting()
+
+    def update_accepting(self):
+        """
+        Watches the listening socket only while more handshakes may start
+        Otherwise the waiting connections stay in the listen backlog (and the kernel refuses connections beyond it),
+        rather than keeping the listening socket readable while nothing is accepted
+        """
+        accepting = len(self.pending) < self.limits.max_pending
+        if accepting != self.accepting:
+            self.accepting = accepting
+            self.event_loop.modify(self.server, event_loop.READ if accepting else 0)
+
+    def release_address(self, address):
+        """
+        Stops counting a closed connection towards the limit of its IP address
+        :param address: the IP address
+        """
+        self.connections[address] -= 1
+        if self.connections[address] <= 0:
+            del self.connections[address]
+
+    def continue_handshake(self, connection):
+        """
+        Reads the available handshake data of a pending connection
+        Once the nickname was received it is checked (by the supervisor if there are several workers)
+        :param connection: a PendingConnection object
+        """
+        state = connection.on_readable()
+        if state == handshake.DONE:
+            self.event_loop.unregister(connection)
+            if self.bus:
+                self.bus.claim(connection.nick, self.finish_handshake, connection)
+            else:
+                self.finish_handshake(connection, connection.nick not in self.users)
+        elif state == handshake.CLOSED:
+            self.drop_pending(connection)
+            self.release_address(connection.address[0])
+            connection.client.close_sock()
+
+    def finish_handshake(self, connection, available):
+        """
+        Negotiates the codec of a connection and creates its User object
+        :param connection: a PendingConnection object
+        :param available: whether the connection's nickname is available
+        """
+        if connection not in self.pending:  # the handshake timed out while the nickname was checked
+            if available and self.bus:
+                self.bus.release(connection.nick)
+            return
+        self.drop_pending(connection)
+        client, nick = connection.client, connection.nick
+        full = len(self.users) >= self.limits.max_users
+        codec = wire.choose_codec(connection.offers)
+        features = wire.choose_features(connection.offers, codec)
+        if connection.offers is not None:
+            client.send_str(wire.build_reply(codec, features))  # the reply is sent before switching codecs
+        client.configure(codec, features)
+        if not available or full:
+            if available and self.bus:
+                self.bus.release(nick)
+            client.send_regular_msg(self.server_full_message.format(self.limits.max_users) if available
+                                    else self.invalid_nick_message.format(nick))
+            client.close_sock()
+            self.release_address(connection.address[0])
             return
-        self.process_new_user(user.User(nick, client, address[0]))
+        self.process_new_user(user.User(nick, client, connection.address[0]))
+
+    def expire_handshake(self, connection):
+        """
+        Closes a pending connection whose handshake timed out
+        :param connection: a PendingConnection object
+        """
+        self.drop_pending(connection)
+        self.release_address(connection.address[0])
+        connection.client.close_sock()
+
+    def drop_pending(self, connection):
+        """
+        Stops tracking a pending connection
+        :param connection: a PendingConnection object
+        """
+        self.pending.discard(connection)
+        connection.timer.cancel()
+        self.event_loop.unregister(connection)
+        self.update_accepting()
 
     def process_new_user(self, user):
         """
@@ -96,10 +382,11 @@ class Server(object):
         :param user: a User object
         """
         self.add_user(user)
+        self.rooms.get(user.room).history.replay(user.client)
         # The host is the owner (Admin) of the server
         if user.address == self.server.server_ip:
             commands.promote(commands.CommandArgs(self, user, ''))
-        self.broadcast(self.connect_message.format(user.display_name))
+        self.broadcast(self.connect_message.format(user.display_name), user.room)
 
     def add_user(self, user):
         """
@@ -107,18 +394,62 @@ class Server(object):
         :param user: a USer object
         """
         user.connected = True
-        self.users_by_nick[user.nickname] = user
-        self.users_by_client[user.client] = user
-        self.downloads[user.nickname] = list()
+        user.client.outbound = outbound.OutboundQueue(user.client, self.outbound_budget, self.set_write_interest,
+                                                      self.outbound_failed, self.high_watermark,
+                                                      self.low_watermark, self.outbound_policy,
+                                                      schedule_flush=self.schedule_flush
+                                                      if self.coalesce_window >= 0 else None,
+                                                      stats=self.send_stats)
+        user.downloads = download_manager.DownloadManager(self.store.temp_dir, fsync_policy=self.fsync_policy,
+                                                          store=self.store, max_size=self.limits.max_upload_size)
+        user.limiter = admission.RateLimiter(user.client, self.limits)
+        self.users.add(user)
+        self.rooms.join(user, rooms.DEF_ROOM)
+        self.event_loop.register(user.client)
+        if self.bus:
+            self.bus.publish(cluster.JOIN, cluster.user_info(user))
 
     def remove_user(self, user):
         """
         Updates user dictionaries to accommodate the new user
         :param user: a USer object
         """
-        del self.users_by_nick[user.nickname]
-        del self.users_by_client[user.client]
-        del self.downloads[user.nickname]
+        self.users.remove(user)
+        self.rooms.leave(user)
+        for key in user.uploads:
+            stream, name = key
+            if self.deduplicated.pop((user.nickname,) + key, None) is None:
+                # resumable uploads are kept, so the user can resume them once they reconnect
+                self.submit_upload_job(user, key, user.downloads.suspend, (name, stream))
+            self.relay.upload_ended(name, failed=True)
+        self.release_address(user.address)
+        self.paused_readers.discard(user.client)
+        self.throttled.discard(user.client)
+        self.event_loop.unregister(user.client)
+        user.client.outbound.clear()
+        if self.bus:
+            self.bus.publish(cluster.LEAVE, {'nickname': user.nickname})
+
+    def find_user(self, name):
+        """
+        Finds a user by their nickname, including users connected to other workers
+        :param name: the user's nickname
+        :return: a User (or cluster.RemoteUser) object, None if there is no such user
+        """
+        found = self.users.get(name)
+        if not found and self.bus:
+            found = self.bus.remote_users.get(name)
+        return found
+
+    def admin_nicks(self):
+        """
+        Lists the admins, including admins connected to other workers
+        :return: a list of nicknames
+        """
+        admins = list(self.users.admins)
+        if self.bus:
+            admins.extend(nick for nick, user in self.bus.remote_users.iteritems() if user.is_admin)
+        return admins
 
     # Server logic
     def handle_client(self, user):
@@ -126,20 +457,28 @@ class Server(object):
         Handles the chatsocket's needs
         :param user: the user to handle
         """
-        msg = user.client.receive_obj()
-        if msg:
-            self.handle_message(msg, user)
-        elif user.connected:
+        client = user.client
+        received_messages = client.read_messages(admit=user.limiter.admit)
+        while user.connected:
+            try:
+                msg = next(received_messages, None)
+            except (socket.error, wire.CodecError, frame_reader.FrameError, ValueError):
+                msg, client.reader.closed = None, True
+            if msg is None:
+                break
+            try:
+                self.handle_message(msg, user)
+            except protocols.ProtocolError:
+                client.reader.closed = True  # the user is disconnected, the other users are not affected
+                break
+        if client.reader.closed and user.connected:
             self.disconnect_user(user)
-            self.broadcast(self.disconnect_message.format(user.display_name))
+            self.broadcast(self.disconnect_message.format(user.display_name), user.room)
+        elif client.reader.held and user.connected and client not in self.throttled:
+            self.throttle(user)
 
     def handle_command(self, msg, user):
-        command = commands.Command.parse_msg(msg)
-        if command:
-            if self.check_permission(user, command):
-                command(commands.CommandArgs(self, user, msg))
-            else:
-                user.client.send_regular_msg(self.no_permission_message)
+        self.router.route(user, msg)
 
     def check_permission(self, user, command):
         """
@@ -156,18 +495,20 @@ class Server(object):
         :param msg: the message.
         :param user: the user who sent the message.
         """
-        self.broadcast(user.display_name + ': ' + msg.data)
+        self.broadcast(user.display_name + ': ' + msg.data, user.room, user.nickname)
         self.handle_command(msg.data, user)
 
     def handle_message(self, msg, user):
         """
         Handles the user's message - broadcasts the message and attempts to execute the command
         unless the user's muted, in which case it will do nothing but send the user
-        a reminder that he is muted
+        a reminder that he is muted (credits and resumes are still accepted, so downloads to muted users go on)
         :param msg: the user's message
         :param user: the user who sent the message
+        :raises protocols.ProtocolError: if the message is malformed (its sender should be disconnected)
         """
-        if user.muted:
+        protocols.validate_message(msg)
+        if user.muted and protocols.get_protocol(msg.header) not in (protocols.FILE_CREDIT, protocols.FILE_RESUME):
             user.client.send_regular_msg(self.muted_message)
         else:
             self.protocols.initiate_protocol(msg.header, msg=msg, user=user)
@@ -179,8 +520,23 @@ class Server(object):
         :param user: the user who who requested the file.
         :param msg: the request message.
         """
+        self.relay.locate(name, self.file_located, user, name)
+
+    def file_located(self, user, name, location, error):
+        """
+        Sends a requested file once it was looked up (on the event loop).
+        :param user: the user who requested the file.
+        :param name: the file's name.
+        :param location: the file's relay.Location, None if there is no such file.
+        :param error: the exception raised while looking the file up, None if there was none.
+        """
+        if not user.connected:
+            return
+        if not location:
+            user.client.send_regular_msg(self.file_not_found_msg.format(name))
+            return
         user.client.send_regular_msg(self.file_send_started.format(name))
-        user.client.send_file(name)
+        self.relay.send(user.client, name, location)
 
     def file_not_found(self, name, user, msg):
         """
@@ -189,16 +545,189 @@ class Server(object):
         :param user: the user who who sent the message.
         :param msg: the 'file not found' message.
         """
-        self.broadcast(self.file_not_found_msg.format(name))
+        self.users.discard_request(user, file_handler.GET_FILE_NAME(name))
+        self.broadcast(self.file_not_found_msg.format(name), user.room)
+
+    def is_uploading(self, name):
+        """
+        Checks whether a file is being uploaded, or was requested from a user (by any user).
+        :param name: the file's path or name.
+        :return: True if the file is being uploaded, False otherwise.
+        """
+        return self.users.is_uploading(file_handler.GET_FILE_NAME(name))
+
+    def request_upload(self, user, path):
+        """
+        Asks a user to upload a file, unless the file is being uploaded already.
+        :param user: the user who has the file.
+        :param path: the file's path on the user's computer.
+        :return: True if the file was requested, False otherwise.
+        """
+        if self.is_uploading(path):
+            return False
+        self.users.request_upload(user, file_handler.GET_FILE_NAME(path))
+        user.client.send_msg(protocols.build_header(protocols.REQUEST_FILE, path), '')
+        return True
+
+    def start_upload(self, user, key):
+        """
+        Tracks an upload which has started.
+        :param user: the user who uploads the file.
+        :param key: the upload's (stream id, file name) key.
+        """
+        self.users.add_upload(user, key)
+
+    def submit_upload_job(self, user, key, func, args=(), callback=None, *callback_args):
+        """
+        Runs disk work of an upload on a writer thread, after the upload's earlier jobs
+        :param user: the user who uploads the file
+        :param key: the upload's (stream id, file name) key
+        :param func: the function to run
+        :param args: the arguments of the function
+        :param callback: called on the event loop with the callback args, the result and the exception (if any)
+        :param callback_args: additional arguments for the callback
+        """
+        self.writers.submit((user.nickname,) + key, func, args, callback, *callback_args)
+
+    def file_start(self, name, user, msg):
+        """
+        Accepts a flow controlled upload.
+        The upload is granted credits once its file was opened - a resumable upload first learns which of its chunks
+        were received by an earlier upload.
+        A resumable upload whose content is already stored (with the same manifest) is told to skip all of its chunks
+        but one, which proves the user has the content (see store.Challenge).
+        :param name: the file's name.
+        :param user: the user who sends the file.
+        :param msg: the 'file start' message.
+        :raises protocols.ProtocolError: if the file was not requested from the user, or it is too large.
+        """
+        key = (msg.stream, name)
+        if name not in user.upload_requests:
+            raise protocols.ProtocolError('Unrequested upload: {!r}'.format(name))
+        size, manifest = manifests.parse_start(msg.data)
+        if size is not None and size > self.limits.max_upload_size:
+            raise protocols.ProtocolError('Upload too large: {!r} ({} bytes)'.format(name, size))
+        self.start_upload(user, key)
+        if manifest:
+            self.submit_upload_job(user, key, self.store.find, (manifest,), self.stored_content_found, user, key,
+                                   size, manifest)
+            return
+        self.submit_upload_job(user, key, user.downloads.start, (name, size, msg.stream, manifest),
+                               self.upload_started, user, key)
+
+    def stored_content_found(self, user, key, size, manifest, stored, error):
+        """
+        Challenges an upload whose content is stored already, or opens its file (on the event loop).
+        :param user: the user who sends the file.
+        :param key: the upload's (stream id, file name) key.
+        :param size: the file's size.
+        :param manifest: the upload's manifests.Manifest.
+        :param stored: the manifest kept with the stored content, None if the content is not stored.
+        :param error: the exception raised while looking the content up, None if there was none.
+        """
+        if not user.connected or key not in user.uploads:
+            return
+        stream, name = key
+        if not stored:
+            self.submit_upload_job(user, key, user.downloads.start, (name, size, stream, manifest),
+                                   self.upload_started, user, key)
+            return
+        challenge = store.Challenge(stored)
+        self.deduplicated[(user.nickname,) + key] = challenge
+        user.client.send_resume(name, challenge.skipped(), stream)
+        user.client.start_receiving(name, stream)
+
+    def upload_started(self, user, key, upload, error):
+        """
+        Lets an upload start sending its chunks once its file was opened (on the event loop).
+        :param user: the user who sends the file.
+        :param key: the upload's (stream id, file name) key.
+        :param upload: the download_manager.Download object, None if the file could not be opened.
+        :param error: the exception raised while opening the file, None if there was none.
+        """
+        if not user.connected:
+            return
+        stream, name = key
+        if upload and upload.resumed:
+            user.client.send_resume(name, upload.resumed, stream)
+        user.client.start_receiving(name, stream)
+
+    def file_resume(self, name, user, msg):
+        """
+        Handles the chunks a user already has of a resumable download.
+        :param name: the file's name.
+        :param user: the user who receives the file.
+        :param msg: the 'file resume' message.
+        """
+        user.client.resume_transfer(name, msg.data, msg.stream)
+
+    def file_credit(self, name, user, msg):
+        """
+        Handles the credits a user grants a download.
+        :param name: the file's name.
+        :param user: the user who receives the file.
+        :param msg: the 'file credit' message.
+        """
+        user.client.grant_credit(name, msg.data, msg.stream)
 
     def process_file_chunk(self, name, user, msg):
         """
-        Adds the file chunk data to the downloaded file data.
+        Queues the file chunk data to be written to the uploaded file.
+        The user's socket is not read while too much of their data waits for the disk.
+        Only the chunks of accepted uploads are taken - of a flow controlled upload once its file start was accepted,
+        otherwise of a file which was requested from the user.
         :param name: the file's name.
         :param user: the user who sent the file chunk.
         :param msg: the message.
+        :raises protocols.ProtocolError: if the chunk is not of an accepted upload.
+        """
+        key = (msg.stream, name)
+        if user.client.flow_controlled and key not in user.client.receiving:
+            raise protocols.ProtocolError('A chunk of an upload which was not accepted: {!r}'.format(name))
+        challenge = self.deduplicated.get((user.nickname,) + key)
+        if challenge:
+            challenge.check(msg.data)  # the content is stored already, the chunk only proves the user has it
+            user.client.chunk_consumed(name, msg.stream)
+            return
+        if key not in user.uploads:
+            if key in user.downloads.failed:
+                # the upload failed, the rest of it is drained and ignored
+                user.client.chunk_consumed(name, msg.stream)
+                return
+            if user.client.flow_controlled or name not in user.upload_requests:
+                raise protocols.ProtocolError('A chunk of an upload which was not accepted: {!r}'.format(name))
+            self.start_upload(user, key)  # an upload which is not flow controlled starts with its first chunk
+        data = wire.to_bytes(msg.data)  # the message is a view of the socket's buffer
+        user.write_backlog += len(data)
+        if user.write_backlog > MAX_WRITE_BACKLOG:
+            self.pause_reading(user.client)
+        self.submit_upload_job(user, key, user.downloads.write, (name, data, msg.stream),
+                               self.chunk_written, user, key, data)
+
+    def chunk_written(self, user, key, data, upload, error):
+        """
+        Handles a chunk which was written to the disk (on the event loop).
+        :param user: the user who sent the chunk.
+        :param key: the upload's (stream id, file name) key.
+        :param data: the chunk's data.
+        :param upload: the download_manager.Download object.
+        :param error: the exception raised by the write, None if it succeeded.
         """
-        file_handler.create_file(file_handler.get_location(DL_DIR, name), msg.data)
+        if not user.connected:
+            return
+        stream, name = key
+        user.write_backlog -= len(data)
+        if user.client in self.paused_readers and user.write_backlog <= MAX_WRITE_BACKLOG / 2:
+            self.resume_reading(user.client)
+        if key in user.uploads:
+            if error:
+                self.users.discard_upload(user, key)
+                self.relay.upload_ended(name, failed=True)
+                user.client.send_regular_msg(self.upload_failed_msg.format(name))
+            else:
+                self.relay.upload_chunk(name, data, upload)
+        # the upload's window grows while the user's writes keep up with the disk
+        user.client.chunk_consumed(name, stream, room=user.write_backlog <= MAX_WRITE_BACKLOG / 2)
 
     def file_end(self, name, user, msg):
         """
@@ -207,8 +736,59 @@ class Server(object):
         :param user: the user who sent the file.
         :param msg: the 'file end' message.
         """
-        self.broadcast(self.upload_finished_msg.format(name))
-        user.uploading = False
+        key = (msg.stream, name)
+        user.client.finish_receiving(name, msg.stream)
+        challenge = self.deduplicated.pop((user.nickname,) + key, None)
+        if challenge:
+            if challenge.proven:
+                self.submit_upload_job(user, key, self.store.link, (name, challenge.digest), self.upload_finished,
+                                       user, key)
+            else:
+                self.upload_finished(user, key, None, None)
+        else:
+            self.submit_upload_job(user, key, self.finish_upload, (user.downloads, name, msg.stream),
+                                   self.upload_finished, user, key)
+
+    @staticmethod
+    def finish_upload(downloads, name, stream):
+        """
+        Completes an upload's file (on a writer thread).
+        :param downloads: the uploader's download_manager.DownloadManager object.
+        :param name: the file's name.
+        :param stream: the upload's stream id.
+        :return: the file's content hash, None if the upload failed.
+        """
+        upload = downloads.finish(name, stream)
+        return upload.digest if upload else None
+
+    def upload_finished(self, user, key, digest, error):
+        """
+        Announces an upload once it was stored (on the event loop).
+        :param user: the user who sent the file.
+        :param key: the upload's (stream id, file name) key.
+        :param digest: the file's content hash, None if the upload failed.
+        :param error: the exception raised while storing the upload, None if there was none.
+        """
+        if not user.connected or key not in user.uploads:
+            return  # the failure was already reported
+        name = key[1]
+        self.users.discard_upload(user, key)
+        self.relay.upload_ended(name, failed=not digest, digest=digest)
+        if not digest:
+            user.client.send_regular_msg(self.upload_failed_msg.format(name))
+            return
+        self.broadcast(self.upload_finished_msg.format(name), user.room)
+        self.broadcast_file(name, user.room)
+
+    def set_admin(self, user, is_admin):
+        """
+        Promotes a user to an admin, or demotes them to a regular (their display name changes accordingly)
+        :param user: the User object
+        :param is_admin: whether the user is an admin
+        """
+        self.users.set_admin(user, is_admin)
+        if self.bus:
+            self.bus.publish(cluster.UPDATE, cluster.user_info(user))
 
     def change_display_name(self, user, new_nick):
         """
@@ -216,47 +796,162 @@ class Server(object):
         :param user: the user whose nickname will change
         :param new_nick: The new nickname
         """
-        self.users_by_nick[user.nickname].display_name = new_nick
-        self.users_by_client[user.client].display_name = new_nick
+        self.users.rename(user, new_nick)
+        if self.bus:
+            self.bus.publish(cluster.UPDATE, cluster.user_info(user))
 
-    def broadcast_file(self, path):
+    def join_room(self, user, name):
+        """
+        Moves a user to a room - the room's last messages are replayed to them, and both rooms are told
+        :param user: the User object
+        :param name: the room's name
+        """
+        left = user.room
+        room = self.rooms.join(user, name)
+        self.broadcast(self.room_left_message.format(user.display_name, left), left)
+        room.history.replay(user.client)
+        self.broadcast(self.room_joined_message.format(user.display_name, name), name)
+        if self.bus:
+            self.bus.publish(cluster.UPDATE, cluster.user_info(user))
+
+    def room_sizes(self):
+        """
+        Counts the members of the rooms, including users connected to other workers
+        :return: a Counter of the numbers of members by room names
         """
-        Sends a file to all users.
+        sizes = collections.Counter({room.name: len(room) for room in self.rooms if room.members})
+        if self.bus:
+            sizes.update(remote_user.room for remote_user in self.bus.remote_users.itervalues())
+        return sizes
+
+    def broadcast_file(self, path, room):
+        """
+        Sends a file to the members of a room.
         :param path: the file's path.
+        :param room: the room's name.
         """
-        for client in self.users_by_client:
-            try:
-                client.send_msg(protocols.build_header(protocols.FILE_DL, path), '')
-            except:
-                pass
+        self.broadcast_message(wire.SharedMessage(protocols.build_header(protocols.FILE_DL, path), ''), room)
 
-    def broadcast(self, content):
+    def broadcast(self, content, room, sender=''):
         """
-        Broadcasts content to everyone
+        Broadcasts content to the members of a room
         :param content: the content to send
+        :param room: the room's name
+        :param sender: the nickname of the user who wrote the content ('' for the server's announcements)
         """
-        for client in self.users_by_client:
+        self.broadcast_message(wire.SharedMessage(protocols.build_header(protocols.REGULAR), content), room,
+                               droppable=True, sender=sender)
+
+    def broadcast_message(self, message, room, droppable=False, relay=True, sender=''):
+        """
+        Sends a message to the members of a room
+        The message is encoded (and compressed) once per codec and the same frame is queued for every member
+        Chat messages are kept in the room's history and the chat log as well (file announcements are not)
+        :param message: a wire.SharedMessage object
+        :param room: the room's name
+        :param droppable: whether overloaded outbound queues may discard the message
+        :param relay: whether to relay the message to the members of the room on the other workers
+        :param sender: the nickname of the user who wrote the message ('' for the server's announcements)
+        """
+        if relay and self.bus:
+            self.bus.publish(cluster.BROADCAST, {'header': message.header, 'data': message.data, 'room': room,
+                                                 'droppable': droppable, 'sender': sender})
+        if protocols.get_protocol(message.header) == protocols.REGULAR:
+            self.rooms.record(room, message)
+            self.log_message(chat_log.BROADCAST, sender, '', message.data, room)
+        for user in self.rooms.members(room):
+            client = user.client
             try:
-                client.send_regular_msg(content)
+                client.send_frame(message.frame(client.codec, client.compressing), droppable)
             except:
                 pass
 
+    def log_message(self, kind, sender, target, text, room=''):
+        """
+        Appends a message to the chat log - the messages are written in batches, on a writer thread
+        :param kind: chat_log.BROADCAST or chat_log.WHISPER
+        :param sender: the nickname of the sender ('' for the server's announcements)
+        :param target: the nickname of the whisper's target ('' for broadcasts)
+        :param text: the message
+        :param room: the room of a broadcast ('' for whispers)
+        """
+        waiting = self.chat_log.append(kind, sender, target, text, room)
+        if waiting >= chat_log.DEF_FLUSH_BATCH:
+            self.flush_chat_log()
+        elif waiting == 1:
+            self.event_loop.call_later(chat_log.DEF_FLUSH_INTERVAL, self.flush_chat_log)
+
+    def flush_chat_log(self):
+        """
+        Hands the waiting messages of the chat log to a writer thread (the writes run in order)
+        """
+        records = self.chat_log.take()
+        if records:
+            self.writers.submit(CHAT_LOG_JOBS, self.write_chat_log, (records,))
+
+    def write_chat_log(self, records):
+        """
+        Writes messages to the chat log and indexes them for searching (on a writer thread)
+        :param records: chat_log.Record objects
+        """
+        self.chat_log.write(records)
+        self.search_index.add(records)
+        if self.search_index.unsaved >= search.SAVE_INTERVAL:
+            self.search_index.save(self.chat_log.first_id())
+
     def disconnect_user(self, user):
         """
         Disconnects the user from the server
-        :param user: the user to disconnect
+        :param user: the user to disconnect (users of other workers are disconnected by their worker)
         """
+        if isinstance(user, cluster.RemoteUser):
+            self.bus.publish(cluster.KICK, {'nickname': user.nickname})
+            return
         try:
             user.client.send_msg(protocols.build_header(protocols.END_CONNECTION), '')
         except:
             pass
         user.connected = False
-        user.client.close_sock()
+        user.client.outbound.flush()  # best effort, the socket is closed either way
         self.remove_user(user)
+        user.client.close_sock()
 
 
 def main():
-    s = Server()
+    parser = argparse.ArgumentParser(description='Runs the chat server.')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='the number of server processes (more than one forks workers sharing the port)')
+    parser.add_argument('-c', '--coalesce-window', type=float, default=outbound.DEF_COALESCE_WINDOW,
+                        help='the seconds messages wait to be sent together with later messages '
+                             '(0 - until the current events are handled, negative - sent right away)')
+    parser.add_argument('--max-users', type=int, default=admission.DEF_MAX_USERS,
+                        help='the number of users (of each worker), more are rejected once they connect')
+    parser.add_argument('--max-per-address', type=int, default=admission.DEF_MAX_PER_ADDRESS,
+                        help='the number of connections from one IP address (to each worker)')
+    parser.add_argument('--backlog', type=int, default=admission.DEF_BACKLOG,
+                        help='the size of the listen backlog')
+    parser.add_argument('--message-rate', type=float, default=admission.DEF_MESSAGE_RATE,
+                        help='the messages each user may send per second')
+    parser.add_argument('--byte-rate', type=float, default=admission.DEF_BYTE_RATE,
+                        help='the bytes of messages each user may send per second')
+    parser.add_argument('--max-frame-size', type=int, default=admission.DEF_MAX_FRAME_SIZE,
+                        help='the size (bytes) of the largest frame a connection may send, larger ones disconnect it')
+    parser.add_argument('--max-upload-size', type=int, default=admission.DEF_MAX_UPLOAD_SIZE,
+                        help='the size (bytes) of the largest file a user may upload')
+    parser.add_argument('--history-size', type=int, default=history.DEF_HISTORY_SIZE,
+                        help='the number of chat messages each room replays to joining users (0 - none)')
+    parser.add_argument('--history-bytes', type=int, default=history.DEF_HISTORY_BYTES,
+                        help='the bytes of chat messages each room replays to joining users')
+    args = parser.parse_args()
+    limits = admission.Limits(max_users=args.max_users, max_per_address=args.max_per_address,
+                              backlog=args.backlog, message_rate=args.message_rate, byte_rate=args.byte_rate,
+                              max_frame_size=args.max_frame_size, max_upload_size=args.max_upload_size)
+    server_factory = functools.partial(Server, coalesce_window=args.coalesce_window, limits=limits,
+                                       history_size=args.history_size, history_bytes=args.history_bytes)
+    if args.workers > 1:
+        cluster.Supervisor(server_factory, args.workers, limits.backlog, limits.max_frame_size).start()
+        return
+    s = server_factory()
     s.start_server()
     s.server.close_sock()
 
@@ -2,25 +2,27 @@
 This module contains the ChatClient class, used for client-server communication.
 The ChatClient follows the communication protocol: send size of data - then the data itself.
 """
+import collections
+import functools
+import itertools
 import socket
-import jsonpickle as pickle
-from threading import Thread
-from time import sleep
+import threading
 
 import file_handler
-import messages
+import frame_reader
+import manifests
 import protocols
+import transfer
+import wire
 
-MSG_LEN_SIZE = 10  # The size of the length of a message
+MSG_LEN_SIZE = wire.MSG_LEN_SIZE  # The size of the length of a message
 # the default server ip address - the current computer
 DEF_SERVER_IP = socket.gethostbyname(socket.gethostname())
 # the default server port - the host's choice
 DEF_SERVER_PORT = 9900
 DEF_DATA_CHUNK_SIZE = 1048576
 DEF_LISTEN = 5
-
-
-CHUNK_SEND_WAIT = 0.1
+DEF_MAX_READS = 4  # the maximum number of reads per read_messages call, so one socket cannot starve the others
 
 
 class ChatSocket(socket.socket):
@@ -29,13 +31,16 @@ class ChatSocket(socket.socket):
     The chat socket contains the chat socket socket and the server's info
     """
     def __init__(self, server_ip=DEF_SERVER_IP, port=DEF_SERVER_PORT, msg_len_size=MSG_LEN_SIZE,
-                 data_chunk_size=DEF_DATA_CHUNK_SIZE, listen=DEF_LISTEN, _sock=None):
+                 data_chunk_size=DEF_DATA_CHUNK_SIZE, listen=DEF_LISTEN, max_frame_size=frame_reader.DEF_MAX_FRAME_SIZE,
+                 scheduler=None, _sock=None):
         """
         The class constructor.
         :param server_ip: IP of the server.
         :param port: port of the server.
         :param msg_len_size: the maximum number of digits representing data size.
         :param data_chunk_size: the size of a data chunk (used to split sent file data)
+        :param max_frame_size: the size of the largest frame accepted from the peer.
+        :param scheduler: the transfer.Scheduler which sends the files (when there is no outbound queue).
         """
         self.port = port
         self.server_ip = server_ip
@@ -47,11 +52,43 @@ class ChatSocket(socket.socket):
         else:
             super(ChatSocket, self).__init__()
         self.open = False
+        # an outbound queue (used by the server) - when set, frames are queued instead of sent directly
+        self.outbound = None
+        # the wire codec of the connection, negotiated in the handshake
+        self.codec = wire.CODECS[wire.JSON]
+        # the optional features of the connection, negotiated in the handshake
+        self.features = set()
+        # the streaming compression contexts of the connection (see wire.py), when it is compressed
+        self.deflater = None
+        self.inflater = None
+        # transfers are identified by (stream id, file name) keys - the stream ids are chosen by the sending side
+        self.stream_ids = itertools.count(1)
+        self.senders = dict()  # the flow control of the outgoing transfers by keys
+        self.receiving = dict()  # the flow control of the incoming transfers (transfer.Receiver objects) by keys
+        self.credited = 0  # the credits granted to the senders of the incoming transfers which were not used yet
+        self.unacknowledged = 0  # the chunks of the outgoing flow controlled transfers which were not credited back yet
+        self.scheduler = scheduler or transfer.SCHEDULER
+        # without an outbound queue, frames are sent by several threads - one at a time, and the frames which are not
+        # file chunks before the chunks
+        self.send_lock = threading.Lock()
+        self.control = collections.deque()
+        self.reader = frame_reader.FrameReader(self, max_frame_size)
 
     def connect(self):
         super(ChatSocket, self).connect((self.server_ip, self.port))
+        self.set_no_delay()
         self.open = True
 
+    def set_no_delay(self):
+        """
+        Disables Nagle's algorithm - small frames are coalesced before they are written, so they should not be
+        delayed by the kernel as well.
+        """
+        try:
+            self.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except socket.error:
+            pass  # not a TCP socket
+
     def initialize_server_socket(self):
         """
         Initializes the server socket.
@@ -65,7 +102,9 @@ class ChatSocket(socket.socket):
         :return: client socket and address as returned by the socket.accept method.
         """
         sock, address = super(ChatSocket, self).accept()
-        return ChatSocket(_sock=sock), address
+        client = ChatSocket(max_frame_size=self.reader.max_frame_size, _sock=sock)
+        client.set_no_delay()
+        return client, address
 
     def receive(self):
         """
@@ -86,73 +125,395 @@ class ChatSocket(socket.socket):
         """
         try:
             data = self.recv(size)
-            while len(data) < size:
-                data += self.recv(size - len(data))
+            while data and len(data) < size:
+                chunk = self.recv(size - len(data))
+                if not chunk:  # the peer closed the connection mid-message
+                    return ''
+                data += chunk
             return data
         except:
             return ''
 
     def receive_obj(self):
         """
-        Receives an object from the server.
-        :return: sent object.
+        Receives a message from the server.
+        :return: sent message.
         """
         try:
-            return pickle.loads(self.receive())
+            while True:
+                for frame in self.reader.frames():
+                    return self.codec.decode(frame, self.inflater)
+                if not self.reader.fill():
+                    return ''
         except:
             return ''
 
-    def send_str(self, msg):
+    def read_messages(self, max_reads=DEF_MAX_READS, admit=None):
+        """
+        Reads the messages which are available without blocking (the socket should be non-blocking).
+        The messages are yielded as they are decoded - the data of a file chunk is a view of the read buffer,
+        which is valid until the next message is requested.
+        The reader's closed attribute is set once the peer closes the connection.
+        :param max_reads: the maximum number of reads from the socket.
+        :param admit: called with each frame before it is decoded - once it refuses a frame, reading stops and the
+        reader's held attribute is set (the frame is offered again by the next call, before anything else is read).
+        :return: a generator of the received messages.
+        """
+        for _ in xrange(max_reads):
+            received = None if self.reader.held else self.reader.fill()
+            for frame in self.reader.frames(admit):
+                yield self.codec.decode(frame, self.inflater)
+            if not received or self.reader.held:
+                break
+
+    def handshake(self, nick, offers=wire.OFFERS):
+        """
+        Sends the client's nickname and negotiates the codec and the features of the connection.
+        :param nick: the client's nickname.
+        :param offers: the names of the codecs (preferred first) and the features the client supports.
+        """
+        self.send_str(wire.build_hello(nick, offers))
+        self.configure(*wire.parse_reply(self.receive()))
+
+    def configure(self, codec, features):
+        """
+        Switches the connection to its negotiated codec and features.
+        :param codec: the codec object.
+        :param features: the feature names.
+        """
+        self.codec, self.features = codec, set(features)
+        if wire.DEFLATE in self.features:
+            self.deflater, self.inflater = wire.create_deflater(), wire.create_inflater()
+
+    @property
+    def compressing(self):
+        """
+        :return: True if the frames of the connection are compressed.
+        """
+        return self.deflater is not None
+
+    def compress_frame(self, frame):
+        """
+        Compresses a frame with the connection's streaming context - frames have to be compressed in the order
+        they are sent.
+        :param frame: the frame's bytes (encoded by the connection's codec).
+        :return: the frame to send.
+        """
+        return self.codec.deflate(frame, self.deflater) if self.deflater else frame
+
+    def send_frame(self, frame, droppable=False, compress=False):
+        """
+        Sends a complete frame (size and data), through the outbound queue if there is one.
+        :param frame: the frame's bytes.
+        :param droppable: whether an overloaded outbound queue may discard the frame.
+        :param compress: whether to compress the frame with the connection's streaming context when it is sent
+        (frames shared with other connections are not).
+        """
+        if self.outbound is not None:
+            self.outbound.push(frame, droppable, compress)
+            return
+        self.control.append((frame, compress))
+        with self.send_lock:
+            self._send_control()
+
+    def _send_control(self):
+        """
+        Sends the frames which wait for the socket (the send lock should be held) - together, with one write.
+        """
+        batch = list()
+        while self.control:
+            frame, compress = self.control.popleft()
+            batch.append(self.compress_frame(frame) if compress else frame)
+        if batch:
+            self.sendall(batch[0] if len(batch) == 1 else ''.join(batch))
+
+    def _send_transfer_frame(self, frame):
+        """
+        Sends a frame of a file transfer - after the other frames which wait for the socket.
+        :param frame: the frame's bytes, or a file_handler.ChunkFrame object.
+        """
+        with self.send_lock:
+            self._send_control()
+            if isinstance(frame, file_handler.ChunkFrame):
+                frame.sendall(self)
+            else:
+                self.sendall(frame)
+
+    def send_str(self, msg, droppable=False):
         """
         Sends a string
         :param msg: the message object
+        :param droppable: whether an overloaded outbound queue may discard the message.
         """
-        self.sendall(str(len(msg)).zfill(MSG_LEN_SIZE))
-        self.sendall(msg)
+        self.send_frame(wire.build_frame(msg), droppable)
 
-    def send_obj(self, obj):
+    def send_obj(self, obj, droppable=False):
         """
-        Sends and object.
-        :param obj: an object.
+        Sends a Message object.
+        :param obj: a Message object.
+        :param droppable: whether an overloaded outbound queue may discard the object.
         """
-        self.send_str(pickle.dumps(obj))
+        self.send_msg(obj.header, obj.data, droppable)
 
-    def send_msg(self, header, data):
+    def send_msg(self, header, data, droppable=False, stream=0):
         """
         Sends a message.
         :param header: the message's protocol header.
         :param data: the message's data.
+        :param droppable: whether an overloaded outbound queue may discard the message.
+        :param stream: the id of the transfer stream the message belongs to.
         """
-        self.send_obj(messages.Message(header, data))
+        self.send_frame(self.codec.encode(header, data, stream), droppable, compress=True)
 
     def send_regular_msg(self, data):
         """
         Sends a regular-type message.
         :param data: the message's data
         """
-        self.send_msg(protocols.build_header(protocols.REGULAR), data)
+        self.send_msg(protocols.build_header(protocols.REGULAR), data, droppable=True)
+
+    @property
+    def flow_controlled(self):
+        """
+        :return: True if the file transfers of the connection are flow controlled (see transfer.py).
+        """
+        return wire.CREDIT in self.features
+
+    @property
+    def resumable(self):
+        """
+        :return: True if the file transfers of the connection are resumable (see manifests.py).
+        """
+        return wire.RESUME in self.features and wire.CREDIT in self.features
+
+    def open_stream(self):
+        """
+        Chooses the stream id of a new outgoing transfer.
+        :return: a stream id, 0 if the codec does not carry stream ids.
+        """
+        return next(self.stream_ids) if self.codec.streams else 0
 
-    def _send_chunks(self, chunks, path):
+    def generate_chunk_frames(self, path, name, stream=0):
         """
-        Sends chunks of a file.
-        :param chunks: a collection of a file's data in chunks.
-        :param path: the file's path.
+        Generates the file chunk frames of a file.
+        If the codec allows it the frames are file regions, whose data is sent straight from the file - unless the
+        connection is compressed and a sample of the file compresses well, then the chunks are compressed.
+        :param path: the path of the file.
+        :param name: the file's name.
+        :param stream: the transfer's stream id.
+        :return: the frames.
         """
+        header = protocols.build_header(protocols.FILE_CHUNK, name)
+        compress = self.compressing and wire.is_compressible(file_handler.read_sample(path, wire.COMPRESS_SAMPLE_SIZE))
+        if compress or not self.codec.raw_payloads:
+            for chunk in file_handler.generate_chunks(path, self.data_chunk_size):
+                yield self.codec.encode(header, chunk, stream, compress)
+            return
+        buffer = None if file_handler.SENDFILE else bytearray(file_handler.DEF_REGION_BUFFER_SIZE)
+        for file, offset, length in file_handler.generate_regions(path, self.data_chunk_size):
+            yield file_handler.FileRegion(self.codec.encode_header(header, length, stream=stream), file, offset,
+                                          length, buffer)
+
+    def build_chunk_frame(self, header, data, stream=0, compressed=False):
+        """
+        Builds the frame of a file chunk which is held in memory.
+        If the codec allows it the chunk is not copied into the frame, so it may be shared with other sockets.
+        :param header: the chunk's protocol header.
+        :param data: the chunk's data (a string).
+        :param stream: the transfer's stream id.
+        :param compressed: whether the data was compressed on its own (see wire.compress_payload).
+        :return: the frame.
+        """
+        if self.codec.raw_payloads:
+            flags = wire.FLAG_DEFLATE if compressed else 0
+            return file_handler.ChunkFrame(self.codec.encode_header(header, len(data), flags, stream), data)
+        return self.codec.encode(header, data, stream)
+
+    def generate_file_frames(self, chunks, path, sender=None, size=None, stream=0, manifest=None):
+        """
+        Generates the frames of a file transfer.
+        A flow controlled transfer starts with a file start (which carries the file's manifest, or its size if it is
+        known), and yields None whenever it waits for credits (or whenever the chunks do).
+        The chunks the receiver of a resumable transfer reported before granting its first credits are skipped.
+        :param chunks: the file chunk frames.
+        :param path: the file's name.
+        :param sender: a transfer.Sender object if the transfer is flow controlled, None otherwise.
+        :param size: the file's size, None if it is not known.
+        :param stream: the transfer's stream id.
+        :param manifest: the file's manifests.Manifest, or a function which builds it, if the transfer is resumable.
+        :return: the frames (chunks, then the file end).
+        """
+        if sender:
+            if callable(manifest):
+                manifest = manifest()
+            data = manifest.encode() if manifest else ('' if size is None else str(size))
+            yield self.codec.encode(protocols.build_header(protocols.FILE_START, path), data, stream, self.compressing)
+        index = 0
         for chunk in chunks:
-            self.send_msg(protocols.build_header(protocols.FILE_CHUNK, path), chunk)
-            sleep(CHUNK_SEND_WAIT)
-        self.send_msg(protocols.build_header(protocols.FILE_END, path), '')
+            if chunk is None:
+                yield None
+                continue
+            while sender and not sender.can_send():
+                if sender.cancelled:
+                    return
+                yield None
+            index += 1
+            if sender and index - 1 in sender.skipped:
+                continue
+            if sender:
+                sender.on_sent()
+                self.unacknowledged += 1
+            yield chunk
+        if sender:
+            self.senders.pop((stream, path), None)
+        yield self.codec.encode(protocols.build_header(protocols.FILE_END, path), '', stream)
 
     def send_file(self, path):
         """
         Sends a file.
+        With an outbound queue the file's frames are pulled by the queue, otherwise the scheduler sends them.
+        The transfer is flow controlled if the peer supports it.
         :param path: a path of a file.
         Name is necessary for instances where the receiver has no indication of the sender's identity.
         """
-        file_chunks = file_handler.generate_chunks(path, DEF_DATA_CHUNK_SIZE)
-        path = file_handler.GET_FILE_NAME(path)
-        sender = Thread(target=self._send_chunks, args=[file_chunks, path])
-        sender.start()
+        name = file_handler.GET_FILE_NAME(path)
+        stream = self.open_stream()
+        # the manifest is built by the transfer, so the file is read by the thread which sends it
+        manifest = functools.partial(manifests.build, path, self.data_chunk_size)
+        self.send_file_frames(self.generate_chunk_frames(path, name, stream), name, file_handler.GET_FILE_SIZE(path),
+                              stream, manifest)
+
+    def send_file_frames(self, chunks, name, size=None, stream=0, manifest=None):
+        """
+        Sends a file given the frames of its chunks.
+        :param chunks: the file chunk frames, None whenever the next chunk is not available yet
+        (only with an outbound queue, which has to be resumed once it is).
+        :param name: the file's name.
+        :param size: the file's size, None if it is not known.
+        :param stream: the transfer's stream id (see open_stream).
+        :param manifest: the file's manifests.Manifest (or a function which builds it), None if it is not known -
+        the transfer is resumable if the peer supports it and the chunks match the manifest's chunks.
+        """
+        sender = None
+        if wire.CREDIT in self.features:
+            sender = self.senders[(stream, name)] = transfer.Sender(name)
+        if not self.resumable:
+            manifest = None
+        frames = self.generate_file_frames(chunks, name, sender, size, stream, manifest)
+        if self.outbound is not None:
+            self.outbound.add_producer(frames)
+        else:
+            self.scheduler.submit(frames, self._send_transfer_frame)
+
+    def grant_credit(self, path, count, stream=0):
+        """
+        Handles the credits granted by the receiver of a transfer.
+        :param path: the file's name.
+        :param count: the number of credits, and the number of chunks consumed if it is not the same
+        ('<credits>[ <consumed chunks>]').
+        :param stream: the transfer's stream id.
+        :raises protocols.ProtocolError: if the numbers are invalid.
+        """
+        try:
+            numbers = [int(number) for number in count.split()]
+        except ValueError:
+            raise protocols.ProtocolError('Invalid credit: {!r}'.format(count))
+        if not 0 < len(numbers) <= 2 or min(numbers) < 0 or not any(numbers):
+            raise protocols.ProtocolError('Invalid credit: {!r}'.format(count))
+        sender = self.senders.get((stream, path))
+        if not sender:
+            return
+        sender.on_credit(*numbers)
+        if self.outbound is not None:
+            self.outbound.resume()
+        else:
+            self.scheduler.resume()
+
+    def send_credit(self, path, count, stream=0, consumed=None):
+        """
+        Grants the sender of a transfer credits.
+        :param path: the file's name.
+        :param count: the number of credits.
+        :param stream: the transfer's stream id.
+        :param consumed: the number of chunks consumed since the last credits, None if it is the number of credits.
+        """
+        self.credited += count
+        data = str(count) if consumed is None or consumed == count else '{} {}'.format(count, consumed)
+        self.send_msg(protocols.build_header(protocols.FILE_CREDIT, path), data, stream=stream)
+
+    def take_credit(self):
+        """
+        Accounts for a received chunk which was sent on a credit.
+        :return: True if a credit the sender was granted covers the chunk, False otherwise.
+        """
+        if self.credited <= 0:
+            return False
+        self.credited -= 1
+        return True
+
+    def take_acknowledgement(self):
+        """
+        Accounts for received credits which acknowledge a sent chunk.
+        :return: True if a chunk which was sent on a credit was not acknowledged yet, False otherwise.
+        """
+        if self.unacknowledged <= 0:
+            return False
+        self.unacknowledged -= 1
+        return True
+
+    def send_resume(self, path, indexes, stream=0):
+        """
+        Tells the sender of a resumable transfer which chunks it should skip (before granting it credits).
+        :param path: the file's name.
+        :param indexes: the indexes of the chunks the receiver has.
+        :param stream: the transfer's stream id.
+        """
+        self.send_msg(protocols.build_header(protocols.FILE_RESUME, path), manifests.format_ranges(indexes),
+                      stream=stream)
+
+    def resume_transfer(self, path, ranges, stream=0):
+        """
+        Handles the chunks the receiver of a resumable transfer reported it has.
+        :param path: the file's name.
+        :param ranges: the ranges of the chunks (see manifests.format_ranges).
+        :param stream: the transfer's stream id.
+        :raises protocols.ProtocolError: if the ranges are malformed.
+        """
+        skipped = manifests.parse_ranges(ranges)
+        sender = self.senders.get((stream, path))
+        if sender:
+            sender.skipped = skipped
+
+    def start_receiving(self, path, stream=0):
+        """
+        Accepts a flow controlled transfer - grants the sender its initial window.
+        :param path: the file's name.
+        :param stream: the transfer's stream id.
+        """
+        receiver = self.receiving[(stream, path)] = transfer.Receiver()
+        self.send_credit(path, receiver.window, stream)
+
+    def chunk_consumed(self, path, stream=0, room=True):
+        """
+        Grants the sender of a flow controlled transfer credits for a chunk which was consumed - one, more while the
+        receiver's window grows, or none while it shrinks (see transfer.Receiver).
+        :param path: the file's name.
+        :param stream: the transfer's stream id.
+        :param room: whether the receiver has room for more chunks than it granted.
+        """
+        receiver = self.receiving.get((stream, path))
+        if receiver:
+            self.send_credit(path, receiver.on_consumed(room), stream, consumed=1)
+
+    def finish_receiving(self, path, stream=0):
+        """
+        Forgets an incoming transfer.
+        :param path: the file's name.
+        :param stream: the transfer's stream id.
+        """
+        self.receiving.pop((stream, path), None)
+        if not self.receiving:
+            self.credited = 0  # the credits of the transfers which ended are not used anymore
 
     def close_sock(self):
         """
@@ -162,5 +523,9 @@ class ChatSocket(socket.socket):
             self.shutdown(socket.SHUT_RDWR)  # Stop receiving/sending
         except:
             pass
+        for sender in self.senders.values():
+            sender.cancel()
+        if self.outbound is None:
+            self.scheduler.resume()  # the cancelled transfers end
         self.close()
         self.open = False
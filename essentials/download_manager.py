@@ -0,0 +1,383 @@
+"""
+This module contains the download manager, which writes received files to the disk.
+Each transfer is written through a single buffered handle into a temporary file (preallocated when the size is known),
+which atomically replaces the destination file once the transfer ends - a failed or repeated transfer never leaves
+a partial or doubled file behind. With a store (such as the server's content addressed store), the received file
+is handed to the store instead.
+A resumable transfer (one with a manifest, see manifests.py) verifies every chunk, and writes the chunks it verified
+to a state file next to its temporary file - when the transfer is interrupted both files are kept, and the next
+transfer of the same file picks them up and only receives the missing chunks.
+"""
+import json
+import os
+import tempfile
+import time
+
+import manifests
+
+DEF_WRITE_BUFFER_SIZE = 262144  # 256 KiB
+TEMP_SUFFIX = '.part'
+STATE_SUFFIX = '.state'
+PREALLOCATE = getattr(os, 'posix_fallocate', None)
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+# fsync policies - when the written data is forced to the disk
+FSYNC_NEVER = 'never'  # left to the operating system
+FSYNC_FINISH = 'finish'  # once, before the file is renamed
+FSYNC_ALWAYS = 'always'  # after every chunk
+FSYNC_POLICIES = (FSYNC_NEVER, FSYNC_FINISH, FSYNC_ALWAYS)
+
+# download states
+RECEIVING = 'receiving'
+DONE = 'done'
+FAILED = 'failed'
+SUSPENDED = 'suspended'  # interrupted, and kept to be resumed
+
+
+class Download(object):
+    """
+    This class is a single file transfer which is being written to the disk
+    """
+    def __init__(self, directory, name, size=None, buffer_size=DEF_WRITE_BUFFER_SIZE, fsync_policy=FSYNC_FINISH,
+                 manifest=None, store=None, max_size=None):
+        """
+        The class constructor.
+        :param directory: the destination directory.
+        :param name: the file's name.
+        :param size: the file's size if it is known, None otherwise.
+        :param buffer_size: the size of the write buffer.
+        :param fsync_policy: when to force the data to the disk (see FSYNC_POLICIES).
+        :param manifest: the file's manifests.Manifest if the transfer is resumable, None otherwise.
+        :param store: the store which takes the received file (see DownloadManager), None to rename it.
+        :param max_size: the size of the largest file accepted, None for no limit.
+        :raises IOError: if the file is larger than max_size.
+        """
+        self.name = os.path.basename(name)
+        self.path = os.path.abspath(os.path.join(directory, self.name))
+        self.size = manifest.size if manifest else size
+        self.buffer_size = buffer_size
+        self.fsync_policy = fsync_policy
+        self.manifest = manifest
+        self.store = store
+        self.max_size = max_size
+        self.digest = None  # the content hash of the received file (with a store)
+        self.hasher = None  # hashes the content as it is written, while it is written in order
+        self.received = 0
+        self.flushed = 0  # the number of bytes which can be read back from the file
+        self.resumed = set()  # the indexes of the chunks a previous transfer verified (they are not sent again)
+        self.verified = set()  # the indexes of the verified chunks which were written to the file
+        self.pending = list()  # the indexes of the verified chunks which may still be buffered
+        self.state = RECEIVING
+        self.started = time.time()
+        if max_size is not None and self.size is not None and self.size > max_size:
+            raise IOError('{} is larger than the maximum of {} bytes'.format(self.name, max_size))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        if manifest:
+            self._open_resumable(directory)
+        else:
+            self._open_temp(directory, size)
+        if store and not self.resumed:
+            self.hasher = manifests.HASH()
+
+    def _open_temp(self, directory, size):
+        """
+        Opens a new temporary file.
+        :param directory: the destination directory.
+        :param size: the file's size if it is known, None otherwise.
+        """
+        fd, self.temp_path = tempfile.mkstemp(TEMP_SUFFIX, self.name + '.', directory)
+        os.chmod(self.temp_path, 0666 & ~UMASK)  # the permissions of a file created by open
+        self.file = os.fdopen(fd, 'wb', self.buffer_size)
+        if size:
+            self._preallocate(size)
+
+    def _open_resumable(self, directory):
+        """
+        Opens the temporary file of a resumable transfer - the file of an interrupted transfer of the same file
+        if there is one.
+        :param directory: the destination directory.
+        """
+        self.temp_path = os.path.join(directory, '{}.{}{}'.format(self.name, self.manifest.file_id, TEMP_SUFFIX))
+        self.state_path = self.temp_path + STATE_SUFFIX
+        try:
+            with open(self.state_path, 'rb') as state:
+                saved = json.load(state)
+            if saved['id'] == self.manifest.file_id and os.path.exists(self.temp_path):
+                self.resumed = manifests.parse_ranges(saved['verified'])
+        except (IOError, ValueError, KeyError, TypeError):
+            pass  # nothing to resume
+        self.verified = set(self.resumed)
+        self.next_index = self._next_missing(0)
+        if self.resumed:
+            self.file = open(self.temp_path, 'r+b', self.buffer_size)
+            return
+        self.file = open(self.temp_path, 'wb', self.buffer_size)
+        if self.size:
+            self._preallocate(self.size)
+
+    def _next_missing(self, index):
+        """
+        :param index: a chunk's index.
+        :return: the index of the first chunk from the given index on which is sent (was not resumed).
+        """
+        while index in self.resumed:
+            index += 1
+        return index
+
+    def _save_state(self):
+        """
+        Writes the indexes of the verified chunks to the state file (replaced atomically).
+        """
+        temp_state = self.state_path + TEMP_SUFFIX
+        with open(temp_state, 'wb') as state:
+            json.dump({'id': self.manifest.file_id, 'verified': manifests.format_ranges(self.verified)}, state)
+        if os.name == 'nt' and os.path.exists(self.state_path):
+            os.remove(self.state_path)
+        os.rename(temp_state, self.state_path)
+
+    @property
+    def sequential(self):
+        """
+        :return: True if the file is written from its start on (it can be read back while it is received).
+        """
+        return not self.resumed
+
+    def _preallocate(self, size):
+        """
+        Reserves the file's space on the disk, or at least sets its size if the platform cannot reserve space.
+        :param size: the file's size.
+        """
+        try:
+            if PREALLOCATE:
+                PREALLOCATE(self.file.fileno(), 0, size)
+            else:
+                self.file.truncate(size)
+        except (IOError, OSError):
+            pass  # best effort, the file grows as it is written
+
+    @property
+    def progress(self):
+        """
+        :return: the received fraction of the file, None if its size is unknown.
+        """
+        return float(self.received) / self.size if self.size else None
+
+    def write(self, data):
+        """
+        Writes a chunk of the file.
+        The chunks of a resumable transfer are written at their places, skipping the resumed chunks.
+        :param data: the chunk's data (a string or a memoryview).
+        """
+        if self.max_size is not None and self.received + len(data) > self.max_size:
+            raise IOError('{} is larger than the maximum of {} bytes'.format(self.name, self.max_size))
+        if self.manifest:
+            index = self.next_index
+            if index >= self.manifest.chunk_count:
+                raise IOError('{} has more chunks than its manifest lists'.format(self.name))
+            offset = index * self.manifest.chunk_size
+            if self.file.tell() != offset:
+                self.file.seek(offset)
+            self.file.write(data)
+            if self.hasher:
+                self.hasher.update(data)
+            if self.manifest.verify(index, data):
+                self.pending.append(index)
+            self.next_index = self._next_missing(index + 1)
+        else:
+            self.file.write(data)
+            if self.hasher:
+                self.hasher.update(data)
+        self.received += len(data)
+        if self.fsync_policy == FSYNC_ALWAYS:
+            self.flush(sync=True)
+        elif self.received - self.flushed >= self.buffer_size:
+            self.flush()
+
+    def flush(self, sync=False):
+        """
+        Writes the buffered data to the file.
+        :param sync: whether to force the data to the disk.
+        """
+        self.file.flush()
+        self.flushed = self.received
+        if sync:
+            os.fsync(self.file.fileno())
+        if self.pending:
+            self.verified.update(self.pending)
+            del self.pending[:]
+            self._save_state()
+
+    def finish(self):
+        """
+        Completes the transfer - the temporary file replaces the destination file (or is handed to the store).
+        A resumable transfer with chunks which were not verified is suspended instead (and raises an IOError), so the
+        next transfer of the file only receives those chunks.
+        """
+        if not self.manifest and self.size and self.received != self.size:
+            self.file.truncate(self.received)  # drops the preallocated space which was not written
+        self.flush(sync=self.fsync_policy != FSYNC_NEVER)
+        if self.manifest and len(self.verified) != self.manifest.chunk_count:
+            self.suspend()
+            raise IOError('{} chunks of {} failed verification'.format(
+                self.manifest.chunk_count - len(self.verified), self.name))
+        self.file.close()
+        if self.store:
+            self.digest = self.store.put(self.name, self.temp_path, self.hasher and self.hasher.hexdigest(),
+                                         self.manifest)
+        else:
+            if os.name == 'nt' and os.path.exists(self.path):
+                os.remove(self.path)  # renaming does not replace files on windows
+            os.rename(self.temp_path, self.path)
+        if self.manifest and os.path.exists(self.state_path):
+            os.remove(self.state_path)
+        self.state = DONE
+
+    def abort(self):
+        """
+        Cancels the transfer - the temporary file (and the state file) is deleted.
+        """
+        self.state = FAILED
+        paths = [self.temp_path, self.state_path] if self.manifest else [self.temp_path]
+        try:
+            self.file.close()
+            for path in paths:
+                if os.path.exists(path):
+                    os.remove(path)
+        except (IOError, OSError):
+            pass
+
+    def suspend(self):
+        """
+        Interrupts the transfer - a resumable transfer keeps its files to be resumed, others are cancelled.
+        """
+        if self.state != RECEIVING:
+            return
+        if not self.manifest:
+            self.abort()
+            return
+        self.state = SUSPENDED
+        try:
+            self.flush()
+            self.file.close()
+        except (IOError, OSError):
+            self.abort()
+
+
+class DownloadManager(object):
+    """
+    This class tracks the transfers written to a directory by their streams and file names
+    Transfers of the same file on different streams are written to different temporary files
+    """
+    def __init__(self, directory, buffer_size=DEF_WRITE_BUFFER_SIZE, fsync_policy=FSYNC_FINISH, store=None,
+                 max_size=None):
+        """
+        The class constructor.
+        :param directory: the destination directory (of the temporary files, with a store).
+        :param buffer_size: the size of the write buffer of each transfer.
+        :param fsync_policy: when to force the data to the disk (see FSYNC_POLICIES).
+        :param store: takes the received files instead of the directory - an object with a
+        put(name, temp_path, digest, manifest) method which returns the file's content hash (digest is None when
+        the content was not hashed).
+        :param max_size: the size of the largest file accepted, None for no limit (larger transfers fail).
+        """
+        if fsync_policy not in FSYNC_POLICIES:
+            raise ValueError('Unknown fsync policy: {}'.format(fsync_policy))
+        self.directory = directory
+        self.buffer_size = buffer_size
+        self.fsync_policy = fsync_policy
+        self.store = store
+        self.max_size = max_size
+        self.transfers = dict()  # Download objects by (stream id, file name) keys
+        self.failed = set()  # the keys of the transfers which failed and did not end yet
+
+    def start(self, name, size=None, stream=0, manifest=None):
+        """
+        Starts a transfer (a transfer of the same stream and name which did not end is suspended).
+        :param name: the file's name.
+        :param size: the file's size if it is known, None otherwise.
+        :param stream: the transfer's stream id.
+        :param manifest: the file's manifests.Manifest if the transfer is resumable, None otherwise.
+        :return: a Download object (its resumed attribute holds the chunks which should not be sent).
+        """
+        self.suspend(name, stream)
+        self.failed.discard((stream, name))
+        if manifest and any(download.manifest and download.manifest.file_id == manifest.file_id
+                            for download in self.transfers.itervalues()):
+            manifest = None  # the same file is received on another stream, which owns the resumable files
+        download = Download(self.directory, name, size, self.buffer_size, self.fsync_policy, manifest, self.store,
+                            self.max_size)
+        self.transfers[(stream, name)] = download
+        return download
+
+    def write(self, name, data, stream=0):
+        """
+        Writes a chunk of a transfer, starting it if it was not started (by peers which do not announce transfers).
+        A transfer which failed is not written until it ends.
+        :param name: the file's name.
+        :param data: the chunk's data.
+        :param stream: the transfer's stream id.
+        :return: the Download object.
+        """
+        if (stream, name) in self.failed:
+            raise IOError('The transfer of {} failed'.format(name))
+        try:
+            download = self.transfers.get((stream, name)) or self.start(name, stream=stream)
+            download.write(data)
+        except (IOError, OSError):
+            self.abort(name, stream)
+            self.failed.add((stream, name))
+            raise
+        return download
+
+    def finish(self, name, stream=0):
+        """
+        Completes a transfer.
+        :param name: the file's name.
+        :param stream: the transfer's stream id.
+        :return: the Download object, None if there was no such transfer (or it failed).
+        """
+        self.failed.discard((stream, name))
+        download = self.transfers.pop((stream, name), None)
+        if download:
+            try:
+                download.finish()
+            except (IOError, OSError):
+                download.suspend()
+                raise
+        return download
+
+    def abort(self, name, stream=0):
+        """
+        Cancels a transfer (if there is one).
+        :param name: the file's name.
+        :param stream: the transfer's stream id.
+        """
+        download = self.transfers.pop((stream, name), None)
+        if download:
+            download.abort()
+
+    def suspend(self, name, stream=0):
+        """
+        Interrupts a transfer (if there is one) - it is kept to be resumed if it is resumable.
+        :param name: the file's name.
+        :param stream: the transfer's stream id.
+        """
+        download = self.transfers.pop((stream, name), None)
+        if download:
+            download.suspend()
+
+    def abort_all(self):
+        """
+        Cancels all the transfers.
+        """
+        for stream, name in self.transfers.keys():
+            self.abort(name, stream)
+
+    def suspend_all(self):
+        """
+        Interrupts all the transfers (when the connection is lost).
+        """
+        for stream, name in self.transfers.keys():
+            self.suspend(name, stream)
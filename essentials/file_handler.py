@@ -3,6 +3,9 @@ import os
 
 PATH_EXISTS = os.path.exists
 GET_FILE_NAME = os.path.basename
+GET_FILE_SIZE = os.path.getsize
+SENDFILE = getattr(os, 'sendfile', None)  # zero-copy sends, where the platform has them
+DEF_REGION_BUFFER_SIZE = 65536
 
 
 def get_location(*args):
@@ -28,6 +31,119 @@ def generate_chunks(path, size):
             data = file.read(size)
 
 
+def read_sample(path, size):
+    """
+    Reads the beginning of a file.
+    :param path: the path of the file.
+    :param size: the max size of the sample.
+    :return: the sample's data.
+    """
+    with open(path, 'rb') as file:
+        return file.read(size)
+
+
+def generate_regions(path, size):
+    """
+    Generates the ranges of a file's data in chunks, without reading the data.
+    The file is closed once the last of its regions is dropped.
+    :param path: the path of the file.
+    :param size: the max size of each chunk of data.
+    :return: (file, offset, length) tuples.
+    """
+    file = open(path, 'rb')
+    file_size = os.fstat(file.fileno()).st_size
+    for offset in xrange(0, file_size, size):
+        yield file, offset, min(size, file_size - offset)
+
+
+class ChunkFrame(object):
+    """
+    This class is a frame whose payload is sent as is after its header
+    The payload is not copied into the frame, so the same chunk can be shared by the frames of many sockets
+    """
+    def __init__(self, header, data):
+        """
+        The class constructor.
+        :param header: the frame's header bytes.
+        :param data: the payload (a string).
+        """
+        self.header = header
+        self.data = data
+        self.length = len(data)
+
+    def __len__(self):
+        return len(self.header) + self.length
+
+    def send(self, sock, sent, flags=0):
+        """
+        Sends the next part of the frame.
+        :param sock: the socket.
+        :param sent: the number of bytes of the frame which were already sent.
+        :param flags: the send flags.
+        :return: the number of bytes sent.
+        """
+        if sent < len(self.header):
+            return sock.send(memoryview(self.header)[sent:], flags)
+        return sock.send(memoryview(self.data)[sent - len(self.header):], flags)
+
+    def sendall(self, sock):
+        """
+        Sends the whole frame (the socket should be blocking).
+        :param sock: the socket.
+        """
+        sent = 0
+        while sent < len(self):
+            sent += self.send(sock, sent)
+
+
+class FileRegion(ChunkFrame):
+    """
+    This class is a frame whose payload is a range of a file
+    The frame's header is sent from memory and its payload straight from the file - with sendfile if the platform
+    has it, otherwise through a reusable buffer, so no string is built for the chunk
+    """
+    def __init__(self, header, file, offset, length, buffer=None):
+        """
+        The class constructor.
+        :param header: the frame's header bytes.
+        :param file: the file object.
+        :param offset: the offset of the payload in the file.
+        :param length: the size of the payload.
+        :param buffer: a bytearray to read the payload through (may be shared by the regions of a file).
+        """
+        self.header = header
+        self.file = file
+        self.offset = offset
+        self.length = length
+        self.buffer = buffer
+        self.buffered = (0, 0)  # the range of the file in the buffer
+
+    def send(self, sock, sent, flags=0):
+        """
+        Sends the next part of the frame.
+        :param sock: the socket.
+        :param sent: the number of bytes of the frame which were already sent.
+        :param flags: the send flags (ignored by sendfile).
+        :return: the number of bytes sent.
+        """
+        if sent < len(self.header):
+            return sock.send(memoryview(self.header)[sent:], flags)
+        position = self.offset + sent - len(self.header)
+        remaining = self.offset + self.length - position
+        if SENDFILE:
+            return SENDFILE(sock.fileno(), self.file.fileno(), position, remaining)
+        start, end = self.buffered
+        if not start <= position < end:
+            if self.buffer is None:
+                self.buffer = bytearray(DEF_REGION_BUFFER_SIZE)
+            self.file.seek(position)
+            read = self.file.readinto(memoryview(self.buffer)[:min(remaining, len(self.buffer))])
+            if not read:
+                raise IOError('{} was truncated while it was sent'.format(self.file.name))
+            start, end = self.buffered = (position, position + read)
+        return sock.send(memoryview(self.buffer)[position - start:end - start], flags)
+
+
 def create_file(path, data):
     """
     Creates a file in the given path with the given data.
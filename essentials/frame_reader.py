@@ -0,0 +1,121 @@
+"""
+This module contains the FrameReader class, an incremental reader of frames.
+Data is received straight into a reusable buffer (recv_into) and complete frames are handed out
+as memoryview slices of the buffer, so several frames can be parsed from a single read without copying.
+The buffer grows for large frames as their data arrives (doubling up to the frame's size), so a peer which only
+announces a large frame does not make the reader allocate it.
+"""
+import errno
+import socket
+
+DEF_BUFFER_SIZE = 65536
+DEF_MAX_FRAME_SIZE = 16777216  # 16 MiB
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK)
+
+
+class FrameError(Exception):
+    pass
+
+
+class FrameReader(object):
+    """
+    This class reads the frames of a socket
+    It works with both blocking and non-blocking sockets: fill receives whatever is available
+    and frames yields the complete frames received so far
+    """
+    def __init__(self, sock, max_frame_size=DEF_MAX_FRAME_SIZE, buffer_size=DEF_BUFFER_SIZE):
+        """
+        The class constructor.
+        :param sock: a ChatSocket (its codec determines the size of the frames).
+        :param max_frame_size: the size of the largest frame accepted from the peer.
+        :param buffer_size: the initial size of the buffer.
+        """
+        self.sock = sock
+        self.max_frame_size = max_frame_size
+        self.buffer_size = buffer_size
+        self._allocate(buffer_size)
+        self.start = 0  # the beginning of the unparsed data
+        self.end = 0  # the end of the received data
+        self.needed = 0  # the size of the frame which is waiting for more data
+        self.held = False  # whether a complete frame was held back (see frames)
+        self.closed = False
+
+    def __len__(self):
+        return self.end - self.start
+
+    def _allocate(self, size):
+        """
+        Replaces the buffer with a new one, keeping the unparsed data.
+        A new buffer is allocated (rather than resizing the old one) since frames may still reference it.
+        :param size: the size of the new buffer.
+        """
+        buffer = bytearray(size)
+        if hasattr(self, 'buffer'):
+            buffer[:self.end - self.start] = self.view[self.start:self.end]
+            self.end -= self.start
+            self.start = 0
+        self.buffer = buffer
+        self.view = memoryview(buffer)
+
+    def _make_room(self):
+        """
+        Makes sure there is free space after the received data
+        The unparsed data is moved to the beginning of the buffer, and the buffer only grows for large frames - it
+        doubles each time it fills up, until the frame fits
+        """
+        if self.start == self.end:
+            self.start = self.end = 0
+            if len(self.buffer) > self.buffer_size and not self.needed:
+                self._allocate(self.buffer_size)  # a large frame was consumed, give the memory back
+        needed = max(self.needed, len(self) + 1)
+        if self.start + needed <= len(self.buffer) and self.end < len(self.buffer):
+            return
+        if needed > len(self.buffer) and len(self) == len(self.buffer):
+            self._allocate(min(needed, 2 * len(self.buffer)))
+        elif self.start:
+            unparsed = len(self)
+            self.buffer[:unparsed] = self.buffer[self.start:self.end]
+            self.start, self.end = 0, unparsed
+
+    def fill(self):
+        """
+        Receives the available data into the buffer.
+        Blocks only if the socket is blocking.
+        :return: the number of bytes received, 0 if the peer closed the connection,
+        None if the socket is non-blocking and has no data.
+        """
+        self._make_room()
+        try:
+            received = self.sock.recv_into(self.view[self.end:])
+        except socket.error as e:
+            if e.args[0] in WOULD_BLOCK:
+                return None
+            raise
+        if not received:
+            self.closed = True
+        self.end += received
+        return received
+
+    def frames(self, admit=None):
+        """
+        Yields the complete frames received so far.
+        The frames are memoryview slices of the buffer - they are valid until the next fill.
+        :param admit: called with each frame before it is yielded - a frame it refuses stays in the buffer
+        (and the held attribute is set) until the next call.
+        """
+        self.held = False
+        codec = self.sock.codec
+        while len(self) >= codec.header_size:
+            size = codec.frame_size(self.view[self.start:self.start + codec.header_size])
+            if size > self.max_frame_size:
+                raise FrameError('Frame of {} bytes exceeds the maximum of {}'.format(size, self.max_frame_size))
+            if len(self) < size:
+                self.needed = size
+                return
+            frame = self.view[self.start:self.start + size]
+            if admit is not None and not admit(frame):
+                self.held = True
+                return
+            self.start += size
+            self.needed = 0
+            yield frame
@@ -0,0 +1,191 @@
+"""
+This module contains the manifests of resumable file transfers.
+A manifest lists a file's size, the size of its chunks, the hash of the whole file (its content hash) and the hash
+of every chunk - the receiver verifies each chunk it writes, and the hash of the manifest itself is the file's id.
+When a transfer is interrupted the receiver keeps the chunks it verified, and once the same file is sent again
+it reports their ranges (FILE_RESUME) so the sender skips them.
+"""
+import hashlib
+import re
+
+import frame_reader
+import protocols
+
+HASH = hashlib.sha1
+DIGEST_PATTERN = re.compile(r'^[0-9a-f]{40}$')  # a hex digest of HASH
+MANIFEST_SUFFIX = '.manifest'  # the manifests the server keeps next to the files it serves
+MAX_CHUNK_SIZE = frame_reader.DEF_MAX_FRAME_SIZE  # a chunk is sent in a single frame
+MAX_CHUNKS = 1048576  # the chunks of a file (and of the ranges a receiver reports)
+
+
+class Manifest(object):
+    """
+    This class is the manifest of a file
+    """
+    def __init__(self, size, chunk_size, digest, hashes):
+        """
+        The class constructor.
+        :param size: the file's size.
+        :param chunk_size: the size of the file's chunks (the last chunk may be shorter).
+        :param digest: the hex digest of the whole file.
+        :param hashes: the hex digests of the chunks.
+        """
+        self.size = size
+        self.chunk_size = chunk_size
+        self.digest = digest
+        self.hashes = hashes
+        self.file_id = HASH(self.encode()).hexdigest()
+
+    @property
+    def chunk_count(self):
+        return len(self.hashes)
+
+    def chunk_length(self, index):
+        """
+        :param index: a chunk's index.
+        :return: the chunk's size.
+        """
+        return min(self.chunk_size, self.size - index * self.chunk_size)
+
+    def verify(self, index, data):
+        """
+        Checks a received chunk.
+        :param index: the chunk's index.
+        :param data: the chunk's data (a string or a memoryview).
+        :return: True if the chunk matches its hash, False otherwise.
+        """
+        return (index < self.chunk_count and len(data) == self.chunk_length(index) and
+                HASH(data).hexdigest() == self.hashes[index])
+
+    def encode(self):
+        """
+        :return: the manifest as a string (the data of a file start).
+        """
+        return ' '.join([str(self.size), str(self.chunk_size), self.digest] + self.hashes)
+
+    @classmethod
+    def decode(cls, text):
+        """
+        Parses an encoded manifest.
+        :param text: the encoded manifest.
+        :return: a Manifest object.
+        :raises protocols.ProtocolError: if the manifest is malformed.
+        """
+        fields = text.split()
+        try:
+            size, chunk_size, digest, hashes = int(fields[0]), int(fields[1]), fields[2], fields[3:]
+        except (ValueError, IndexError):
+            raise protocols.ProtocolError('Invalid manifest')
+        if size < 0 or not 0 < chunk_size <= MAX_CHUNK_SIZE or len(hashes) > MAX_CHUNKS:
+            raise protocols.ProtocolError('Invalid manifest sizes: {} {}'.format(size, chunk_size))
+        if len(hashes) != (size + chunk_size - 1) // chunk_size:
+            raise protocols.ProtocolError('The manifest lists {} chunks of {} bytes'.format(len(hashes), size))
+        if not all(DIGEST_PATTERN.match(value) for value in [digest] + hashes):
+            raise protocols.ProtocolError('Invalid manifest hashes')
+        return cls(size, chunk_size, digest, hashes)
+
+
+def build(path, chunk_size):
+    """
+    Builds the manifest of a file (reads the whole file).
+    :param path: the path of the file.
+    :param chunk_size: the size of the chunks the file is sent in.
+    :return: a Manifest object.
+    """
+    hashes = list()
+    digest = HASH()
+    size = 0
+    with open(path, 'rb') as file:
+        data = file.read(chunk_size)
+        while data:
+            hashes.append(HASH(data).hexdigest())
+            digest.update(data)
+            size += len(data)
+            data = file.read(chunk_size)
+    return Manifest(size, chunk_size, digest.hexdigest(), hashes)
+
+
+def hash_file(path, buffer_size=1048576):
+    """
+    Calculates the content hash of a file.
+    :param path: the path of the file.
+    :param buffer_size: the size of the reads.
+    :return: the hex digest of the file.
+    """
+    digest = HASH()
+    with open(path, 'rb') as file:
+        data = file.read(buffer_size)
+        while data:
+            digest.update(data)
+            data = file.read(buffer_size)
+    return digest.hexdigest()
+
+
+def load(path):
+    """
+    Loads a manifest the server kept for a file.
+    :param path: the path of the file.
+    :return: a Manifest object, None if there is none (or it cannot be read).
+    """
+    try:
+        with open(path + MANIFEST_SUFFIX, 'rb') as file:
+            return Manifest.decode(file.read())
+    except (IOError, ValueError, IndexError):
+        return None
+
+
+def parse_start(data):
+    """
+    Parses the data of a file start - the file's size, or its manifest.
+    :param data: the file start's data.
+    :return: the file's size (None if it is not known) and its Manifest (None if the transfer is not resumable).
+    :raises protocols.ProtocolError: if the data is malformed.
+    """
+    if ' ' in data:
+        manifest = Manifest.decode(data)
+        return manifest.size, manifest
+    if not data:
+        return None, None
+    try:
+        size = int(data)
+    except ValueError:
+        raise protocols.ProtocolError('Invalid file size: {!r}'.format(data))
+    if size < 0:
+        raise protocols.ProtocolError('Invalid file size: {!r}'.format(data))
+    return size, None
+
+
+def format_ranges(indexes):
+    """
+    Formats a set of chunk indexes as ranges.
+    :param indexes: the chunk indexes.
+    :return: a string of comma separated ranges ('0-4,7,9-12').
+    """
+    ranges = list()
+    for index in sorted(indexes):
+        if ranges and ranges[-1][1] == index - 1:
+            ranges[-1][1] = index
+        else:
+            ranges.append([index, index])
+    return ','.join(str(first) if first == last else '{}-{}'.format(first, last) for first, last in ranges)
+
+
+def parse_ranges(text):
+    """
+    Parses chunk ranges (as formatted by format_ranges).
+    :param text: the ranges string.
+    :return: a set of chunk indexes.
+    :raises protocols.ProtocolError: if the ranges are malformed, or cover more than MAX_CHUNKS chunks.
+    """
+    indexes = set()
+    for part in text.split(','):
+        if part:
+            first, _, last = part.partition('-')
+            try:
+                first, last = int(first), int(last or first)
+            except ValueError:
+                raise protocols.ProtocolError('Invalid chunk range: {!r}'.format(part))
+            if not 0 <= first <= last or len(indexes) + last - first >= MAX_CHUNKS:
+                raise protocols.ProtocolError('Invalid chunk range: {!r}'.format(part))
+            indexes.update(xrange(first, last + 1))
+    return indexes
@@ -2,11 +2,16 @@
 
 
 class Message(object):
-    def __init__(self, header, data):
+    stream = 0  # the transfer stream of the message (only binary version 2 frames carry streams)
+
+    def __init__(self, header, data, stream=0):
         """
         The class constructor.
         :param header: the header of message.
         :param data: the data of the message.
+        :param stream: the id of the transfer stream the message belongs to.
         """
         self.header = header
         self.data = data
+        if stream:
+            self.stream = stream
@@ -10,10 +10,53 @@ REQUEST_FILE = 'req_file'
 FILE_NOT_FOUND = 'file_not_found'
 FILE_CHUNK = 'file_chunk'
 FILE_END = 'file_end'
+FILE_START = 'file_start'  # a flow controlled transfer starts (see transfer.py)
+FILE_CREDIT = 'file_credit'  # the receiver of a transfer grants the sender credits
+FILE_RESUME = 'file_resume'  # the receiver of a resumable transfer already has some of its chunks (see manifests.py)
 
 # clients
 FILE_DL = 'file_dl'
 
+# the protocols whose header names a resource (a file's name)
+RESOURCE_PROTOCOLS = (REQUEST_FILE, FILE_NOT_FOUND, FILE_CHUNK, FILE_END, FILE_DL, FILE_START, FILE_CREDIT, FILE_RESUME)
+
+# the opcodes of the protocols in binary frames
+OPCODES = {REGULAR: 1, END_CONNECTION: 2, REQUEST_FILE: 3, FILE_NOT_FOUND: 4, FILE_CHUNK: 5, FILE_END: 6,
+           FILE_DL: 7, FILE_START: 8, FILE_CREDIT: 9, FILE_RESUME: 10}
+PROTOCOLS_BY_OPCODE = dict((opcode, protocol) for protocol, opcode in OPCODES.iteritems())
+
+
+class ProtocolError(ValueError):
+    """
+    A message which does not follow the protocol (the peer which sent it should be disconnected)
+    """
+    pass
+
+
+def validate_message(msg):
+    """
+    Validates the fields of a received message (they come from the peer).
+    The text of the message is turned into utf-8 encoded strings, like the rest of the server's text (the nicknames),
+    so the two can be mixed.
+    :param msg: a messages.Message object.
+    :raises ProtocolError: if the header is not a header string or a (protocol, resource) tuple of strings, or the data
+    is not a string (or a memoryview, of a file chunk).
+    """
+    header = msg.header
+    if isinstance(header, tuple):
+        if len(header) != 2 or not all(isinstance(part, basestring) for part in header):
+            raise ProtocolError('Invalid header: {!r}'.format(header))
+        msg.header = tuple(part.encode('utf-8') if isinstance(part, unicode) else part for part in header)
+    elif isinstance(header, unicode):
+        msg.header = header.encode('utf-8')
+    elif not isinstance(header, str):
+        raise ProtocolError('Invalid header: {!r}'.format(header))
+    if isinstance(msg.data, unicode):
+        msg.data = msg.data.encode('utf-8')
+    elif not isinstance(msg.data, str) and not (isinstance(msg.data, memoryview) and
+                                                get_protocol(msg.header) == FILE_CHUNK):
+        raise ProtocolError('Invalid data: {!r}'.format(type(msg.data)))
+
 
 def build_header(protocol, resource=None):
     """
@@ -25,12 +68,23 @@ def build_header(protocol, resource=None):
     return ':'.join((protocol, resource or ''))
 
 
+def get_protocol(header):
+    """
+    Gets the protocol of a message.
+    :param header: the message's header (a header string, or a (protocol, resource) tuple).
+    :return: the protocol string.
+    """
+    return header[0] if isinstance(header, tuple) else header.partition(':')[0]
+
+
 class Protocol(object):
     """This class is used to allow client-server communication behind the scenes."""
-    def __init__(self, regular, end_connection, request_file, file_not_found, file_chunk, file_end, file_dl=None):
+    def __init__(self, regular, end_connection, request_file, file_not_found, file_chunk, file_end, file_dl=None,
+                 file_start=None, file_credit=None, file_resume=None):
         """The class constructor."""
         self.protocols = {REGULAR: regular, END_CONNECTION: end_connection, REQUEST_FILE: request_file,
-                          FILE_NOT_FOUND: file_not_found, FILE_CHUNK: file_chunk, FILE_END: file_end, FILE_DL: file_dl}
+                          FILE_NOT_FOUND: file_not_found, FILE_CHUNK: file_chunk, FILE_END: file_end, FILE_DL: file_dl,
+                          FILE_START: file_start, FILE_CREDIT: file_credit, FILE_RESUME: file_resume}
 
     def check_protocol(self, text):
         """Checks whether a string is a protocol message.
@@ -42,14 +96,17 @@ class Protocol(object):
     def initiate_protocol(self, header, **kwargs):
         """
         Parses a protocol msg.
-        :param header: the received message's header.
+        :param header: the received message's header (a header string, or a (protocol, resource) tuple).
         :param kwargs: additional arguments to pass.
+        :raises ProtocolError: if the protocol is unknown, or its resource is missing (or should not be there).
         """
-        components = header.split(':')
+        components = header if isinstance(header, tuple) else header.split(':')
         protocol, data = components[0], filter(None, components[1:])
-        func = self.protocols[protocol]
+        func = self.protocols.get(protocol)
         if not func:
-            print protocol
+            raise ProtocolError('Unexpected protocol: {!r}'.format(protocol))
+        if len(data) != (protocol in RESOURCE_PROTOCOLS):
+            raise ProtocolError('Invalid header: {!r}'.format(header))
         if not data:
             func(**kwargs)
         else:
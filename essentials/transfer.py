@@ -0,0 +1,223 @@
+"""
+This module contains the flow control of file transfers.
+The receiver grants the sender credits, one chunk each: a window of credits when the transfer starts
+and one more credit whenever it has consumed a chunk - its window grows while it has room for more chunks
+(and shrinks while it does not), so a receiver which keeps up does not cap the sender's window.
+The sender never has more chunks in flight than its credits, and limits itself further to a window
+which adapts to the measured round trip time and throughput (like TCP Vegas) - every credit returned
+for a consumed chunk acknowledges the oldest chunk in flight.
+Flow control is used only when both peers negotiated it (wire.CREDIT), other transfers are not limited.
+The transfers of sockets without an outbound queue (the client's) are sent by a shared scheduler, which runs
+a bounded number of transfers on a bounded number of threads and interleaves their chunks.
+"""
+import collections
+import socket
+import threading
+import time
+
+RECEIVE_WINDOW = 8  # the number of credits the receiver grants when a transfer starts
+INITIAL_WINDOW = 2
+MIN_WINDOW = 1
+MAX_WINDOW = 64
+MAX_RECEIVE_WINDOW = MAX_WINDOW  # the receiver's window, beyond which the sender could not use more credits
+# the number of chunks queued in the path (beyond the round trip itself) below which the window grows
+# and above which it shrinks
+VEGAS_ALPHA = 1
+VEGAS_BETA = 3
+DEF_SCHEDULER_THREADS = 2
+DEF_MAX_TRANSFERS = 8  # the number of transfers which are sent at once, the rest wait for their turn
+
+
+class Sender(object):
+    """
+    This class is the flow control state of an outgoing transfer
+    The transfer is driven by an outbound queue or by a scheduler - both poll can_send, and are resumed once
+    credits arrive
+    """
+    def __init__(self, name):
+        """
+        The class constructor.
+        :param name: the file's name.
+        """
+        self.name = name
+        self.credits = 0
+        self.window = INITIAL_WINDOW
+        self.in_flight = collections.deque()  # the send times of the unacknowledged chunks
+        self.min_rtt = None
+        self.skipped = set()  # the indexes of the chunks the receiver already has (of a resumed transfer)
+        self.cancelled = False
+        self.lock = threading.Lock()
+
+    def can_send(self):
+        """
+        Checks whether another chunk may be sent.
+        :return: True if the sender has a credit and room in its window, False otherwise.
+        """
+        return self.credits > 0 and len(self.in_flight) < self.window
+
+    def on_sent(self):
+        """
+        Accounts for a sent chunk.
+        """
+        with self.lock:
+            self.credits -= 1
+            self.in_flight.append(time.time())
+
+    def on_credit(self, count, acknowledged=None):
+        """
+        Adds credits granted by the receiver.
+        :param count: the number of credits.
+        :param acknowledged: the number of chunks the receiver consumed (the oldest chunks in flight), None if it is
+        the number of credits.
+        """
+        now = time.time()
+        acknowledged = count if acknowledged is None else acknowledged
+        with self.lock:
+            self.credits += count
+            for _ in xrange(min(acknowledged, len(self.in_flight))):
+                self._adapt(now - self.in_flight.popleft())
+
+    def _adapt(self, rtt):
+        """
+        Adapts the window to a round trip time sample.
+        The difference between the expected throughput (window / minimal rtt) and the actual throughput
+        (window / rtt) tells how many chunks wait in queues along the way.
+        :param rtt: the time it took to get the credit of a chunk.
+        """
+        rtt = max(rtt, 1e-6)
+        self.min_rtt = rtt if self.min_rtt is None else min(self.min_rtt, rtt)
+        queued = self.window * (1 - self.min_rtt / rtt)
+        if queued < VEGAS_ALPHA:
+            self.window = min(MAX_WINDOW, self.window + 1)
+        elif queued > VEGAS_BETA:
+            self.window = max(MIN_WINDOW, self.window - 1)
+
+    def cancel(self):
+        """
+        Cancels the transfer (it ends the next time it is polled).
+        """
+        self.cancelled = True
+
+
+class Receiver(object):
+    """
+    This class is the flow control state of an incoming transfer
+    The credits the sender holds or used for chunks which were not consumed yet always add up to the window
+    """
+    def __init__(self, window=RECEIVE_WINDOW, max_window=MAX_RECEIVE_WINDOW):
+        """
+        The class constructor.
+        :param window: the receiver's initial window (the credits granted when the transfer starts).
+        :param max_window: the largest window.
+        """
+        self.window = window
+        self.max_window = max_window
+
+    def on_consumed(self, room=True):
+        """
+        Accounts for a consumed chunk - the window grows by a credit while the receiver has room for more chunks,
+        and shrinks by a credit while it does not.
+        :param room: whether the receiver has room for more chunks (like buffer space which is not in use).
+        :return: the number of credits to grant the sender.
+        """
+        if room and self.window < self.max_window:
+            self.window += 1
+            return 2
+        if not room and self.window > MIN_WINDOW:
+            self.window -= 1
+            return 0
+        return 1
+
+
+class Scheduler(object):
+    """
+    This class sends the file transfers of sockets which have no outbound queue
+    The transfers take turns, one frame each, so a large file does not hold back the transfers started after it
+    A transfer which yields None is paused until the scheduler is resumed (like the producers of an outbound queue)
+    At most max_transfers transfers are sent at once, the rest wait in line
+    """
+    def __init__(self, threads=DEF_SCHEDULER_THREADS, max_transfers=DEF_MAX_TRANSFERS):
+        """
+        The class constructor.
+        :param threads: the number of sending threads (started with the first transfer).
+        :param max_transfers: the number of transfers which are sent at once.
+        """
+        self.thread_count = threads
+        self.max_transfers = max_transfers
+        self.threads = list()
+        self.ready = collections.deque()  # (frames, send) tuples of the transfers which take turns
+        self.paused = list()  # transfers which wait to be resumed
+        self.waiting = collections.deque()  # transfers which were not started yet
+        self.started = 0  # the number of started transfers which did not end
+        self.resumes = 0  # counts the resume calls, so a transfer paused during a resume is not forgotten
+        self.condition = threading.Condition()
+
+    def submit(self, frames, send):
+        """
+        Adds a transfer.
+        :param frames: an iterator of the transfer's frames (None whenever it waits).
+        :param send: sends a frame (raises socket.error or IOError if it fails).
+        """
+        with self.condition:
+            if self.started < self.max_transfers:
+                self.started += 1
+                self.ready.append((frames, send))
+                self.condition.notify()
+            else:
+                self.waiting.append((frames, send))
+            if len(self.threads) < self.thread_count:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def resume(self):
+        """
+        Resumes the paused transfers.
+        """
+        with self.condition:
+            self.resumes += 1
+            self.ready.extend(self.paused)
+            del self.paused[:]
+            self.condition.notify_all()
+
+    def _end(self, frames):
+        """
+        Forgets a transfer which ended, and starts the next transfer in line.
+        :param frames: the transfer's frames.
+        """
+        if hasattr(frames, 'close'):
+            frames.close()
+        with self.condition:
+            self.started -= 1
+            if self.waiting:
+                self.started += 1
+                self.ready.append(self.waiting.popleft())
+                self.condition.notify()
+
+    def _work(self):
+        """
+        Sends the frames of the transfers, one frame of each in turn (the body of a sending thread).
+        """
+        while True:
+            with self.condition:
+                while not self.ready:
+                    self.condition.wait()
+                frames, send = self.ready.popleft()
+                resumes = self.resumes
+            try:
+                frame = next(frames)
+                if frame is not None:
+                    send(frame)
+            except (StopIteration, socket.error, IOError, OSError):
+                self._end(frames)
+                continue
+            with self.condition:
+                if frame is not None or self.resumes != resumes:
+                    self.ready.append((frames, send))
+                    self.condition.notify()
+                else:
+                    self.paused.append((frames, send))
+
+
+SCHEDULER = Scheduler()  # shared by the sockets of a process
@@ -0,0 +1,451 @@
+"""
+This module contains the wire codecs, which turn messages into frames and frames back into messages.
+The json codec is the original format: the zero-padded size of the data followed by a jsonpickle'd Message.
+Json frames are decoded as plain json (the frames come from the peer - nothing in them is instantiated or called),
+so only the fields of a Message are taken from them.
+The binary codec is a fixed struct header (version, opcode, flags, resource size, payload size)
+followed by the resource and the payload.
+Version 2 of the binary header adds a stream id, so the frames of several file transfers can be told apart
+(version 1 frames, and json frames, belong to stream 0 - their transfers are told apart by file name only).
+The codec of a connection is negotiated in the handshake, the json codec is the fallback.
+Optional features (such as flow controlled file transfers) are negotiated along with the codec.
+Binary frames may be compressed (the deflate feature): a frame sent to one connection is compressed with the
+connection's streaming context when it is sent, so repeated words compress across messages, while a frame shared by
+many connections (a broadcast, a cached file chunk) is compressed on its own, once.
+"""
+import base64
+import binascii
+import json
+import struct
+import zlib
+
+import jsonpickle as pickle
+
+import messages
+import protocols
+
+MSG_LEN_SIZE = 10  # The size of the length of a message (json codec)
+JSON_HEADER_FIELD = '"header": "'
+JSON_TAIL_SIZE = 512  # the end of a json frame which holds its header (the fields are sorted, the data comes first)
+JSON_BYTES_FIELD = 'py/b64'  # jsonpickle encodes strings which are not utf-8 (file chunks) as {"py/b64": base64}
+
+BINARY_VERSION = 2
+BINARY_HEADERS = {
+    1: struct.Struct('!BBBHI'),  # version, opcode, flags, resource size, payload size
+    2: struct.Struct('!BBBIHI'),  # version, opcode, flags, stream id, resource size, payload size
+}
+FLAG_UNICODE = 1  # the payload is utf-8 encoded unicode
+FLAG_DEFLATE = 2  # the payload is compressed on its own (a complete zlib stream)
+FLAG_STREAM = 4  # the payload is the next part of the connection's zlib stream
+COMPRESSED = FLAG_DEFLATE | FLAG_STREAM
+
+MIN_COMPRESS_SIZE = 64  # smaller payloads are not compressed
+COMPRESS_LEVEL = 6
+COMPRESS_WINDOW_BITS = 12  # the window of the streaming contexts (4 KiB), which are kept for every connection
+COMPRESS_MEM_LEVEL = 5
+COMPRESS_SAMPLE_SIZE = 65536  # the beginning of a file which decides whether the file is compressed
+MAX_COMPRESS_RATIO = 0.9  # a file whose sample does not shrink below this ratio is sent as is (e.g. a zip)
+MAX_INFLATED_SIZE = 16777216  # the largest payload a compressed frame may inflate to
+
+JSON = 'json'
+BINARY = 'bin1'
+BINARY2 = 'bin2'
+HELLO_SEPARATOR = '\0'
+
+# optional features
+CREDIT = 'credit'  # flow controlled file transfers (see transfer.py)
+RESUME = 'resume'  # resumable file transfers, which also have to be flow controlled (see manifests.py)
+DEFLATE = 'deflate'  # compressed frames (binary codecs only)
+FEATURES = (CREDIT, RESUME, DEFLATE)
+
+
+class CodecError(Exception):
+    pass
+
+
+def to_bytes(data):
+    """
+    Copies a slice of a frame into a string.
+    :param data: a string or a memoryview.
+    :return: the data as a string.
+    """
+    return data.tobytes() if isinstance(data, memoryview) else data
+
+
+def build_frame(msg):
+    """
+    Builds a raw frame - the size of a string followed by the string itself.
+    :param msg: a string.
+    :return: the frame's bytes.
+    """
+    return str(len(msg)).zfill(MSG_LEN_SIZE) + msg
+
+
+def create_deflater():
+    """
+    :return: the streaming compression context of a connection's outgoing frames.
+    """
+    return zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, COMPRESS_WINDOW_BITS, COMPRESS_MEM_LEVEL)
+
+
+def create_inflater():
+    """
+    :return: the streaming decompression context of a connection's incoming frames.
+    """
+    return zlib.decompressobj()
+
+
+def compress_payload(data):
+    """
+    Compresses a payload on its own.
+    :param data: the payload (a string).
+    :return: the compressed payload, None if it is not worth compressing.
+    """
+    if len(data) < MIN_COMPRESS_SIZE:
+        return None
+    compressed = zlib.compress(data, COMPRESS_LEVEL)
+    return compressed if len(compressed) < len(data) else None
+
+
+def is_compressible(sample):
+    """
+    Checks whether a file is worth compressing by compressing a sample of it.
+    :param sample: the beginning of the file.
+    :return: True if the sample shrinks enough, False otherwise (the file is likely compressed already).
+    """
+    sample = sample[:COMPRESS_SAMPLE_SIZE]
+    return bool(sample) and len(zlib.compress(sample, 1)) <= len(sample) * MAX_COMPRESS_RATIO
+
+
+def inflate(data, inflater=None):
+    """
+    Decompresses a payload.
+    :param data: the compressed payload.
+    :param inflater: the connection's streaming context, None if the payload was compressed on its own.
+    :return: the payload.
+    """
+    inflater = inflater or zlib.decompressobj()
+    try:
+        data = inflater.decompress(to_bytes(data), MAX_INFLATED_SIZE)
+    except zlib.error as e:
+        raise CodecError('Invalid compressed payload: {}'.format(e))
+    if inflater.unconsumed_tail:
+        raise CodecError('Compressed payload exceeds {} bytes'.format(MAX_INFLATED_SIZE))
+    return data
+
+
+class JsonCodec(object):
+    """
+    The original codec - jsonpickle'd Message objects behind a decimal size
+    """
+    name = JSON
+    header_size = MSG_LEN_SIZE
+    raw_payloads = False  # whether file data can follow a frame's header as is (see encode_header)
+    streams = False  # whether frames carry stream ids
+    compression = False  # whether frames can be compressed
+
+    def __init__(self, any_data=False):
+        """
+        The class constructor.
+        :param any_data: whether the data of a message may be any json value, not only a string (the cluster bus's
+        messages, whose peer is trusted).
+        """
+        self.any_data = any_data
+
+    def encode(self, header, data, stream=0, compress=False):
+        """
+        Encodes a message into a frame.
+        :param header: the message's protocol header.
+        :param data: the message's data.
+        :param stream: ignored - json frames belong to stream 0.
+        :param compress: ignored - json frames are not compressed.
+        :return: the frame's bytes.
+        """
+        return build_frame(pickle.dumps(messages.Message(header, data)))
+
+    def deflate(self, frame, deflater):
+        return frame
+
+    def frame_size(self, prefix):
+        """
+        Calculates the size of a frame from its first header_size bytes.
+        :param prefix: the beginning of the frame (a string or a memoryview).
+        :return: the size of the whole frame.
+        """
+        prefix = to_bytes(prefix[:self.header_size])
+        if not prefix.isdigit():
+            raise CodecError('Invalid frame size: {!r}'.format(prefix))
+        return self.header_size + int(prefix)
+
+    def frame_protocol(self, frame):
+        """
+        Finds the protocol of a frame without decoding it.
+        :param frame: the whole frame (a string or a memoryview).
+        :return: the protocol string, None if it was not found.
+        """
+        tail = to_bytes(frame[-JSON_TAIL_SIZE:])
+        start = tail.rfind(JSON_HEADER_FIELD)  # quotes in the data are escaped, so the last match is the header
+        if start == -1:
+            return None
+        start += len(JSON_HEADER_FIELD)
+        end = tail.find(':', start)
+        return tail[start:end] if end != -1 else None
+
+    def decode(self, frame, inflater=None):
+        """
+        Decodes a frame into a message.
+        :param frame: the whole frame (a string or a memoryview).
+        :param inflater: ignored - json frames are not compressed.
+        :return: a Message object.
+        :raises CodecError: if the frame is not a json message with a string header and string data.
+        """
+        try:
+            fields = json.loads(to_bytes(frame[self.header_size:]))
+        except ValueError as e:
+            raise CodecError('Invalid json frame: {}'.format(e))
+        if not isinstance(fields, dict):
+            raise CodecError('Invalid json message: {!r}'.format(fields)[:200])
+        header, data = fields.get('header'), fields.get('data')
+        if isinstance(data, dict) and data.keys() == [JSON_BYTES_FIELD]:
+            try:
+                data = base64.b64decode(data[JSON_BYTES_FIELD])
+            except (TypeError, ValueError, binascii.Error):
+                raise CodecError('Invalid json bytes: {!r}'.format(data)[:200])
+        if not isinstance(header, basestring) or not (self.any_data or isinstance(data, basestring)):
+            raise CodecError('Invalid json message: {!r}'.format(fields)[:200])
+        return messages.Message(header, data)
+
+
+class BinaryCodec(object):
+    """
+    The binary codec - a struct header with an integer opcode followed by the raw resource and payload
+    Decoded messages carry their header as a (protocol, resource) tuple, so it does not have to be split
+    File chunks are not copied: they are encoded without their payload (which is sent straight from the file)
+    and decoded into memoryview slices of the read buffer (unless they were compressed)
+    """
+    raw_payloads = True
+    compression = True
+
+    def __init__(self, version=BINARY_VERSION):
+        """
+        The class constructor.
+        :param version: the version of the frame header (see BINARY_HEADERS).
+        """
+        self.version = version
+        self.name = 'bin{}'.format(version)
+        self.header = BINARY_HEADERS[version]
+        self.header_size = self.header.size
+        self.streams = version >= 2
+
+    def encode(self, header, data, stream=0, compress=False):
+        """
+        Encodes a message into a frame.
+        :param header: the message's protocol header (as built by protocols.build_header).
+        :param data: the message's data (a string).
+        :param stream: the id of the transfer stream the message belongs to (0 for other messages).
+        :param compress: whether to compress the data on its own (if it is worth it).
+        :return: the frame's bytes.
+        """
+        flags = 0
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+            flags |= FLAG_UNICODE
+        compressed = compress and compress_payload(data)
+        if compressed:
+            data = compressed
+            flags |= FLAG_DEFLATE
+        return self.encode_header(header, len(data), flags, stream) + data
+
+    def deflate(self, frame, deflater):
+        """
+        Compresses an encoded frame with a connection's streaming context.
+        The frames have to be compressed in the order they are sent - the peer decompresses them in that order.
+        :param frame: the frame's bytes.
+        :param deflater: the connection's streaming context (see create_deflater).
+        :return: the compressed frame, the frame itself if it is too small or compressed already.
+        """
+        opcode, flags, stream, resource_size, payload_size = self._unpack(frame)
+        if payload_size < MIN_COMPRESS_SIZE or flags & COMPRESSED:
+            return frame
+        start = self.header_size + resource_size
+        data = deflater.compress(frame[start:]) + deflater.flush(zlib.Z_SYNC_FLUSH)
+        if self.streams:
+            fields = self.header.pack(self.version, opcode, flags | FLAG_STREAM, stream, resource_size, len(data))
+        else:
+            fields = self.header.pack(self.version, opcode, flags | FLAG_STREAM, resource_size, len(data))
+        return fields + frame[self.header_size:start] + data
+
+    def encode_header(self, header, size, flags=0, stream=0):
+        """
+        Encodes the beginning of a frame - everything but the payload.
+        :param header: the message's protocol header (as built by protocols.build_header).
+        :param size: the size of the payload (bytes).
+        :param flags: the frame's flags.
+        :param stream: the id of the transfer stream the message belongs to (dropped by version 1 headers).
+        :return: the bytes which precede the payload.
+        """
+        protocol, _, resource = header.partition(':')
+        if isinstance(resource, unicode):
+            resource = resource.encode('utf-8')
+        opcode = protocols.OPCODES[protocol]
+        if self.streams:
+            fields = self.header.pack(self.version, opcode, flags, stream, len(resource), size)
+        else:
+            fields = self.header.pack(self.version, opcode, flags, len(resource), size)
+        return fields + resource
+
+    def _unpack(self, prefix):
+        """
+        Unpacks a frame header.
+        :param prefix: the beginning of the frame (a string or a memoryview).
+        :return: the opcode, the flags, the stream id, the resource size and the payload size.
+        """
+        fields = self.header.unpack_from(prefix)
+        if fields[0] != self.version:
+            raise CodecError('Unsupported frame version: {}'.format(fields[0]))
+        if self.streams:
+            return fields[1:]
+        opcode, flags, resource_size, payload_size = fields[1:]
+        return opcode, flags, 0, resource_size, payload_size
+
+    def frame_size(self, prefix):
+        """
+        Calculates the size of a frame from its first header_size bytes.
+        :param prefix: the beginning of the frame (a string or a memoryview).
+        :return: the size of the whole frame.
+        """
+        opcode, flags, stream, resource_size, payload_size = self._unpack(prefix)
+        return self.header_size + resource_size + payload_size
+
+    def frame_protocol(self, frame):
+        """
+        Finds the protocol of a frame without decoding it.
+        :param frame: the whole frame (a string or a memoryview).
+        :return: the protocol string, None if the opcode is unknown.
+        """
+        return protocols.PROTOCOLS_BY_OPCODE.get(self._unpack(frame)[0])
+
+    def decode(self, frame, inflater=None):
+        """
+        Decodes a frame into a message.
+        The data of a file chunk is a slice of the frame - it is valid as long as the frame is.
+        :param frame: the whole frame (a string or a memoryview).
+        :param inflater: the connection's streaming decompression context, None if the connection is not compressed.
+        :return: a Message object.
+        """
+        opcode, flags, stream, resource_size, payload_size = self._unpack(frame)
+        protocol = protocols.PROTOCOLS_BY_OPCODE.get(opcode)
+        if protocol is None:
+            raise CodecError('Unknown opcode: {}'.format(opcode))
+        start = self.header_size + resource_size
+        resource = to_bytes(frame[self.header_size:start])
+        data = frame[start:start + payload_size]
+        if flags & FLAG_STREAM:
+            if inflater is None:
+                raise CodecError('Compressed frame on an uncompressed connection')
+            data = inflate(data, inflater)
+        elif flags & FLAG_DEFLATE:
+            data = inflate(data)
+        elif protocol != protocols.FILE_CHUNK:
+            data = to_bytes(data)
+        if flags & FLAG_UNICODE:
+            data = data.decode('utf-8')
+        return messages.Message((protocol, resource), data, stream)
+
+
+CODECS = {JSON: JsonCodec(), BINARY: BinaryCodec(1), BINARY2: BinaryCodec(2)}
+PREFERRED_CODECS = (BINARY2, BINARY, JSON)  # offered by clients in this order
+OFFERS = PREFERRED_CODECS + FEATURES
+
+
+class SharedMessage(object):
+    """
+    This class is a message sent to many sockets (a broadcast)
+    It is encoded (and compressed) at most once per codec and the same frame is handed to every socket
+    """
+    def __init__(self, header, data):
+        """
+        The class constructor.
+        :param header: the message's protocol header.
+        :param data: the message's data.
+        """
+        self.header = header
+        self.data = data
+        self.frames = dict()
+
+    def frame(self, codec, compress=False):
+        """
+        Gets the frame of the message for a codec.
+        :param codec: a codec object.
+        :param compress: whether the frame may be compressed.
+        :return: the frame's bytes.
+        """
+        key = (codec.name, compress)
+        frame = self.frames.get(key)
+        if frame is None:
+            frame = self.frames[key] = codec.encode(self.header, self.data, compress=compress)
+        return frame
+
+
+def build_hello(nick, offers=OFFERS):
+    """
+    Builds the handshake string a client sends when it connects.
+    :param nick: the client's nickname.
+    :param offers: the codec names the client supports (preferred first) and the features it supports.
+    :return: the hello string.
+    """
+    return HELLO_SEPARATOR.join((nick, ' '.join(offers)))
+
+
+def parse_hello(hello):
+    """
+    Parses a client's handshake string.
+    Clients which do not negotiate send only their nickname.
+    :param hello: the hello string.
+    :return: the nickname and the list of offered codec and feature names (None if the client does not negotiate).
+    """
+    nick, separator, offers = hello.partition(HELLO_SEPARATOR)
+    return nick, offers.split() if separator else None
+
+
+def choose_codec(offers):
+    """
+    Chooses the codec of a connection.
+    :param offers: the codec names offered by the client (None if it does not negotiate).
+    :return: a codec object.
+    """
+    for name in offers or ():
+        if name in CODECS:
+            return CODECS[name]
+    return CODECS[JSON]
+
+
+def choose_features(offers, codec=CODECS[JSON]):
+    """
+    Chooses the optional features of a connection.
+    :param offers: the names offered by the client (None if it does not negotiate).
+    :param codec: the chosen codec object (compression needs a binary codec).
+    :return: a list of feature names.
+    """
+    return [name for name in offers or () if name in FEATURES and (name != DEFLATE or codec.compression)]
+
+
+def build_reply(codec, features):
+    """
+    Builds the server's answer to a hello.
+    :param codec: the chosen codec object.
+    :param features: the chosen feature names.
+    :return: the reply string.
+    """
+    return ' '.join([codec.name] + list(features))
+
+
+def parse_reply(reply):
+    """
+    Parses the server's answer to a hello.
+    :param reply: the reply string.
+    :return: the codec object and the set of feature names.
+    """
+    names = reply.split() or [JSON]
+    codec = CODECS.get(names[0], CODECS[JSON])
+    return codec, set(choose_features(names[1:], codec))
@@ -0,0 +1,147 @@
+"""
+This module is used by the server
+It contains the admission control: the limits on the number of connections (in total, per address and of handshakes
+in progress), and the token buckets which limit the messages and bytes each user sends
+A user who runs out of tokens is not read until the tokens refill - the frames wait undecoded in the socket's buffers,
+so a flood costs the server almost nothing
+The chunks of the uploads the server accepted are limited by their flow control instead, as long as they were
+credited (and so are the credits of the downloads the server sends, one per chunk it sent) - any other transfer frame
+takes tokens
+A frame larger than the bucket is admitted once the bucket is full, and its full size is taken - the bucket goes into
+debt, so large frames do not get past the byte rate
+"""
+import time
+
+from essentials import frame_reader, protocols
+
+DEF_MAX_USERS = 5
+DEF_MAX_PENDING = 16  # connections which have not finished the handshake (accepting pauses beyond them)
+DEF_MAX_PER_ADDRESS = 8  # connections from one IP address
+DEF_BACKLOG = 16  # the listen backlog - the kernel refuses connections beyond it while accepting is paused
+DEF_MESSAGE_RATE = 20  # messages per second
+DEF_MESSAGE_BURST = 40
+DEF_BYTE_RATE = 65536  # bytes per second
+DEF_BYTE_BURST = 262144
+DEF_MAX_FRAME_SIZE = frame_reader.DEF_MAX_FRAME_SIZE  # larger frames disconnect their senders
+DEF_MAX_UPLOAD_SIZE = 1073741824  # 1 GiB
+
+
+class Limits(object):
+    """
+    This class holds the server's admission limits
+    """
+    def __init__(self, max_users=DEF_MAX_USERS, max_pending=DEF_MAX_PENDING, max_per_address=DEF_MAX_PER_ADDRESS,
+                 backlog=DEF_BACKLOG, message_rate=DEF_MESSAGE_RATE, message_burst=DEF_MESSAGE_BURST,
+                 byte_rate=DEF_BYTE_RATE, byte_burst=DEF_BYTE_BURST, max_frame_size=DEF_MAX_FRAME_SIZE,
+                 max_upload_size=DEF_MAX_UPLOAD_SIZE):
+        """
+        The class constructor
+        :param max_users: the number of users, connections beyond it are rejected after their handshake
+        :param max_pending: the number of connections in the handshake, no more are accepted until they finish
+        :param max_per_address: the number of connections from one IP address, more are closed once accepted
+        :param backlog: the size of the listening socket's backlog
+        :param message_rate: the messages a user may send per second
+        :param message_burst: the messages a user may send at once
+        :param byte_rate: the bytes of messages a user may send per second
+        :param byte_burst: the bytes of messages a user may send at once
+        :param max_frame_size: the size of the largest frame a connection may send
+        :param max_upload_size: the size of the largest file a user may upload
+        """
+        self.max_users = max_users
+        self.max_pending = max_pending
+        self.max_per_address = max_per_address
+        self.backlog = backlog
+        self.message_rate = message_rate
+        self.message_burst = message_burst
+        self.byte_rate = byte_rate
+        self.byte_burst = byte_burst
+        self.max_frame_size = max_frame_size
+        self.max_upload_size = max_upload_size
+
+
+class TokenBucket(object):
+    """
+    This class is a token bucket - tokens refill at a fixed rate up to the bucket's size
+    """
+    def __init__(self, rate, burst):
+        """
+        The class constructor
+        :param rate: the tokens added per second
+        :param burst: the size of the bucket (it starts full)
+        """
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.time()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self, amount, now):
+        """
+        :param amount: a number of tokens (at most the bucket's size is needed, the rest is taken as debt)
+        :param now: the current time
+        :return: True if the bucket has the tokens, False otherwise
+        """
+        self._refill(now)
+        return self.tokens >= min(amount, self.burst)
+
+    def take(self, amount):
+        """
+        :param amount: a number of tokens - all of them are taken, the bucket may go into debt
+        """
+        self.tokens -= amount
+
+    def delay(self, amount):
+        """
+        :param amount: a number of tokens
+        :return: the seconds until the bucket has the tokens
+        """
+        return max(0.0, (min(amount, self.burst) - self.tokens) / self.rate)
+
+
+class RateLimiter(object):
+    """
+    This class limits the messages and bytes a user sends
+    It decides on frames before they are decoded (see ChatSocket.read_messages)
+    """
+    def __init__(self, client, limits):
+        """
+        The class constructor
+        :param client: the user's socket (its codec tells the protocols of frames, and it tracks the credits)
+        :param limits: the server's Limits object
+        """
+        self.client = client
+        self.messages = TokenBucket(limits.message_rate, limits.message_burst)
+        self.bytes = TokenBucket(limits.byte_rate, limits.byte_burst)
+        self.held = 0  # the size of the frame which waits for tokens, 0 if none does
+        self.throttled = 0  # the number of times the user ran out of tokens
+
+    def admit(self, frame):
+        """
+        Takes the tokens of a received frame
+        :param frame: the frame (a string or a memoryview)
+        :return: True if the frame may be handled, False if it has to wait for tokens
+        """
+        protocol = self.client.codec.frame_protocol(frame)
+        if protocol == protocols.FILE_CHUNK and self.client.take_credit():
+            return True  # the chunk of an accepted upload, limited by the credits it was granted
+        if protocol == protocols.FILE_CREDIT and self.client.take_acknowledgement():
+            return True  # the credits of a download, one frame per chunk the server sent
+        now = time.time()
+        if not (self.messages.available(1, now) and self.bytes.available(len(frame), now)):
+            if not self.held:
+                self.throttled += 1
+            self.held = len(frame)
+            return False
+        self.held = 0
+        self.messages.take(1)
+        self.bytes.take(len(frame))
+        return True
+
+    def delay(self):
+        """
+        :return: the seconds until the held frame may be handled
+        """
+        return max(self.messages.delay(1), self.bytes.delay(self.held))
@@ -0,0 +1,415 @@
+"""
+This module is used by the server
+It contains the chat log: an append-only log of the chat messages and the whispers, kept in segment files
+The event loop only queues the records - they are appended in batches on a writer thread (see Server.log_message)
+Every server start begins a new segment, and a segment is sealed once it is full - sealed segments never change
+The segments are memory mapped for reads, and each one has a sparse index: the time and offset of the first record
+of every block (INDEX_INTERVAL records) and the blocks each sender and each room wrote in - so the scrollback queries
+read only the blocks they need rather than the whole log
+Broadcasts are logged with their room, and the queries return the messages of the reader's room (and their whispers)
+Every record has a sequential id, by which the search index (see search.py) refers to it
+The oldest segments are deleted beyond the retention limit, and small sealed segments (left by restarts) are merged
+"""
+import bisect
+import collections
+import mmap
+import os
+import struct
+import threading
+import time
+
+LOG_DIR = 'log'
+SEGMENT_SUFFIX = '.seg'
+TEMP_SUFFIX = '.tmp'
+DEF_SEGMENT_SIZE = 4194304  # 4 MiB
+DEF_MAX_SEGMENTS = 16
+DEF_FLUSH_INTERVAL = 0.5  # the seconds records wait to be written together
+DEF_FLUSH_BATCH = 256  # the number of waiting records which are written right away
+INDEX_INTERVAL = 64  # the records of an index block
+BROADCAST = 0
+WHISPER = 1
+ROOM_FLAG = 0x80  # set in the kind of a record which has a room (its size follows the header, it precedes the text)
+RECORD_HEADER = struct.Struct('!QdBHHI')  # id, time, kind, sender size, target size, text size
+ROOM_HEADER = struct.Struct('!H')  # room size
+
+# the room is '' for whispers, and for the broadcasts logged before there were rooms
+Record = collections.namedtuple('Record', 'id time kind sender target text room')
+
+
+def _to_utf8(text):
+    return text.encode('utf-8') if isinstance(text, unicode) else text
+
+
+def encode_record(record):
+    """
+    :param record: a Record object
+    :return: the record's bytes
+    """
+    sender, target, text, room = (_to_utf8(record.sender), _to_utf8(record.target), _to_utf8(record.text),
+                                  _to_utf8(record.room))
+    if not room:
+        return (RECORD_HEADER.pack(record.id, record.time, record.kind, len(sender), len(target), len(text)) +
+                sender + target + text)
+    return (RECORD_HEADER.pack(record.id, record.time, record.kind | ROOM_FLAG, len(sender), len(target), len(text)) +
+            ROOM_HEADER.pack(len(room)) + sender + target + room + text)
+
+
+def decode_records(view, start, end):
+    """
+    Decodes the records of a part of a segment
+    :param view: the segment's bytes (a memory map)
+    :param start: the offset of the first record
+    :param end: the offset after the last record
+    :return: a generator of (offset, end, Record) tuples - a record which ends after the part (torn) is not decoded
+    """
+    offset = start
+    while offset + RECORD_HEADER.size <= end:
+        record_id, when, kind, sender_size, target_size, text_size = RECORD_HEADER.unpack_from(view, offset)
+        sender_start = offset + RECORD_HEADER.size
+        room_size = 0
+        if kind & ROOM_FLAG:
+            if sender_start + ROOM_HEADER.size > end:
+                return
+            room_size, = ROOM_HEADER.unpack_from(view, sender_start)
+            sender_start += ROOM_HEADER.size
+        target_start = sender_start + sender_size
+        room_start = target_start + target_size
+        text_start = room_start + room_size
+        text_end = text_start + text_size
+        if text_end > end:
+            return
+        sender = view[sender_start:target_start].decode('utf-8', 'replace')
+        target = view[target_start:room_start].decode('utf-8', 'replace')
+        room = view[room_start:text_start].decode('utf-8', 'replace')
+        yield offset, text_end, Record(record_id, when, kind & ~ROOM_FLAG, sender, target,
+                                       view[text_start:text_end].decode('utf-8', 'replace'), room)
+        offset = text_end
+
+
+def is_visible(record, viewer, room):
+    """
+    :param record: a Record object
+    :param viewer: the nickname of the user who reads the log
+    :param room: the room of the user who reads the log
+    :return: True if the user may read the record (whispers are read by their sender and target only, broadcasts in
+    their room only - the broadcasts logged before there were rooms are read in every room)
+    """
+    if record.kind == WHISPER:
+        return viewer in (record.sender, record.target)
+    return record.room in (room, '')
+
+
+class Segment(object):
+    """
+    This class is a segment file of the chat log, with its sparse index
+    """
+    def __init__(self, path):
+        """
+        The class constructor
+        The segment is scanned to build its index, and a torn record at its end (a crash) is cut off
+        :param path: the segment's path
+        """
+        self.path = path
+        self.size = 0  # the bytes of the complete records
+        self.count = 0
+        self.first_time = self.last_time = None
+        self.last_id = None
+        self.blocks = list()  # the offsets of the blocks' first records
+        self.times = list()  # the times of the blocks' first records (for bisect)
+        self.ids = list()  # the ids of the blocks' first records (for bisect)
+        self.senders = dict()  # the indexes of the blocks each sender wrote in, by nicknames
+        self.rooms = dict()  # the indexes of the blocks of each room's records, by room names ('' for the others)
+        self._map = None
+        self._mapped_size = 0
+        view = self.view()
+        if view is not None:
+            for offset, end, record in decode_records(view, 0, len(view)):
+                self.index(offset, record, end)
+            if self.size < len(view):
+                self.close()
+                with open(path, 'r+b') as torn:
+                    torn.truncate(self.size)
+
+    def index(self, offset, record, end):
+        """
+        Adds an appended record to the index
+        :param offset: the record's offset
+        :param record: the Record object
+        :param end: the offset after the record
+        """
+        if self.count % INDEX_INTERVAL == 0:
+            self.blocks.append(offset)
+            self.times.append(record.time)
+            self.ids.append(record.id)
+        block = len(self.blocks) - 1
+        for written in (self.senders.setdefault(record.sender, []), self.rooms.setdefault(record.room, [])):
+            if not written or written[-1] != block:
+                written.append(block)
+        if self.first_time is None:
+            self.first_time = record.time
+        self.last_time = record.time
+        self.last_id = record.id
+        self.count += 1
+        self.size = end
+
+    def view(self):
+        """
+        Maps the segment's file (again if it grew since it was mapped)
+        :return: the memory map, None if the file is empty
+        """
+        size = os.path.getsize(self.path)
+        if self._map is None or self._mapped_size != size:
+            self.close()
+            if not size:
+                return None
+            with open(self.path, 'rb') as segment:
+                self._map = mmap.mmap(segment.fileno(), size, access=mmap.ACCESS_READ)
+            self._mapped_size = size
+        return self._map
+
+    def block_range(self, block):
+        """
+        :param block: a block's index
+        :return: the offsets of the block's first record and of the end of its last record
+        """
+        end = self.blocks[block + 1] if block + 1 < len(self.blocks) else self.size
+        return self.blocks[block], end
+
+    def read_block(self, block):
+        """
+        :param block: a block's index
+        :return: the block's records
+        """
+        start, end = self.block_range(block)
+        return [record for _, _, record in decode_records(self.view(), start, end)]
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+            self._mapped_size = 0
+
+
+class ChatLog(object):
+    """
+    This class is the chat log
+    Records are queued on the event loop (append, take) and written on a writer thread (write),
+    while the queries run on the command threads - the segments are guarded by a lock
+    """
+    def __init__(self, directory=LOG_DIR, segment_size=DEF_SEGMENT_SIZE, max_segments=DEF_MAX_SEGMENTS):
+        """
+        The class constructor
+        :param directory: the directory of the segments
+        :param segment_size: the size at which a segment is sealed
+        :param max_segments: the number of segments kept (the oldest are deleted)
+        """
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.lock = threading.Lock()
+        self.pending = list()  # the records waiting to be written
+        self.segments = [Segment(os.path.join(directory, name)) for name in sorted(os.listdir(directory))
+                         if name.endswith(SEGMENT_SUFFIX)]
+        self.active = None  # the file of the last segment, opened by the first write
+        self.compact()
+        last_ids = [segment.last_id for segment in self.segments if segment.last_id is not None]
+        self.next_id = last_ids[-1] + 1 if last_ids else 0  # the id of the next record
+
+    def _segment_path(self, number):
+        return os.path.join(self.directory, '{:08d}{}'.format(number, SEGMENT_SUFFIX))
+
+    def append(self, kind, sender, target, text, room=''):
+        """
+        Queues a record (on the event loop)
+        :param kind: BROADCAST or WHISPER
+        :param sender: the nickname of the sender ('' for the server's announcements)
+        :param target: the nickname of the whisper's target ('' for broadcasts)
+        :param text: the message
+        :param room: the room of a broadcast ('' for whispers)
+        :return: the number of records waiting to be written
+        """
+        self.pending.append(Record(self.next_id, time.time(), kind, sender, target, text, room))
+        self.next_id += 1
+        return len(self.pending)
+
+    def take(self):
+        """
+        :return: the records waiting to be written (they are handed over to write)
+        """
+        records, self.pending = self.pending, list()
+        return records
+
+    def write(self, records):
+        """
+        Appends records to the log (on a writer thread) - a segment is sealed once it is full
+        :param records: Record objects
+        """
+        with self.lock:
+            batch = list()
+            size = self.segments[-1].size if self.active is not None else 0  # the active segment's size with the batch
+            for record in records:
+                data = encode_record(record)
+                if self.active is None or size + len(data) > self.segment_size:
+                    self._write_batch(batch)
+                    batch = list()
+                    self._roll()
+                    size = 0
+                batch.append((record, data))
+                size += len(data)
+            self._write_batch(batch)
+
+    def _write_batch(self, batch):
+        """
+        Writes records to the active segment with one write, and indexes them
+        :param batch: (Record, bytes) tuples
+        """
+        if not batch:
+            return
+        self.active.write(''.join(data for _, data in batch))
+        self.active.flush()
+        segment = self.segments[-1]
+        for record, data in batch:
+            segment.index(segment.size, record, segment.size + len(data))
+
+    def _roll(self):
+        """
+        Starts a new segment (the active one is sealed), and compacts the sealed segments
+        """
+        if self.active is not None:
+            self.active.close()
+        number = int(os.path.basename(self.segments[-1].path)[:-len(SEGMENT_SUFFIX)]) + 1 if self.segments else 0
+        path = self._segment_path(number)
+        self.active = open(path, 'ab')
+        self.segments.append(Segment(path))
+        self.compact()
+
+    def compact(self):
+        """
+        Merges adjacent sealed segments which fit in one segment, and deletes the oldest segments beyond the limit
+        """
+        sealed = len(self.segments) - 1 if self.active is not None else len(self.segments)
+        i = 0
+        while i + 1 < sealed:
+            first, second = self.segments[i], self.segments[i + 1]
+            if first.size + second.size > self.segment_size:
+                i += 1
+                continue
+            first.close()
+            second.close()
+            temp_path = first.path + TEMP_SUFFIX
+            with open(temp_path, 'wb') as merged:
+                for segment in (first, second):
+                    with open(segment.path, 'rb') as part:
+                        merged.write(part.read(segment.size))
+            if os.name == 'nt':
+                os.remove(first.path)
+            os.rename(temp_path, first.path)
+            os.remove(second.path)
+            self.segments[i:i + 2] = [Segment(first.path)]
+            sealed -= 1
+        while len(self.segments) > self.max_segments:
+            oldest = self.segments.pop(0)
+            oldest.close()
+            os.remove(oldest.path)
+
+    def tail(self, count, viewer, room, sender=None):
+        """
+        Gets the last records of the log (only the blocks of the sender, or of the room, are read)
+        :param count: the number of records
+        :param viewer: the nickname of the user who reads the log
+        :param room: the room of the user who reads the log
+        :param sender: the nickname of the sender of the records, None for all the senders
+        :return: the Record objects, oldest first
+        """
+        found = list()
+        with self.lock:
+            for segment in reversed(self.segments):
+                if sender is not None:
+                    blocks = segment.senders.get(sender, [])
+                else:
+                    blocks = sorted(set(segment.rooms.get(room, [])).union(segment.rooms.get('', [])))
+                for block in reversed(blocks):
+                    records = [record for record in segment.read_block(block) if is_visible(record, viewer, room) and
+                               (sender is None or record.sender == sender)]
+                    found.extend(reversed(records))
+                    if len(found) >= count:
+                        return found[count - 1::-1]
+        return found[::-1]
+
+    def since(self, when, viewer, room, limit):
+        """
+        Gets the first records of the log since a time
+        :param when: the time (seconds since the epoch)
+        :param viewer: the nickname of the user who reads the log
+        :param room: the room of the user who reads the log
+        :param limit: the maximum number of records
+        :return: the Record objects, oldest first
+        """
+        found = list()
+        with self.lock:
+            for segment in self.segments:
+                if segment.last_time is None or segment.last_time < when:
+                    continue
+                first = max(0, bisect.bisect_right(segment.times, when) - 1)
+                for block in xrange(first, len(segment.blocks)):
+                    for record in segment.read_block(block):
+                        if record.time >= when and is_visible(record, viewer, room):
+                            found.append(record)
+                            if len(found) >= limit:
+                                return found
+        return found
+
+    def first_id(self):
+        """
+        :return: the id of the oldest record kept, None if the log is empty
+        """
+        with self.lock:
+            for segment in self.segments:
+                if segment.ids:
+                    return segment.ids[0]
+        return None
+
+    def get(self, ids):
+        """
+        Gets records by their ids (the records of deleted segments are skipped)
+        :param ids: record ids
+        :return: the Record objects, in the order of the ids
+        """
+        found = dict()
+        with self.lock:
+            read = set()  # the (segment, block) pairs which were read
+            for record_id in ids:
+                for segment in self.segments:
+                    if segment.ids and segment.ids[0] <= record_id <= segment.last_id:
+                        block = bisect.bisect_right(segment.ids, record_id) - 1
+                        if (segment.path, block) not in read:
+                            read.add((segment.path, block))
+                            found.update((record.id, record) for record in segment.read_block(block))
+                        break
+        return [found[record_id] for record_id in ids if record_id in found]
+
+    def records_after(self, record_id):
+        """
+        Reads the records written after a record
+        :param record_id: a record id, None for all the records
+        :return: the Record objects, oldest first
+        """
+        found = list()
+        with self.lock:
+            for segment in self.segments:
+                if segment.last_id is None or (record_id is not None and segment.last_id <= record_id):
+                    continue
+                first = max(0, bisect.bisect_right(segment.ids, record_id) - 1) if record_id is not None else 0
+                for block in xrange(first, len(segment.blocks)):
+                    found.extend(record for record in segment.read_block(block)
+                                 if record_id is None or record.id > record_id)
+        return found
+
+    def close(self):
+        with self.lock:
+            if self.active is not None:
+                self.active.close()
+            for segment in self.segments:
+                segment.close()
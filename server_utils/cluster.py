@@ -0,0 +1,304 @@
+"""
+This module is used by the server
+It contains the multi-process mode: a supervisor forks worker servers which share the listening socket
+The workers are linked to the supervisor by unix sockets (the bus) - the supervisor relays broadcasts,
+routes messages and kicks to the worker which holds the user, and keeps the nicknames globally unique
+"""
+import itertools
+import os
+import socket
+
+from essentials import chatsocket, frame_reader, protocols, wire
+from server_utils import event_loop, outbound
+
+# bus operations
+CLAIM = 'claim'  # worker -> supervisor: reserve a nickname
+CLAIMED = 'claimed'  # supervisor -> worker: the answer to a claim
+JOIN = 'join'  # a user connected to a worker
+LEAVE = 'leave'  # a user disconnected from a worker (releases the nickname)
+UPDATE = 'update'  # a user's display name or status changed
+BROADCAST = 'broadcast'  # a message to the members of a room, on all the workers
+DELIVER = 'deliver'  # a message to a single user on another worker
+KICK = 'kick'  # disconnect a user on another worker
+
+
+def create_link(sock, on_interest, on_failure):
+    """
+    Wraps one end of a bus socket pair
+    :param sock: a unix socket
+    :param on_interest: the outbound queue's write interest callback
+    :param on_failure: the outbound queue's failure callback
+    :return: a non-blocking ChatSocket with an outbound queue
+    """
+    link = chatsocket.ChatSocket(_sock=sock)
+    link.codec = wire.JsonCodec(any_data=True)  # the bus's messages carry dictionaries
+    link.setblocking(False)
+    link.outbound = outbound.OutboundQueue(link, outbound.MemoryBudget(), on_interest, on_failure,
+                                           high_watermark=outbound.DEF_MEMORY_CAP)
+    return link
+
+
+def user_info(user):
+    """
+    Describes a user for the other workers
+    :param user: a User object
+    :return: a dictionary of the user's public state
+    """
+    return {'nickname': user.nickname, 'display_name': user.display_name, 'is_admin': user.is_admin,
+            'room': user.room}
+
+
+class RemoteClient(object):
+    """
+    This class stands in for the socket of a user on another worker
+    Messages sent to it are delivered through the bus
+    """
+    def __init__(self, bus, nickname):
+        """
+        The class constructor
+        :param bus: the worker's Bus object
+        :param nickname: the nickname of the remote user
+        """
+        self.bus = bus
+        self.nickname = nickname
+
+    def send_msg(self, header, data, droppable=False):
+        self.bus.publish(DELIVER, {'nickname': self.nickname, 'header': header, 'data': data,
+                                   'droppable': droppable})
+
+    def send_regular_msg(self, data):
+        self.send_msg(protocols.build_header(protocols.REGULAR), data, droppable=True)
+
+
+class RemoteUser(object):
+    """
+    This class is a user connected to another worker
+    """
+    def __init__(self, bus, info):
+        """
+        The class constructor
+        :param bus: the worker's Bus object
+        :param info: the user's state as built by user_info
+        """
+        self.nickname = info['nickname']
+        self.client = RemoteClient(bus, self.nickname)
+        self.update(info)
+        self.connected = True
+
+    def update(self, info):
+        self.display_name = info['display_name']
+        self.is_admin = info['is_admin']
+        self.room = info['room']
+
+
+class Bus(object):
+    """
+    This class is the worker's end of the bus
+    It is registered in the server's event loop like any other socket
+    """
+    def __init__(self, sock, server):
+        """
+        The class constructor
+        :param sock: the worker's end of the bus socket pair
+        :param server: the worker's Server object
+        """
+        self.server = server
+        self.link = create_link(sock, server.set_write_interest, self.link_failed)
+        self.remote_users = dict()  # users of the other workers by their nicknames
+        self.claims = dict()  # claim callbacks by reference
+        self.references = itertools.count()
+        self.handlers = {CLAIMED: self.on_claimed, JOIN: self.on_join, LEAVE: self.on_leave, UPDATE: self.on_update,
+                         BROADCAST: self.on_broadcast, DELIVER: self.on_deliver, KICK: self.on_kick}
+
+    def publish(self, operation, data):
+        """
+        Sends an operation to the supervisor
+        :param operation: the bus operation
+        :param data: the operation's data
+        """
+        self.link.send_msg(operation, data)
+
+    def claim(self, nickname, callback, *args):
+        """
+        Reserves a nickname across all the workers
+        :param nickname: the requested nickname
+        :param callback: called with the args and whether the nickname was reserved once the supervisor answers
+        :param args: additional arguments for the callback
+        """
+        reference = next(self.references)
+        self.claims[reference] = (callback, args)
+        self.publish(CLAIM, {'nickname': nickname, 'reference': reference})
+
+    def release(self, nickname):
+        """
+        Releases a reserved nickname
+        :param nickname: the nickname
+        """
+        self.publish(LEAVE, {'nickname': nickname})
+
+    def receive(self):
+        """
+        Handles the operations sent by the supervisor
+        """
+        for msg in self.link.read_messages():
+            self.handlers[msg.header](msg.data)
+        if self.link.reader.closed:
+            self.link_failed(self.link)
+
+    def link_failed(self, link):
+        raise SystemExit('The connection to the supervisor was lost.')
+
+    def on_claimed(self, data):
+        callback, args = self.claims.pop(data['reference'])
+        callback(*args + (data['available'],))
+
+    def on_join(self, data):
+        self.remote_users[data['nickname']] = RemoteUser(self, data)
+
+    def on_leave(self, data):
+        self.remote_users.pop(data['nickname'], None)
+
+    def on_update(self, data):
+        remote_user = self.remote_users.get(data['nickname'])
+        if remote_user:
+            remote_user.update(data)
+
+    def on_broadcast(self, data):
+        self.server.broadcast_message(wire.SharedMessage(data['header'], data['data']), data['room'],
+                                      data['droppable'], relay=False, sender=data.get('sender', ''))
+
+    def on_deliver(self, data):
+        user = self.server.users.get(data['nickname'])
+        if user:
+            user.client.send_msg(data['header'], data['data'], data['droppable'])
+
+    def on_kick(self, data):
+        user = self.server.users.get(data['nickname'])
+        if user:
+            self.server.disconnect_user(user)
+
+
+class Supervisor(object):
+    """
+    This class runs the server on several processes
+    It forks the workers and relays the bus operations between them
+    """
+    def __init__(self, server_factory, workers, backlog=chatsocket.DEF_LISTEN,
+                 max_frame_size=frame_reader.DEF_MAX_FRAME_SIZE):
+        """
+        The class constructor
+        :param server_factory: creates a worker's Server object (called with the worker's index as worker)
+        :param workers: the number of worker processes
+        :param backlog: the size of the listening socket's backlog
+        :param max_frame_size: the size of the largest frame the workers accept from a connection
+        """
+        self.server_factory = server_factory
+        self.workers = workers
+        self.listener = chatsocket.ChatSocket(listen=backlog, max_frame_size=max_frame_size)
+        self.event_loop = event_loop.create_event_loop()
+        self.links = dict()  # worker process ids by their links
+        self.nicknames = dict()  # links by the nicknames reserved through them
+        self.handlers = {CLAIM: self.on_claim, JOIN: self.relay, LEAVE: self.on_leave, UPDATE: self.relay,
+                         BROADCAST: self.relay, DELIVER: self.route, KICK: self.route}
+
+    def start(self):
+        """
+        Forks the workers and relays their bus operations until they all exit
+        """
+        print 'IP:', self.listener.server_ip, 'Port:', self.listener.port, 'Workers:', self.workers
+        self.listener.initialize_server_socket()
+        self.listener.setblocking(False)
+        for index in xrange(self.workers):
+            supervisor_end, worker_end = socket.socketpair()
+            pid = os.fork()
+            if not pid:
+                supervisor_end.close()
+                self._run_worker(worker_end, index)
+            worker_end.close()
+            link = create_link(supervisor_end, self.set_write_interest, self.remove_worker)
+            self.links[link] = pid
+            self.event_loop.register(link)
+        self.listener.close()
+        while self.links:
+            for link, events in self.event_loop.poll(self.event_loop.next_timeout()):
+                if events & event_loop.WRITE:
+                    link.outbound.flush()
+                if events & event_loop.READ and link in self.links:
+                    self.receive(link)
+            self.event_loop.run_callbacks()
+
+    def _run_worker(self, sock, index):
+        """
+        Runs a worker server (in the forked process), never returns
+        :param sock: the worker's end of the bus
+        :param index: the worker's index (the worker keeps its own files, such as its chat log, by it)
+        """
+        for link in self.links:
+            link.close()
+        self.event_loop.close()
+        server = self.server_factory(worker=index)
+        server.server.close()
+        server.server = self.listener
+        server.bus = Bus(sock, server)
+        try:
+            server.serve()
+        finally:
+            os._exit(0)
+
+    def set_write_interest(self, link, waiting):
+        self.event_loop.modify(link, event_loop.READ | event_loop.WRITE if waiting else event_loop.READ)
+
+    def receive(self, link):
+        """
+        Handles the operations sent by a worker
+        :param link: the worker's link
+        """
+        for msg in link.read_messages():
+            self.handlers[msg.header](link, msg.header, msg.data)
+        if link.reader.closed:
+            self.remove_worker(link)
+
+    def remove_worker(self, link):
+        """
+        Forgets a worker which exited, its users are announced as disconnected
+        :param link: the worker's link
+        """
+        if link not in self.links:
+            return
+        del self.links[link]
+        self.event_loop.unregister(link)
+        link.outbound.clear()
+        link.close_sock()
+        for nickname, owner in self.nicknames.items():
+            if owner is link:
+                self.on_leave(link, LEAVE, {'nickname': nickname})
+
+    def send(self, link, operation, data):
+        link.send_msg(operation, data)
+
+    def on_claim(self, link, operation, data):
+        available = data['nickname'] not in self.nicknames
+        if available:
+            self.nicknames[data['nickname']] = link
+        self.send(link, CLAIMED, {'reference': data['reference'], 'available': available})
+
+    def on_leave(self, link, operation, data):
+        if self.nicknames.get(data['nickname']) is link:
+            del self.nicknames[data['nickname']]
+            self.relay(link, operation, data)
+
+    def relay(self, link, operation, data):
+        """
+        Sends an operation to all the workers except its sender
+        """
+        for other in self.links:
+            if other is not link:
+                self.send(other, operation, data)
+
+    def route(self, link, operation, data):
+        """
+        Sends an operation to the worker which holds the operation's user
+        """
+        owner = self.nicknames.get(data['nickname'])
+        if owner in self.links:
+            self.send(owner, operation, data)
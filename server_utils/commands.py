@@ -1,12 +1,22 @@
 """
 This module is used by the server
 It contains the commands utility
+Commands are looked up by their name (the first word after the prefix) and their arguments are checked by their
+pattern - blocking commands run on worker threads, and their replies are sent from the event loop
 """
+import collections
 import re
+import time
 
-from essentials import protocols
+from server_utils import chat_log, rooms, search, writer_pool
 
 PREFIX = '?'
+DEF_COMMAND_WORKERS = 2  # the threads which run blocking commands
+DEF_HISTORY_COUNT = 20  # the messages ?history sends by default
+MAX_HISTORY_COUNT = 200  # the messages ?history and ?since send at most
+MAX_SEARCH_RESULTS = 20  # the messages ?search sends at most
+SEARCH_FETCH_SIZE = 100  # the candidates of a search read from the chat log at once
+CLOCK_FORMAT = '%H:%M:%S'
 
 
 class Command(object):
@@ -15,34 +25,40 @@ class Command(object):
     It is used for instantiating, both explicitly and with decorators, storing and detecting commands
     """
     commands = []
+    table = dict()  # the commands by their names
 
-    def __init__(self, pattern, name, func, admin_only):
+    def __init__(self, pattern, name, func, admin_only, blocking=False):
         """
         The class constructor
-        :param pattern: python regex pattern
+        :param pattern: python regex pattern (it should start with the command's name)
         :param name: name of the command
         :param func: the function of the command
         :param admin_only: whether the command is available for admin users only
+        :param blocking: whether the command may block - it runs on a worker thread and returns its reply
+        (a string, or None) instead of using the server
         """
         self.name = name
         self.pattern = re.compile(pattern)
         self.admin_only = admin_only
         self.func = func
+        self.blocking = blocking
 
     def __call__(self, args_obj):
         """
         Makes it so when a command object is called, it calls it's function
         :param args_obj: a command arguments object
+        :return: the function's result (the reply of a blocking command)
         """
-        self.func(args_obj)
+        return self.func(args_obj)
 
     @classmethod
-    def command(cls, pattern, name=None, admin_only=False):
+    def command(cls, pattern, name=None, admin_only=False, blocking=False):
         """
         The wrapper for the inner function, which adds a command
         :param pattern: python regex pattern
         :param name: name of the command (the function's name by default)
         :param admin_only: whether the command is available for admin users only
+        :param blocking: whether the command runs on a worker thread
         :return: the command's function as received by the inner function
         """
         def inner(func):
@@ -52,7 +68,9 @@ class Command(object):
             :param func: the command's function
             :return: func (the command's function argument)
             """
-            cls.commands.append(cls(pattern, name if name else func.__name__, func, admin_only))
+            command = cls(pattern, name if name else func.__name__, func, admin_only, blocking)
+            cls.commands.append(command)
+            cls.table[command.name] = command
             return func
         return inner
 
@@ -63,14 +81,96 @@ class Command(object):
         :param msg: message string
         :return: the command object if it's a command, otherwise None
         """
-        if msg.startswith(PREFIX):
-            msg = msg[1:]
-            for command in cls.commands:
-                if command.pattern.match(msg):
-                    return command
+        if not msg.startswith(PREFIX):
+            return None
+        msg = msg[len(PREFIX):]
+        words = msg.split(None, 1)
+        command = cls.table.get(words[0]) if words else None
+        if command and command.pattern.match(msg):
+            return command
         return None
 
 
+class CommandStats(object):
+    """
+    This class records the calls of a command
+    """
+    def __init__(self):
+        self.calls = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    @property
+    def average_time(self):
+        return self.total_time / self.calls if self.calls else 0.0
+
+    def record(self, elapsed):
+        """
+        Records a call
+        :param elapsed: the seconds the call took (from its message to its reply)
+        """
+        self.calls += 1
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+
+
+class Router(object):
+    """
+    This class runs the commands the users send
+    Blocking commands run on worker threads, in order per user, and their replies are sent from the event loop
+    """
+    def __init__(self, server, post, workers=DEF_COMMAND_WORKERS):
+        """
+        The class constructor
+        :param server: the server which runs the commands
+        :param post: schedules a callback on the event loop from another thread (EventLoop.call_soon_threadsafe)
+        :param workers: the number of threads which run blocking commands
+        """
+        self.server = server
+        self.pool = writer_pool.WriterPool(post, workers)
+        self.stats = collections.defaultdict(CommandStats)  # CommandStats objects by command names
+
+    def route(self, user, msg):
+        """
+        Runs the command of a message (if it is one)
+        :param user: the User object of the sender of the message
+        :param msg: message string
+        :return: True if the message was a command, False otherwise
+        """
+        command = Command.parse_msg(msg)
+        if command is None:
+            return False
+        if not self.server.check_permission(user, command):
+            user.client.send_regular_msg(self.server.no_permission_message)
+            return True
+        started = time.time()
+        if command.blocking:
+            self.pool.submit(user.nickname, command, (CommandArgs(self.server, user, msg),), self.command_done,
+                             command, user, started)
+        else:
+            command(CommandArgs(self.server, user, msg))
+            self.stats[command.name].record(time.time() - started)
+        return True
+
+    def command_done(self, command, user, started, reply, error):
+        """
+        Sends the reply of a blocking command (on the event loop)
+        :param command: the Command object
+        :param user: the User object of the user who ran the command
+        :param started: the time the command was received
+        :param reply: the command's reply, None if it has none
+        :param error: the exception the command raised, None if it succeeded
+        """
+        self.stats[command.name].record(time.time() - started)
+        if error:
+            reply = self.server.command_failed_message.format(command.name)
+        if reply and user.connected:
+            user.client.send_regular_msg(reply)
+
+    def close(self):
+        self.pool.close()
+
+
 class CommandArgs(object):
     """
     This class is used to pass arguments to command functions
@@ -94,7 +194,7 @@ class CommandArgs(object):
         :return: User object if the user was found, otherwise sends the server's
         user-not-found message to the sender of the message
         """
-        return self.server.users_by_nick.get(name) or name
+        return self.server.users.get(name) or name
 
     @property
     def target_user(self):
@@ -107,6 +207,17 @@ class CommandArgs(object):
             return self.user
         return self.get_user(self.args[1])
 
+    @property
+    def any_target_user(self):
+        """
+        Gets the targeted user like target_user, including users connected to other server workers
+        (their objects only support sending them messages and disconnecting them)
+        :return: User object of the sender or of the target user if they were found, otherwise the target's name
+        """
+        if len(self.args) <= 1:
+            return self.user
+        return self.server.find_user(self.args[1]) or self.args[1]
+
 
 @Command.command('^(quit)$')
 def quit(args_obj):
@@ -116,7 +227,7 @@ def quit(args_obj):
     server = args_obj.server
     user = args_obj.user
     server.disconnect_user(user)
-    server.broadcast(server.disconnect_message.format(user.display_name))
+    server.broadcast(server.disconnect_message.format(user.display_name), user.room)
 
 
 @Command.command('^(view_commands)$')
@@ -136,10 +247,155 @@ def view_admins(args_obj):
     Sends the user a list of admins in the server
     """
     server = args_obj.server
-    admins = ', '.join(nick for nick, user in server.users_by_nick.iteritems() if user.is_admin)
+    admins = ', '.join(server.admin_nicks())
     args_obj.user.client.send_regular_msg(server.admins_message.format(admins))
 
 
+@Command.command('^(view_stats)$', admin_only=True)
+def view_stats(args_obj):
+    """
+    Sends the user the server's send statistics, the calls of the commands, the rate limiting of the users and the
+    number of admins, muted users and uploaders (counted by the registry's indexes, only the uploaders are visited)
+    """
+    server = args_obj.server
+    stats = server.send_stats
+    args_obj.user.client.send_regular_msg(server.stats_message.format(stats.frames, stats.calls,
+                                                                      stats.frames_per_call, stats.bytes))
+    calls = ', '.join(server.command_stats_message.format(name, command.calls, command.average_time * 1000,
+                                                          command.max_time * 1000)
+                      for name, command in sorted(server.router.stats.iteritems()))
+    args_obj.user.client.send_regular_msg(server.commands_stats_message.format(calls))
+    args_obj.user.client.send_regular_msg(server.throttles_message.format(server.throttles, len(server.throttled)))
+    users = server.users
+    backlog = sum(users.get(nickname).write_backlog for nickname in users.uploaders)
+    args_obj.user.client.send_regular_msg(server.users_stats_message.format(len(users), len(users.admins),
+                                                                            len(users.muted), len(users.uploaders),
+                                                                            backlog))
+
+
+def format_records(server, records):
+    """
+    Formats records of the chat log as the reply of a scrollback command
+    :param server: the server (which holds the messages)
+    :param records: chat_log.Record objects
+    :return: the reply
+    """
+    if not records:
+        return server.no_history_message
+    lines = list()
+    for record in records:
+        clock = time.strftime(CLOCK_FORMAT, time.localtime(record.time))
+        if record.kind == chat_log.WHISPER:
+            lines.append(server.logged_whisper_message.format(clock, record.sender, record.target, record.text))
+        else:
+            lines.append(server.logged_message.format(clock, record.text))
+    return '\n'.join(lines)
+
+
+def parse_clock(text, now=None):
+    """
+    Parses a time of day
+    :param text: the time ('HH:MM' or 'HH:MM:SS')
+    :param now: the current time, None for time.time()
+    :return: the last time the clock showed it (seconds since the epoch)
+    :raises ValueError: if the time is invalid
+    """
+    now = time.time() if now is None else now
+    fields = [int(field) for field in text.split(':')] + [0]
+    if fields[0] > 23 or fields[1] > 59 or fields[2] > 59:
+        raise ValueError('Invalid time of day: {}'.format(text))
+    today = time.localtime(now)
+    when = time.mktime(today[:3] + (fields[0], fields[1], fields[2]) + today[6:8] + (-1,))
+    return when - 86400 if when > now else when
+
+
+@Command.command('^(history)(\s\d+)?(\s@?\w+)?$', blocking=True)
+def history(args_obj):
+    """
+    Sends the user the last messages of the chat log (only the messages of a user, if one is given)
+    """
+    server = args_obj.server
+    args = args_obj.args[1:]
+    count = DEF_HISTORY_COUNT
+    if args and args[0].isdigit():
+        count = min(int(args.pop(0)), MAX_HISTORY_COUNT)
+    sender = args[0].lstrip('@') if args else None
+    return format_records(server, server.chat_log.tail(count, args_obj.user.nickname, args_obj.user.room, sender))
+
+
+@Command.command('^(since)\s\d{1,2}:\d{2}(:\d{2})?$', blocking=True)
+def since(args_obj):
+    """
+    Sends the user the messages of the chat log since a time of day
+    """
+    server = args_obj.server
+    try:
+        when = parse_clock(args_obj.args[1])
+    except (ValueError, OverflowError):
+        return server.invalid_time_message.format(args_obj.args[1])
+    return format_records(server, server.chat_log.since(when, args_obj.user.nickname, args_obj.user.room,
+                                                        MAX_HISTORY_COUNT))
+
+
+@Command.command('^(search)\s.+', name='search', blocking=True)
+def search_log(args_obj):
+    """
+    Sends the user the newest messages of the chat log which have all the words (and "quoted phrases") searched for
+    """
+    server = args_obj.server
+    viewer, room = args_obj.user.nickname, args_obj.user.room
+    words, phrases = search.parse_query(args_obj.message.split(None, 1)[1])
+    if not words:
+        return server.invalid_search_message
+    candidates = server.search_index.search(words, (room, ''))
+    found = list()
+    for start in xrange(0, len(candidates), SEARCH_FETCH_SIZE):
+        for record in server.chat_log.get(candidates[start:start + SEARCH_FETCH_SIZE]):
+            if chat_log.is_visible(record, viewer, room) and search.matches(record.text, phrases):
+                found.append(record)
+        if len(found) >= MAX_SEARCH_RESULTS:
+            break
+    return format_records(server, found[MAX_SEARCH_RESULTS - 1::-1])
+
+
+@Command.command('^(join)\s#?\w{1,%d}$' % rooms.MAX_ROOM_NAME, name='join')
+def join_room(args_obj):
+    """
+    Moves the user to a room (it is created if it does not exist)
+    """
+    server = args_obj.server
+    user = args_obj.user
+    name = args_obj.args[1].lstrip('#')
+    if name == user.room:
+        user.client.send_regular_msg(server.already_in_room_message.format(name))
+        return
+    server.join_room(user, name)
+
+
+@Command.command('^(leave)$', name='leave')
+def leave_room(args_obj):
+    """
+    Moves the user back to the default room
+    """
+    server = args_obj.server
+    user = args_obj.user
+    if user.room == rooms.DEF_ROOM:
+        user.client.send_regular_msg(server.already_in_room_message.format(rooms.DEF_ROOM))
+        return
+    server.join_room(user, rooms.DEF_ROOM)
+
+
+@Command.command('^(rooms)$', name='rooms')
+def list_rooms(args_obj):
+    """
+    Sends the user a list of the rooms and the number of their members
+    """
+    server = args_obj.server
+    sizes = server.room_sizes()
+    entries = ', '.join(server.room_entry_message.format(name, count) for name, count in sorted(sizes.iteritems()))
+    args_obj.user.client.send_regular_msg(server.rooms_message.format(entries))
+
+
 @Command.command('^(whisper)\s@?\w+\s.+')
 def whisper(args_obj):
     """
@@ -147,12 +403,13 @@ def whisper(args_obj):
     """
     server = args_obj.server
     user = args_obj.user
-    target = args_obj.target_user
+    target = args_obj.any_target_user
     if isinstance(target, (str, unicode)):
         user.client.send_regular_msg(server.user_not_found.format(target))
         return
     content = ' '.join(args_obj.args[2:])
     target.client.send_regular_msg(server.whisper_message.format(user.display_name, content))
+    server.log_message(chat_log.WHISPER, user.nickname, target.nickname, content)
 
 
 @Command.command('^(kick)\s@?\w+$', admin_only=True)
@@ -162,13 +419,13 @@ def kick(args_obj):
     """
     server = args_obj.server
     user = args_obj.user
-    target = args_obj.target_user
+    target = args_obj.any_target_user
     if isinstance(target, (str, unicode)):
         user.client.send_regular_msg(server.user_not_found.format(target))
         return
     target.client.send_regular_msg(server.kick_message_whisper)
     server.disconnect_user(target)
-    server.broadcast(server.kick_message_all.format(target.nickname))
+    server.broadcast(server.kick_message_all.format(target.nickname), target.room)
 
 
 @Command.command('^(mute)\s@?\w+$', admin_only=True)
@@ -182,7 +439,7 @@ def mute(args_obj):
     if isinstance(target, (str, unicode)):
         user.client.send_regular_msg(server.user_not_found.format(target))
         return
-    target.muted = True
+    server.users.set_muted(target, True)
     target.client.send_regular_msg(server.mute_message)
 
 
@@ -198,7 +455,7 @@ def unmute(args_obj):
         user.client.send_regular_msg(server.user_not_found.format(target))
         return
     if target.muted:
-        target.muted = False
+        server.users.set_muted(target, False)
         target.client.send_regular_msg(server.unmute_message)
 
 
@@ -214,8 +471,7 @@ def promote(args_obj):
         user.client.send_regular_msg(server.user_not_found.format(target))
         return
     if not target.is_admin:
-        target.is_admin = True
-        server.change_display_name(target, '@' + target.display_name)
+        server.set_admin(target, True)
         target.client.send_regular_msg(server.promote_message)
 
 
@@ -231,8 +487,7 @@ def demote(args_obj):
         user.client.send_regular_msg(server.user_not_found.format(target))
         return
     if target.is_admin:
-        server.change_display_name(target, target.display_name[1:])
-        target.is_admin = False
+        server.set_admin(target, False)
         target.client.send_regular_msg(server.demote_message)
 
 
@@ -243,10 +498,8 @@ def send_file(args_obj):
     """
     server = args_obj.server
     user = args_obj.user
-    if user.uploading:
-        user.client.send_regular_msg(server.already_uploading_msg)
-    user.uploading = True
     name = args_obj.args[1]
-    request = protocols.build_header(protocols.REQUEST_FILE, name)
-    user.client.send_msg(request, '')
-    server.broadcast(server.upload_start_msg.format(name))
+    if not server.request_upload(user, name):
+        user.client.send_regular_msg(server.already_uploading_msg.format(name))
+        return
+    server.broadcast(server.upload_start_msg.format(name), user.room)
@@ -0,0 +1,328 @@
+"""
+This module is used by the server
+It contains the event loop backends which poll the server's sockets
+Sockets are registered once and the backend only reports the sockets which are ready
+The loop also runs timers and deferred callbacks, so all the server's work runs cooperatively on one thread
+Other threads hand results back to the loop with call_soon_threadsafe, which wakes it up through a pipe
+"""
+import collections
+import errno
+import fcntl
+import heapq
+import itertools
+import os
+import select
+import time
+
+READ = 1
+WRITE = 2
+
+
+class Timer(object):
+    """
+    This class is a callback scheduled to run later
+    """
+    def __init__(self, when, callback, args):
+        """
+        The class constructor
+        :param when: the time at which the callback runs
+        :param callback: the function to call
+        :param args: the arguments of the function
+        """
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class EventLoop(object):
+    """
+    The base class of the event loop backends
+    It keeps the registered objects by their file descriptors, the backends do the polling itself
+    The backends set up their poller before calling this constructor, as it registers the wakeup pipe
+    """
+    def __init__(self):
+        """
+        The class constructor
+        """
+        self.objects = dict()
+        self.fds = dict()
+        self.timers = list()  # a heap of (when, sequence, Timer) tuples
+        self.sequence = itertools.count()
+        self.callbacks = collections.deque()
+        self.wakeup_read, self.wakeup_write = os.pipe()
+        for fd in (self.wakeup_read, self.wakeup_write):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self._register(self.wakeup_read, READ)
+
+    def call_soon(self, callback, *args):
+        """
+        Schedules a callback to run after the current wakeup is handled
+        :param callback: the function to call
+        :param args: the arguments of the function
+        """
+        self.callbacks.append((callback, args))
+
+    def call_soon_threadsafe(self, callback, *args):
+        """
+        Schedules a callback from another thread, waking the loop up if it is waiting
+        :param callback: the function to call
+        :param args: the arguments of the function
+        """
+        self.callbacks.append((callback, args))
+        try:
+            os.write(self.wakeup_write, '\0')
+        except OSError as e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):  # a full pipe wakes the loop up anyway
+                raise
+
+    def _drain_wakeup(self):
+        try:
+            while os.read(self.wakeup_read, 4096):
+                pass
+        except OSError as e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def call_later(self, delay, callback, *args):
+        """
+        Schedules a callback to run after a delay
+        :param delay: the number of seconds to wait
+        :param callback: the function to call
+        :param args: the arguments of the function
+        :return: a Timer object, which can be cancelled
+        """
+        timer = Timer(time.time() + delay, callback, args)
+        heapq.heappush(self.timers, (timer.when, next(self.sequence), timer))
+        return timer
+
+    def next_timeout(self):
+        """
+        Calculates how long the loop may wait for sockets without delaying callbacks and timers
+        :return: the number of seconds to wait (None to wait until a socket is ready)
+        """
+        if self.callbacks:
+            return 0
+        while self.timers and self.timers[0][2].cancelled:
+            heapq.heappop(self.timers)
+        if not self.timers:
+            return None
+        return max(0, self.timers[0][0] - time.time())
+
+    def run_callbacks(self):
+        """
+        Runs the scheduled callbacks and the timers which are due
+        """
+        for _ in xrange(len(self.callbacks)):
+            callback, args = self.callbacks.popleft()
+            callback(*args)
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            timer = heapq.heappop(self.timers)[2]
+            if not timer.cancelled:
+                timer.callback(*timer.args)
+
+    def __len__(self):
+        return len(self.objects)
+
+    def register(self, obj, events=READ):
+        """
+        Registers an object (anything with a fileno method)
+        :param obj: the object to register
+        :param events: the events to wait for (READ, WRITE or both)
+        """
+        fd = obj.fileno()
+        self.objects[fd] = obj
+        self.fds[obj] = fd
+        self._register(fd, events)
+
+    def modify(self, obj, events):
+        """
+        Changes the events a registered object waits for
+        :param obj: a registered object
+        :param events: the events to wait for
+        """
+        if obj in self.fds:
+            self._modify(self.fds[obj], events)
+
+    def unregister(self, obj):
+        """
+        Unregisters an object
+        The file descriptor is remembered from the registration, so the object may already be closed
+        :param obj: a registered object
+        """
+        fd = self.fds.pop(obj, None)
+        if fd is None:
+            return
+        del self.objects[fd]
+        try:
+            self._unregister(fd)
+        except (IOError, OSError, KeyError, ValueError):
+            pass
+
+    def poll(self, timeout=None):
+        """
+        Waits until registered objects are ready
+        :param timeout: the maximum number of seconds to wait (None waits forever)
+        :return: a list of (object, events) tuples
+        """
+        try:
+            ready = self._poll(timeout)
+        except (IOError, OSError, select.error) as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+        result = []
+        for fd, events in ready:
+            if fd == self.wakeup_read:
+                self._drain_wakeup()
+            elif fd in self.objects:
+                result.append((self.objects[fd], events))
+        return result
+
+    def close(self):
+        os.close(self.wakeup_read)
+        os.close(self.wakeup_write)
+
+    def _register(self, fd, events):
+        raise NotImplementedError
+
+    def _modify(self, fd, events):
+        raise NotImplementedError
+
+    def _unregister(self, fd):
+        raise NotImplementedError
+
+    def _poll(self, timeout):
+        raise NotImplementedError
+
+
+class EpollLoop(EventLoop):
+    """
+    An event loop backed by epoll (linux)
+    """
+    ERROR_EVENTS = select.EPOLLHUP | select.EPOLLERR if hasattr(select, 'epoll') else 0
+
+    def __init__(self):
+        self.epoll = select.epoll()
+        super(EpollLoop, self).__init__()
+
+    @staticmethod
+    def _mask(events):
+        mask = 0
+        if events & READ:
+            mask |= select.EPOLLIN
+        if events & WRITE:
+            mask |= select.EPOLLOUT
+        return mask
+
+    def _register(self, fd, events):
+        self.epoll.register(fd, self._mask(events))
+
+    def _modify(self, fd, events):
+        self.epoll.modify(fd, self._mask(events))
+
+    def _unregister(self, fd):
+        self.epoll.unregister(fd)
+
+    def _poll(self, timeout):
+        ready = []
+        for fd, mask in self.epoll.poll(-1 if timeout is None else timeout):
+            events = 0
+            # errors and hang-ups are reported as readable so the reader notices the closed connection
+            if mask & (select.EPOLLIN | self.ERROR_EVENTS):
+                events |= READ
+            if mask & select.EPOLLOUT:
+                events |= WRITE
+            ready.append((fd, events))
+        return ready
+
+    def close(self):
+        super(EpollLoop, self).close()
+        self.epoll.close()
+
+
+class PollLoop(EventLoop):
+    """
+    An event loop backed by poll (posix systems without epoll)
+    """
+    ERROR_EVENTS = select.POLLHUP | select.POLLERR | select.POLLNVAL if hasattr(select, 'poll') else 0
+
+    def __init__(self):
+        self.poller = select.poll()
+        super(PollLoop, self).__init__()
+
+    @staticmethod
+    def _mask(events):
+        mask = 0
+        if events & READ:
+            mask |= select.POLLIN | select.POLLPRI
+        if events & WRITE:
+            mask |= select.POLLOUT
+        return mask
+
+    def _register(self, fd, events):
+        self.poller.register(fd, self._mask(events))
+
+    def _modify(self, fd, events):
+        self.poller.modify(fd, self._mask(events))
+
+    def _unregister(self, fd):
+        self.poller.unregister(fd)
+
+    def _poll(self, timeout):
+        ready = []
+        for fd, mask in self.poller.poll(None if timeout is None else timeout * 1000):
+            events = 0
+            if mask & (select.POLLIN | select.POLLPRI | self.ERROR_EVENTS):
+                events |= READ
+            if mask & select.POLLOUT:
+                events |= WRITE
+            ready.append((fd, events))
+        return ready
+
+
+class SelectLoop(EventLoop):
+    """
+    An event loop backed by select (last resort, limited to FD_SETSIZE sockets)
+    """
+    def __init__(self):
+        self.readers = set()
+        self.writers = set()
+        super(SelectLoop, self).__init__()
+
+    def _register(self, fd, events):
+        self._modify(fd, events)
+
+    def _modify(self, fd, events):
+        self._unregister(fd)
+        if events & READ:
+            self.readers.add(fd)
+        if events & WRITE:
+            self.writers.add(fd)
+
+    def _unregister(self, fd):
+        self.readers.discard(fd)
+        self.writers.discard(fd)
+
+    def _poll(self, timeout):
+        readable, writable, exceptional = select.select(self.readers, self.writers, [], timeout)
+        ready = dict.fromkeys(readable, READ)
+        for fd in writable:
+            ready[fd] = ready.get(fd, 0) | WRITE
+        return ready.items()
+
+
+def create_event_loop():
+    """
+    Creates the best event loop backend available on the system
+    :return: an EventLoop object
+    """
+    if hasattr(select, 'epoll'):
+        return EpollLoop()
+    if hasattr(select, 'poll'):
+        return PollLoop()
+    return SelectLoop()
@@ -0,0 +1,80 @@
+"""
+This module is used by the server
+It contains the connection handshake, which reads a new connection's hello (nickname and offered codecs)
+without blocking the server
+"""
+import errno
+import socket
+
+from essentials import chatsocket, wire
+
+# handshake states
+READING_LENGTH = 'reading_length'
+READING_HELLO = 'reading_hello'
+DONE = 'done'
+CLOSED = 'closed'
+
+DEF_HANDSHAKE_TIMEOUT = 10  # seconds a new connection has to send its nickname
+MAX_HELLO_SIZE = 256
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK)
+
+
+class PendingConnection(object):
+    """
+    This class is a connection which was accepted but has not finished the handshake yet
+    It is a state machine fed by the event loop whenever the connection is readable
+    """
+    def __init__(self, client, address):
+        """
+        The class constructor
+        :param client: the accepted ChatSocket
+        :param address: the address of the client as returned by accept
+        """
+        self.client = client
+        self.address = address
+        self.timer = None  # the event loop timer which closes the connection if the handshake times out
+        self.state = READING_LENGTH
+        self.expected = chatsocket.MSG_LEN_SIZE
+        self.buffer = ''
+        self.nick = None
+        self.offers = None  # the codecs offered by the client, None if it does not negotiate
+        client.setblocking(False)
+
+    def fileno(self):
+        return self.client.fileno()
+
+    def on_readable(self):
+        """
+        Reads whatever the client has sent so far and advances the state machine
+        :return: the handshake state
+        """
+        while self.state in (READING_LENGTH, READING_HELLO):
+            try:
+                data = self.client.recv(self.expected - len(self.buffer))
+            except socket.error as e:
+                if e.args[0] in WOULD_BLOCK:
+                    break
+                self.state = CLOSED
+                break
+            if not data:
+                self.state = CLOSED
+                break
+            self.buffer += data
+            if len(self.buffer) == self.expected:
+                self._advance()
+        return self.state
+
+    def _advance(self):
+        """
+        Moves on to the next state once the expected data was fully read
+        """
+        if self.state == READING_LENGTH:
+            if not self.buffer.isdigit() or not 0 < int(self.buffer) <= MAX_HELLO_SIZE:
+                self.state = CLOSED
+                return
+            self.expected = int(self.buffer)
+            self.state = READING_HELLO
+        else:
+            self.nick, self.offers = wire.parse_hello(self.buffer)
+            self.state = DONE
+        self.buffer = ''
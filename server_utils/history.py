@@ -0,0 +1,52 @@
+"""
+This module is used by the server
+It contains the chat history: the last broadcast messages, replayed to users when they join
+The messages are kept as the wire.SharedMessage objects which were broadcast, so their frames are encoded once
+(by the broadcast itself) and a replay is a single write of the joined frames
+"""
+import collections
+
+DEF_HISTORY_SIZE = 50  # messages
+DEF_HISTORY_BYTES = 65536  # the bytes of the messages' contents
+
+
+class History(object):
+    """
+    This class is a ring buffer of the last broadcast messages, bounded by a number of messages and of bytes
+    """
+    def __init__(self, size=DEF_HISTORY_SIZE, max_bytes=DEF_HISTORY_BYTES):
+        """
+        The class constructor
+        :param size: the number of messages kept (0 disables the history)
+        :param max_bytes: the bytes of the messages' contents (headers and data) kept
+        """
+        self.size = size
+        self.max_bytes = max_bytes
+        self.messages = collections.deque()  # (message, size) tuples, oldest first
+        self.bytes = 0
+
+    def __len__(self):
+        return len(self.messages)
+
+    def append(self, message):
+        """
+        Keeps a broadcast message, dropping the oldest messages beyond the limits
+        :param message: a wire.SharedMessage object
+        """
+        size = len(message.header) + len(message.data)
+        if not self.size or size > self.max_bytes:
+            return
+        self.messages.append((message, size))
+        self.bytes += size
+        while len(self.messages) > self.size or self.bytes > self.max_bytes:
+            _, dropped = self.messages.popleft()
+            self.bytes -= dropped
+
+    def replay(self, client):
+        """
+        Sends the kept messages to a client, with one frame push (so the messages leave with a single write)
+        :param client: the client's socket (with an outbound queue)
+        """
+        if self.messages:
+            client.send_frame(''.join(message.frame(client.codec, client.compressing) for message, _ in self.messages),
+                              droppable=True)
@@ -0,0 +1,376 @@
+"""
+This module is used by the server
+It contains the outbound queues, which buffer the frames sent to each client
+The queues are flushed with non-blocking writes whenever the client's socket is writable
+Bulk transfers are producers (iterators of frames or file regions) which the queue pulls from whenever it runs low,
+so transfers progress cooperatively with the rest of the server instead of running in threads
+A producer which yields None is paused (e.g. it waits for flow control credits) until the queue is resumed
+The frames pushed to a queue (chat and control messages) are sent before the frames of the producers, which wait
+in a separate lane - a message waits at most for the rest of the chunk which is being sent
+Frames of a compressed connection are compressed when they are sent, the order the peer decompresses them in
+A bounded number of producers take turns, one frame each, the rest wait for their turn
+Pushed frames are coalesced: the queue is flushed once per coalescing window (by default at the end of the event loop
+iteration) and the frames waiting by then are joined into a single write
+"""
+import collections
+import errno
+import itertools
+import socket
+import threading
+
+from essentials import file_handler
+
+# overload policies - what happens when a queue grows past its high watermark
+DROP = 'drop'  # new droppable frames are discarded until the queue drains below its low watermark
+COALESCE = 'coalesce'  # the oldest unsent droppable frames are discarded to make room for the newest
+DISCONNECT = 'disconnect'  # the client is disconnected
+POLICIES = (DROP, COALESCE, DISCONNECT)
+
+DEF_HIGH_WATERMARK = 8388608  # 8 MiB
+DEF_LOW_WATERMARK = 2097152  # 2 MiB
+DEF_MEMORY_CAP = 268435456  # 256 MiB across all the queues
+DEF_MAX_PRODUCERS = 4  # the number of transfers sent to a client at once
+DEF_COALESCE_WINDOW = 0  # seconds pushed frames wait to be written with later ones (0 - until the loop iteration ends)
+DEF_MAX_BATCH = 65536  # the maximum number of bytes of pushed frames joined into one write
+DONT_WAIT = getattr(socket, 'MSG_DONTWAIT', 0)
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+
+class MemoryBudget(object):
+    """
+    This class limits the amount of memory held by all the outbound queues together
+    """
+    def __init__(self, limit=DEF_MEMORY_CAP):
+        """
+        The class constructor
+        :param limit: the maximum number of bytes queued in all the queues
+        """
+        self.limit = limit
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def reserve(self, size, force=False):
+        """
+        Reserves memory for a frame
+        :param size: the size of the frame
+        :param force: whether to reserve the memory even if the budget is exhausted
+        :return: True if the memory was reserved, False otherwise
+        """
+        with self.lock:
+            if not force and self.used + size > self.limit:
+                return False
+            self.used += size
+            return True
+
+    def release(self, size):
+        """
+        Releases memory reserved for a frame
+        :param size: the size of the frame
+        """
+        with self.lock:
+            self.used -= size
+
+
+class SendStats(object):
+    """
+    This class counts the writes of the outbound queues
+    """
+    def __init__(self):
+        self.frames = 0  # the number of frames written
+        self.calls = 0  # the number of send calls (system calls)
+        self.bytes = 0  # the number of bytes written
+
+    @property
+    def frames_per_call(self):
+        return float(self.frames) / self.calls if self.calls else 0.0
+
+
+class OutboundQueue(object):
+    """
+    This class is a client's outbound buffer
+    Frames are queued by push and written by flush without ever blocking the server
+    Droppable frames (regular chat messages) are subject to the overload policy, other frames are always queued
+    """
+    def __init__(self, sock, budget, on_interest, on_failure, high_watermark=DEF_HIGH_WATERMARK,
+                 low_watermark=DEF_LOW_WATERMARK, policy=DROP, max_producers=DEF_MAX_PRODUCERS, schedule_flush=None,
+                 stats=None, max_batch=DEF_MAX_BATCH):
+        """
+        The class constructor
+        :param sock: the client's socket
+        :param budget: the MemoryBudget shared by all the queues
+        :param on_interest: called with the socket and whether the queue waits for the socket to be writable
+        :param on_failure: called with the socket when the client should be disconnected
+        :param high_watermark: the queue size (bytes) at which the queue is overloaded
+        :param low_watermark: the queue size (bytes) at which an overloaded queue recovers
+        :param policy: the overload policy (DROP, COALESCE or DISCONNECT)
+        :param max_producers: the number of producers which take turns, the others wait until one of them ends
+        :param schedule_flush: called with a callback which flushes the queue, to run it once the coalescing window
+        ends - None writes pushed frames right away
+        :param stats: the SendStats object which counts the queue's writes (may be shared by all the queues)
+        :param max_batch: the maximum number of bytes of pushed frames joined into one write
+        """
+        if policy not in POLICIES:
+            raise ValueError('Unknown overload policy: {}'.format(policy))
+        self.sock = sock
+        self.budget = budget
+        self.on_interest = on_interest
+        self.on_failure = on_failure
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.policy = policy
+        self.frames = collections.deque()  # (frame, droppable, compress) tuples, sent first
+        self.bulk = collections.deque()  # the frames pulled from the producers
+        self.current = None  # the frame which is being sent
+        self.offset = 0  # the number of bytes of the current frame which were already sent
+        self.max_producers = max_producers
+        self.producers = collections.deque()  # iterators of frames, served in turns
+        self.paused = list()  # producers which wait to be resumed
+        self.waiting_producers = collections.deque()  # producers which wait for their turn to start
+        self.size = 0
+        self.overloaded = False
+        self.failed = False
+        self.waiting = False  # whether the queue waits for the socket to be writable
+        self.dropped = 0
+        self.schedule_flush = schedule_flush
+        self.flush_scheduled = False
+        self.stats = stats or SendStats()
+        self.max_batch = max_batch
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.frames) + len(self.bulk) + (self.current is not None)
+
+    def push(self, frame, droppable=False, compress=False):
+        """
+        Queues a frame and attempts to write it right away
+        :param frame: the frame's bytes
+        :param droppable: whether the overload policy may discard the frame
+        :param compress: whether to compress the frame with the socket's streaming context when it is sent
+        :return: True if the frame was queued, False if it was discarded
+        """
+        with self.lock:
+            if self.failed:
+                return False
+            if self.size + len(frame) > self.high_watermark:
+                self.overloaded = True
+            reserved = self.budget.reserve(len(frame), force=not droppable)
+            if droppable and (self.overloaded or not reserved):
+                if reserved:
+                    self.budget.release(len(frame))
+                if not self._handle_overload(len(frame)):
+                    return False
+            self.frames.append((frame, droppable, compress))
+            self.size += len(frame)
+            if not self.waiting:
+                self._flush_later()
+            return True
+
+    def _flush_later(self):
+        """
+        Flushes the queue once the coalescing window ends (right away if there is none)
+        """
+        if self.schedule_flush is None:
+            self.flush()
+        elif not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.schedule_flush(self._scheduled_flush)
+
+    def _scheduled_flush(self):
+        with self.lock:
+            self.flush_scheduled = False
+            if not self.waiting and not self.failed:  # a waiting queue is flushed once its socket is writable
+                self.flush()
+
+    def add_producer(self, producer):
+        """
+        Adds a producer of frames (such as a file transfer)
+        The producer's frames are never dropped, they are pulled only while the queue is below its low watermark
+        :param producer: an iterator of frames
+        """
+        with self.lock:
+            if self.failed:
+                return
+            if len(self.producers) + len(self.paused) >= self.max_producers:
+                self.waiting_producers.append(producer)
+                return
+            self.producers.append(producer)
+            if not self.waiting:
+                self.flush()
+
+    def resume(self):
+        """
+        Resumes the paused producers
+        """
+        with self.lock:
+            if self.failed or not self.paused:
+                return
+            self.producers.extend(self.paused)
+            del self.paused[:]
+            if not self.waiting:
+                self.flush()
+
+    def _refill(self):
+        """
+        Pulls frames from the producers (one frame from each in turn) until the queue reaches its low watermark
+        """
+        while self.producers and self.size < self.low_watermark:
+            producer = self.producers.popleft()
+            try:
+                frame = next(producer)
+            except StopIteration:
+                if self.waiting_producers:
+                    self.producers.append(self.waiting_producers.popleft())
+                continue
+            if frame is None:
+                self.paused.append(producer)
+                continue
+            self.producers.append(producer)
+            self.budget.reserve(len(frame), force=True)
+            self.bulk.append(frame)
+            self.size += len(frame)
+
+    def _handle_overload(self, size):
+        """
+        Applies the overload policy to a droppable frame
+        :param size: the size of the frame
+        :return: True if the frame should still be queued (memory was reserved for it), False otherwise
+        """
+        if self.policy == DISCONNECT:
+            self.fail()
+            return False
+        if self.policy == COALESCE:
+            self._discard_oldest(self.low_watermark - size)
+            if self.size + size <= self.high_watermark and self.budget.reserve(size):
+                return True
+        self.dropped += 1
+        return False
+
+    def _discard_oldest(self, target):
+        """
+        Discards the oldest droppable frames (which are not being sent) until the queue fits the target size
+        :param target: the wanted queue size (bytes)
+        """
+        kept = collections.deque()
+        while self.frames and self.size > target:
+            entry = self.frames.popleft()
+            if entry[1]:
+                self._forget(len(entry[0]))
+                self.dropped += 1
+            else:
+                kept.append(entry)
+        kept.extend(self.frames)
+        self.frames = kept
+
+    def _forget(self, size):
+        """
+        Updates the accounting after a frame has left the queue
+        :param size: the size of the frame
+        """
+        self.size -= size
+        self.budget.release(size)
+        if self.overloaded and self.size <= self.low_watermark:
+            self.overloaded = False
+
+    def flush(self):
+        """
+        Writes as many queued bytes as the socket accepts without blocking
+        :return: True if the queue was emptied, False otherwise
+        """
+        with self.lock:
+            self._refill()
+            while not self.failed:
+                if self.current is None:
+                    if self.frames:
+                        self.current = self._next_batch()
+                    elif self.bulk:
+                        self.current = self.bulk.popleft()
+                        self.stats.frames += 1
+                    else:
+                        break
+                frame = self.current
+                self.stats.calls += 1
+                try:
+                    if isinstance(frame, file_handler.ChunkFrame):
+                        sent = frame.send(self.sock, self.offset, DONT_WAIT)
+                    else:
+                        sent = self.sock.send(memoryview(frame)[self.offset:], DONT_WAIT)
+                except (socket.error, IOError, OSError) as e:
+                    if e.args and e.args[0] in WOULD_BLOCK:
+                        break
+                    self.fail()
+                    return False
+                self.offset += sent
+                self.stats.bytes += sent
+                if self.offset < len(frame):
+                    break
+                self.current = None
+                self.offset = 0
+                self._forget(len(frame))
+                self._refill()
+            self._set_waiting(bool(len(self)) and not self.failed)
+            return not len(self)
+
+    def _next_batch(self):
+        """
+        Joins the pushed frames which wait to be sent into one buffer (up to max_batch bytes), so they are written
+        with a single send
+        :return: the buffer
+        """
+        batch = list()
+        size = 0
+        while self.frames and (not batch or size + len(self.frames[0][0]) <= self.max_batch):
+            frame, _, compress = self.frames.popleft()
+            if compress:
+                frame = self._compress(frame)
+            batch.append(frame)
+            size += len(frame)
+        self.stats.frames += len(batch)
+        return batch[0] if len(batch) == 1 else ''.join(batch)
+
+    def _compress(self, frame):
+        """
+        Compresses a frame which is about to be sent (the queue's size shrinks accordingly)
+        :param frame: the frame's bytes
+        :return: the frame to send
+        """
+        compressed = self.sock.compress_frame(frame)
+        self._forget(len(frame) - len(compressed))
+        return compressed
+
+    def _set_waiting(self, waiting):
+        """
+        Tells the server whether to watch the socket for writability (only when it changes)
+        :param waiting: whether the queue has frames to write
+        """
+        if waiting != self.waiting:
+            self.waiting = waiting
+            self.on_interest(self.sock, waiting)
+
+    def fail(self):
+        """
+        Marks the queue as failed - its client has to be disconnected
+        """
+        with self.lock:
+            if self.failed:
+                return
+            self.failed = True
+        self.on_failure(self.sock)
+
+    def clear(self):
+        """
+        Discards the queued frames and releases their memory
+        """
+        with self.lock:
+            self.budget.release(self.size)
+            for producer in itertools.chain(self.producers, self.paused, self.waiting_producers):
+                if hasattr(producer, 'close'):
+                    producer.close()
+            self.producers.clear()
+            del self.paused[:]
+            self.waiting_producers.clear()
+            self.frames.clear()
+            self.bulk.clear()
+            self.current = None
+            self.size = 0
+            self.offset = 0
+            self.failed = True
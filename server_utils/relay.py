@@ -0,0 +1,358 @@
+"""
+This module is used by the server
+It contains the file relay, which serves the uploaded files to the users who download them
+The chunks of the files are kept in a bounded LRU cache shared by all the downloads, so a file downloaded by
+many users at once is read from the disk once, and the chunks of an upload are written through to the cache
+Downloads of a file which is still being uploaded follow the upload chunk by chunk (from its temporary file)
+The files whose manifests were kept (uploads which were resumable) are sent resumable
+The files are read from the upload store (see store.Store) on the writer threads - a download waits for its reads like
+it waits for an upload (its producer is resumed once the read is done), and the downloads which miss the same chunk
+share its read
+Chunks sent to compressed connections are compressed once and cached next to the raw chunks, unless a sample of
+the file shows it does not compress
+"""
+import collections
+
+from essentials import chatsocket, file_handler, manifests, protocols, wire
+
+DEF_CACHE_SIZE = 67108864  # 64 MiB
+READ_JOBS = 'relay reads'  # the writer pool keys of the reads of a file start with this (the reads of a file queue up)
+
+# a stored file, as looked up by Relay.locate (the fields are None for a file served from its upload)
+Location = collections.namedtuple('Location', ('digest', 'path', 'size', 'manifest'))
+
+
+class ChunkCache(object):
+    """
+    This class is an LRU cache of file chunks with a byte budget
+    Chunks are keyed by the file's name and the chunk's offset (and the raw chunk's size for compressed chunks)
+    """
+    def __init__(self, limit=DEF_CACHE_SIZE):
+        """
+        The class constructor
+        :param limit: the maximum number of bytes cached
+        """
+        self.limit = limit
+        self.chunks = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Gets a chunk (and marks it as recently used)
+        :param key: a (name, offset) or (name, offset, size) tuple
+        :return: the chunk's data, None if it is not cached
+        """
+        chunk = self.chunks.pop(key, None)
+        if chunk is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.chunks[key] = chunk
+        return chunk
+
+    def put(self, key, chunk):
+        """
+        Caches a chunk, evicting the least recently used chunks to stay within the budget
+        :param key: a (name, offset) or (name, offset, size) tuple
+        :param chunk: the chunk's data
+        """
+        if len(chunk) > self.limit:
+            return
+        old = self.chunks.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self.chunks[key] = chunk
+        self.size += len(chunk)
+        while self.size > self.limit:
+            _, evicted = self.chunks.popitem(last=False)
+            self.size -= len(evicted)
+
+    def discard(self, name):
+        """
+        Forgets the chunks of a file
+        :param name: the file's name
+        """
+        for key in [key for key in self.chunks if key[0] == name]:
+            self.size -= len(self.chunks.pop(key))
+
+
+class Upload(object):
+    """
+    This class is the state of a file which is being uploaded
+    """
+    def __init__(self, source):
+        self.source = source  # the download_manager.Download object which writes the file
+        self.size = 0  # the number of bytes received so far
+        self.followers = set()  # the outbound queues of the downloads which wait for more chunks
+
+
+class Read(object):
+    """
+    This class is a chunk read on a writer thread - the downloads which need the chunk wait for the same read
+    """
+    def __init__(self, version):
+        self.version = version  # the version of the file's content which is read (see Relay.discard)
+        self.waiters = set()  # the outbound queues of the downloads which wait for the chunk
+        self.done = False
+        self.data = None  # the chunk's data, None if it could not be read
+
+
+class Relay(object):
+    """
+    This class serves the files of a directory to the users
+    The downloads are producers of the users' outbound queues, which take their chunks from the cache
+    """
+    def __init__(self, store, submit, chunk_size=chatsocket.DEF_DATA_CHUNK_SIZE, cache_size=DEF_CACHE_SIZE):
+        """
+        The class constructor
+        :param store: the store.Store object of the files
+        :param submit: runs disk work on a writer thread (writer_pool.WriterPool.submit)
+        :param chunk_size: the size of the chunks read from the disk
+        :param cache_size: the maximum number of bytes cached
+        """
+        self.store = store
+        self.submit = submit
+        self.chunk_size = chunk_size
+        self.cache = ChunkCache(cache_size)
+        self.uploads = dict()  # Upload objects by file names
+        self.manifests = dict()  # the manifests of the files by their paths (None for files without a manifest)
+        self.digests = dict()  # the content hashes of the cached files by their names
+        self.compressible = dict()  # whether the files compress by their names (decided by a sample)
+        self.reads = dict()  # the Read objects of the chunks being read by (name, offset, size)
+        # counts the changes of the files' contents, so a read which was started before a change is not cached
+        self.versions = collections.Counter()
+
+    def get_path(self, name):
+        return self.store.path(file_handler.GET_FILE_NAME(name))
+
+    def locate(self, name, callback, *callback_args):
+        """
+        Looks a file up - its index entry and its manifest are read on a writer thread
+        :param name: the file's name
+        :param callback: called on the event loop with the callback args, the file's Location (None if there is no
+        such file) and the exception raised while looking it up (None if there was none)
+        :param callback_args: additional arguments for the callback
+        """
+        name = file_handler.GET_FILE_NAME(name)
+        self.submit((READ_JOBS, name), self._locate, (name,), self._located, name, callback, callback_args)
+
+    def _locate(self, name):
+        """
+        Looks a stored file up (on a writer thread)
+        :param name: the file's name
+        :return: a Location, None if there is no such file
+        """
+        digest = self.store.lookup(name)
+        path = digest and self.store.object_path(digest)
+        if not path or not file_handler.PATH_EXISTS(path):
+            return None
+        manifest = self.manifests[path] if path in self.manifests else manifests.load(path)
+        return Location(digest, path, file_handler.GET_FILE_SIZE(path), manifest)
+
+    def _located(self, name, callback, callback_args, location, error):
+        if location:
+            self.manifests[location.path] = location.manifest  # the content of a path never changes
+        elif name in self.uploads:
+            location = Location(None, None, None, None)
+        callback(*callback_args + (location, error))
+
+    def upload_chunk(self, name, data, source):
+        """
+        Writes a chunk of an upload through to the cache (after it was written to the disk)
+        The chunks of a resumed upload are not cached - they do not arrive in order, so the upload's downloads wait
+        for it to end
+        :param name: the file's name
+        :param data: the chunk's data
+        :param source: the download_manager.Download object which writes the file
+        """
+        upload = self.uploads.get(name)
+        if upload is None or upload.source is not source:
+            self.discard(name)  # a new version of the file
+            self.digests.pop(name, None)
+            upload = self.uploads[name] = Upload(source)
+        if not source.sequential:
+            return
+        self.cache.put((name, upload.size), wire.to_bytes(data))
+        upload.size += len(data)
+        self._wake_followers(upload)
+
+    def upload_ended(self, name, failed=False, digest=None):
+        """
+        Marks an upload as ended
+        :param name: the file's name
+        :param failed: whether the upload failed (its chunks are dropped from the cache)
+        :param digest: the content hash the file was stored under, None if the upload failed
+        """
+        upload = self.uploads.pop(name, None)
+        if failed or not upload:
+            self.discard(name)  # nothing was written through (a deduplicated or fully resumed upload)
+        if digest:
+            self.digests[name] = digest
+        if upload:
+            self._wake_followers(upload)
+
+    def discard(self, name):
+        """
+        Forgets what is known about the content of a file
+        :param name: the file's name
+        """
+        self.cache.discard(name)
+        self.compressible.pop(name, None)
+        self.versions[name] += 1
+
+    def _compress(self, name, offset, data):
+        """
+        Gets the compressed version of a chunk (compressed once for all the users)
+        :param name: the file's name
+        :param offset: the chunk's offset
+        :param data: the chunk's data
+        :return: the compressed data, None if the chunk is sent as is
+        """
+        if name not in self.compressible:
+            self.compressible[name] = wire.is_compressible(data)  # the first chunk sent is the sample
+        if not self.compressible[name]:
+            return None
+        key = (name, offset, len(data))
+        compressed = self.cache.get(key)
+        if compressed is None:
+            compressed = wire.compress_payload(data) or ''
+            self.cache.put(key, compressed)
+        return compressed or None
+
+    def _wake_followers(self, upload):
+        followers, upload.followers = upload.followers, set()
+        for queue in followers:
+            queue.resume()
+
+    def send(self, client, name, location):
+        """
+        Sends a file to a user
+        :param client: the user's socket (with an outbound queue)
+        :param name: the file's name
+        :param location: the file's Location, as it was just looked up (see locate)
+        """
+        name = file_handler.GET_FILE_NAME(name)
+        upload = self.uploads.get(name)
+        if not upload and location.digest != self.digests.get(name):
+            self.discard(name)  # the name points at another content (deduplicated, or stored by a worker)
+            self.digests[name] = location.digest
+        size = upload.source.size if upload else location.size
+        manifest = None if upload or not client.resumable else location.manifest
+        if manifest and manifest.size != size:
+            manifest = None
+        stream = client.open_stream()
+        client.send_file_frames(self.generate_chunk_frames(client, name, location.path, stream, manifest), name,
+                                size, stream, manifest)
+
+    def _open(self, name, path, temp_path):
+        """
+        Opens a file for reading
+        :param name: the file's name
+        :param path: the path of the file's content, None to look it up
+        :param temp_path: the temporary file of the file's upload, None if it is not being uploaded
+        :return: a file object
+        """
+        if temp_path:
+            try:
+                return open(temp_path, 'rb')
+            except IOError:
+                pass  # the upload has just finished, the temporary file was renamed
+        path = path or self.get_path(name)
+        if not path:
+            raise IOError('{} is not stored'.format(name))
+        return open(path, 'rb')
+
+    def _read_chunk(self, name, path, temp_path, offset, size):
+        """
+        Reads a chunk of a file from the disk (on a writer thread)
+        :param name: the file's name
+        :param path: the path of the file's content, None to look it up
+        :param temp_path: the temporary file of the file's upload, None if it is not being uploaded
+        :param offset: the chunk's offset
+        :param size: the chunk's size
+        :return: the chunk's data (empty at the end of the file)
+        """
+        with self._open(name, path, temp_path) as file:
+            file.seek(offset)
+            return file.read(size)
+
+    def _read(self, name, path, upload, offset, size):
+        """
+        Reads a chunk of a file on a writer thread, unless it is being read already
+        :param name: the file's name
+        :param path: the path of the file's content, None to look it up
+        :param upload: the file's Upload object if it is being uploaded, None otherwise
+        :param offset: the chunk's offset
+        :param size: the chunk's size
+        :return: the Read object
+        """
+        key = (name, offset, size)
+        read = self.reads.get(key)
+        if read is None or read.version != self.versions[name]:
+            read = self.reads[key] = Read(self.versions[name])
+            temp_path = upload.source.temp_path if upload else None
+            self.submit((READ_JOBS, name), self._read_chunk, (name, path, temp_path, offset, size), self._chunk_read,
+                        key, read)
+        return read
+
+    def _chunk_read(self, key, read, data, error):
+        """
+        Caches a chunk which was read, and resumes the downloads which wait for it (on the event loop)
+        :param key: the read's (name, offset, size) key
+        :param read: the Read object
+        :param data: the chunk's data, None if it could not be read
+        :param error: the exception raised while reading the chunk, None if there was none
+        """
+        if self.reads.get(key) is read:
+            del self.reads[key]
+        read.done = True
+        read.data = data
+        name, offset, _ = key
+        if data and read.version == self.versions[name]:
+            self.cache.put((name, offset), data)
+        waiters, read.waiters = read.waiters, set()
+        for queue in waiters:
+            queue.resume()
+
+    def generate_chunk_frames(self, client, name, path=None, stream=0, manifest=None):
+        """
+        Generates the chunk frames of a file for a user
+        Chunks are taken from the cache, and read from the disk (once for all the users) when they are not cached
+        :param client: the user's socket
+        :param name: the file's name
+        :param path: the path of the file's content, None to look it up (a file which is being uploaded)
+        :param stream: the transfer's stream id
+        :param manifest: the file's manifests.Manifest if it is sent resumable - the chunks then match its chunks
+        :return: the frames, None whenever the download waits for the upload or for a read
+        """
+        header = protocols.build_header(protocols.FILE_CHUNK, name)
+        offset = 0
+        while True:
+            data = self.cache.get((name, offset))
+            if data is not None and manifest and len(data) != manifest.chunk_length(offset // manifest.chunk_size):
+                data = None  # cached in chunks of another size
+            if data is None:
+                upload = self.uploads.get(name)
+                # an upload is read back only as far as it was flushed, the rest of the file is preallocated
+                size = manifest.chunk_size if manifest else self.chunk_size
+                if upload:
+                    size = min(size, upload.size - offset, upload.source.flushed - offset)
+                    if size <= 0:
+                        upload.followers.add(client.outbound)
+                        yield None
+                        continue
+                read = self._read(name, path, upload, offset, size)
+                while not read.done:
+                    read.waiters.add(client.outbound)
+                    yield None
+                data = read.data
+                if not data:
+                    return  # the end of the file, or the upload failed
+            compressed = client.compressing and self._compress(name, offset, data)
+            if compressed:
+                yield client.build_chunk_frame(header, compressed, stream, compressed=True)
+            else:
+                yield client.build_chunk_frame(header, data, stream)
+            offset += len(data)
@@ -0,0 +1,107 @@
+"""
+This module is used by the server
+It contains the chat rooms: every user is in one room, and the room's messages are sent to its members only,
+so the cost of a message grows with the size of its room rather than with the number of users
+Each room keeps its own history, which is replayed to the users who join it
+"""
+from server_utils import history
+
+DEF_ROOM = 'lobby'  # the room users join when they connect (it is kept even when it is empty)
+MAX_ROOM_NAME = 32
+
+
+class Room(object):
+    """
+    This class is a chat room - its members (on this server) and its last messages
+    """
+    def __init__(self, name, history_size=history.DEF_HISTORY_SIZE, history_bytes=history.DEF_HISTORY_BYTES):
+        """
+        The class constructor
+        :param name: the room's name
+        :param history_size: the number of messages replayed to users who join the room
+        :param history_bytes: the bytes of the messages replayed to users who join the room
+        """
+        self.name = name
+        self.members = set()  # the User objects of the members
+        self.history = history.History(history_size, history_bytes)
+
+    def __len__(self):
+        return len(self.members)
+
+
+class RoomRegistry(object):
+    """
+    This class holds the rooms by their names
+    Rooms are created when a user joins them and dropped (with their history) once their last member leaves,
+    except for the default room - the users' rooms must be changed through the registry's methods
+    """
+    def __init__(self, history_size=history.DEF_HISTORY_SIZE, history_bytes=history.DEF_HISTORY_BYTES):
+        """
+        The class constructor
+        :param history_size: the number of messages each room replays to users who join it
+        :param history_bytes: the bytes of the messages each room replays to users who join it
+        """
+        self.history_size = history_size
+        self.history_bytes = history_bytes
+        self.rooms = {DEF_ROOM: Room(DEF_ROOM, history_size, history_bytes)}
+
+    def __len__(self):
+        return len(self.rooms)
+
+    def __iter__(self):
+        return self.rooms.itervalues()
+
+    def __contains__(self, name):
+        return name in self.rooms
+
+    def get(self, name):
+        """
+        :param name: a room's name
+        :return: the Room object, None if there is no such room
+        """
+        return self.rooms.get(name)
+
+    def members(self, name):
+        """
+        :param name: a room's name
+        :return: the User objects of the room's members (empty if there is no such room)
+        """
+        room = self.rooms.get(name)
+        return room.members if room else ()
+
+    def join(self, user, name):
+        """
+        Moves a user to a room (out of their current room)
+        :param user: a User object
+        :param name: the room's name
+        :return: the Room object
+        """
+        self.leave(user)
+        room = self.rooms.get(name)
+        if room is None:
+            room = self.rooms[name] = Room(name, self.history_size, self.history_bytes)
+        room.members.add(user)
+        user.room = name
+        return room
+
+    def leave(self, user):
+        """
+        Takes a user out of their room - the user keeps the room's name, so their departure can be announced there
+        :param user: a User object
+        """
+        room = self.rooms.get(user.room)
+        if room is None:
+            return
+        room.members.discard(user)
+        if not room.members and room.name != DEF_ROOM:
+            del self.rooms[room.name]
+
+    def record(self, name, message):
+        """
+        Keeps a message in a room's history
+        :param name: the room's name
+        :param message: a wire.SharedMessage object
+        """
+        room = self.rooms.get(name)
+        if room is not None:
+            room.history.append(message)
@@ -0,0 +1,374 @@
+"""
+This module is used by the server
+It contains the search index of the chat log: an inverted index from the words of the messages to their record ids
+The words are indexed per room (the whispers, which have no room, together), so a query reads only the postings of the
+rooms its user may read
+The index is updated as the chat log is written (on the writer thread), and the postings of a word are kept in
+blocks of delta encoded varints (record ids only grow, so most deltas take a single byte)
+Queries match all of their words (AND) - the postings are intersected from the newest ids, skipping the blocks which
+cannot hold a match, and the intersection stops once enough candidates are found, so a query costs about the blocks
+it visits rather than the whole postings
+Phrases are checked against the candidates' text, newest first, and the candidates and the results are bounded
+The index is saved next to the chat log every SAVE_INTERVAL records, so a restart only indexes the newer records
+"""
+import bisect
+import os
+import re
+import struct
+import threading
+
+INDEX_FILE = 'search.idx'
+TEMP_SUFFIX = '.tmp'
+INDEX_VERSION = 3
+SAVE_INTERVAL = 10000  # the records indexed between saves
+DEF_MAX_CANDIDATES = 2000  # the records checked by a query
+BLOCK_SIZE = 128  # the ids in a block of postings
+WORD_PATTERN = re.compile(r'\w+', re.UNICODE)
+QUERY_PATTERN = re.compile(r'"([^"]*)"|(\S+)', re.UNICODE)
+FILE_HEADER = struct.Struct('!BqqI')  # version, the last id indexed, the oldest id kept, the number of words
+WORD_HEADER = struct.Struct('!HHIqI')  # room size, word size, postings count, last id, the number of blocks
+BLOCK_HEADER = struct.Struct('!qHI')  # first id, the number of ids, block size
+
+
+def tokenize(text):
+    """
+    :param text: a message
+    :return: the message's words (lowercase), in order
+    """
+    if not isinstance(text, unicode):
+        text = text.decode('utf-8', 'replace')
+    return WORD_PATTERN.findall(text.lower())
+
+
+def parse_query(query):
+    """
+    Parses a search query - words, and phrases in double quotes
+    :param query: the query string
+    :return: the words (all of them must match) and the phrases (word lists which must appear in order)
+    """
+    words, phrases = list(), list()
+    for phrase, word in QUERY_PATTERN.findall(query):
+        tokens = tokenize(phrase or word)
+        words.extend(tokens)
+        if len(tokens) > 1:
+            phrases.append(tokens)
+    return words, phrases
+
+
+def matches(text, phrases):
+    """
+    :param text: a message
+    :param phrases: word lists
+    :return: True if every phrase appears in the message, False otherwise
+    """
+    tokens = tokenize(text)
+    for phrase in phrases:
+        size = len(phrase)
+        if not any(tokens[i:i + size] == phrase for i in xrange(len(tokens) - size + 1)):
+            return False
+    return True
+
+
+def encode_varint(value, out):
+    """
+    Appends an unsigned integer to a buffer (7 bits per byte, the high bit marks a following byte)
+    :param value: the integer
+    :param out: a bytearray
+    """
+    while value > 0x7f:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def decode_postings(data, first):
+    """
+    :param data: the delta encoded ids of a block which follow its first id (a bytearray)
+    :param first: the block's first id
+    :return: the record ids, ascending
+    """
+    ids = [first]
+    value = shift = 0
+    last = first
+    for byte in data:
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        last += value
+        ids.append(last)
+        value = shift = 0
+    return ids
+
+
+class Postings(object):
+    """
+    This class is the postings list of a word
+    The ids are kept in blocks of up to BLOCK_SIZE ids - the first id of each block is kept aside (so blocks can be
+    skipped by their first ids), and the rest are delta encoded
+    """
+    __slots__ = ('firsts', 'blocks', 'sizes', 'count', 'last')
+
+    def __init__(self):
+        """
+        The class constructor
+        """
+        self.firsts = list()  # the first id of each block
+        self.blocks = list()  # the delta encoded ids which follow the first id of each block (bytearrays)
+        self.sizes = list()  # the number of ids in each block
+        self.count = 0
+        self.last = -1  # the last id (the base of the next delta)
+
+    def add(self, record_id):
+        """
+        :param record_id: a record id, greater than the ones added before
+        """
+        if self.sizes and self.sizes[-1] < BLOCK_SIZE:
+            encode_varint(record_id - self.last, self.blocks[-1])
+            self.sizes[-1] += 1
+        else:
+            self.add_block(record_id, bytearray(), 1)
+        self.count += 1
+        self.last = record_id
+
+    def add_block(self, first, data, size):
+        """
+        Appends a block (the count and the last id are the caller's)
+        :param first: the block's first id
+        :param data: the delta encoded ids which follow it
+        :param size: the number of ids in the block
+        """
+        self.firsts.append(first)
+        self.blocks.append(data)
+        self.sizes.append(size)
+
+    def block(self, index):
+        """
+        :param index: a block's index
+        :return: the block's record ids, ascending
+        """
+        return decode_postings(self.blocks[index], self.firsts[index])
+
+    def drop_before(self, first_id):
+        """
+        Drops the ids before an id - whole blocks are dropped, and the block which holds the id is encoded again
+        :param first_id: the oldest id to keep
+        """
+        index = bisect.bisect_right(self.firsts, first_id) - 1
+        if index < 0 or (index == 0 and self.firsts[0] == first_id):
+            return
+        kept = [record_id for record_id in self.block(index) if record_id >= first_id]
+        del self.firsts[:index + 1], self.blocks[:index + 1], self.sizes[:index + 1]
+        if kept:
+            data = bytearray()
+            for previous, record_id in zip(kept, kept[1:]):
+                encode_varint(record_id - previous, data)
+            self.firsts.insert(0, kept[0])
+            self.blocks.insert(0, data)
+            self.sizes.insert(0, len(kept))
+        self.count = sum(self.sizes)
+
+
+class Cursor(object):
+    """
+    This class walks the ids of a postings list from the newest to the oldest, decoding only the blocks it visits
+    The postings should not change while it is used (the index's lock should be held)
+    """
+    __slots__ = ('postings', 'block', 'ids', 'position')
+
+    def __init__(self, postings):
+        """
+        The class constructor
+        :param postings: a Postings object which has ids
+        """
+        self.postings = postings
+        self._enter(len(postings.blocks) - 1)
+
+    def _enter(self, block):
+        self.block = block
+        self.ids = self.postings.block(block) if block >= 0 else []
+        self.position = len(self.ids) - 1
+
+    @property
+    def current(self):
+        """
+        :return: the id the cursor is at, None once it passed the oldest id
+        """
+        return self.ids[self.position] if self.position >= 0 else None
+
+    def next(self):
+        """
+        Moves to the next (older) id
+        :return: the id, None if there is none
+        """
+        self.position -= 1
+        if self.position < 0 and self.block > 0:
+            self._enter(self.block - 1)
+        return self.current
+
+    def seek(self, target):
+        """
+        Moves to the newest id which is not newer than an id - the blocks in between are skipped without decoding
+        :param target: a record id
+        :return: the id, None if there is none
+        """
+        current = self.current
+        if current is None or current <= target:
+            return current
+        if self.postings.firsts[self.block] > target:
+            self._enter(bisect.bisect_right(self.postings.firsts, target, 0, self.block) - 1)
+        self.position = bisect.bisect_right(self.ids, target, 0, self.position + 1) - 1
+        return self.current
+
+
+class SearchIndex(object):
+    """
+    This class is the inverted index of the chat log
+    It is updated on the writer thread and queried on the command threads - it is guarded by a lock
+    """
+    def __init__(self, path):
+        """
+        The class constructor
+        :param path: the path of the saved index (it is loaded if it exists)
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.words = dict()  # Postings objects by (room, word) tuples (see chat_log.Record for the rooms)
+        self.last_id = None  # the last record id indexed
+        self.first_id = 0  # the oldest record id which may have postings
+        self.unsaved = 0  # the records indexed since the index was saved
+        self.load()
+
+    def add(self, records):
+        """
+        Indexes records (records which were indexed already are skipped)
+        :param records: chat_log.Record objects, by ascending ids
+        """
+        with self.lock:
+            for record in records:
+                if self.last_id is not None and record.id <= self.last_id:
+                    continue
+                for word in set(tokenize(record.text)):
+                    postings = self.words.get((record.room, word))
+                    if postings is None:
+                        postings = self.words[(record.room, word)] = Postings()
+                    postings.add(record.id)
+                self.last_id = record.id
+                self.unsaved += 1
+
+    def search(self, words, rooms, max_candidates=DEF_MAX_CANDIDATES):
+        """
+        Finds the records of some rooms which have all the words
+        The postings of each room are intersected from the newest ids: each word's cursor seeks the id the others
+        are at, so the blocks between matches are skipped, and the intersection stops once max_candidates ids are found
+        :param words: the words (as tokenized)
+        :param rooms: the names of the rooms ('' for the records which have no room)
+        :param max_candidates: the maximum number of ids returned
+        :return: the record ids, newest first
+        """
+        words = set(words)
+        if not words:
+            return []
+        found = list()
+        with self.lock:
+            for room in set(rooms):
+                postings = [self.words.get((room, word)) for word in words]
+                if None not in postings:
+                    found.extend(self._intersect(postings, max_candidates))
+        found.sort(reverse=True)
+        return found[:max_candidates]
+
+    @staticmethod
+    def _intersect(postings, max_candidates):
+        """
+        Intersects postings lists (the lock should be held)
+        :param postings: Postings objects
+        :param max_candidates: the maximum number of ids returned
+        :return: the record ids in all the lists, newest first
+        """
+        postings = sorted(postings, key=lambda entry: entry.count)  # the rarest word leads the others
+        cursors = [Cursor(entry) for entry in postings]
+        found = list()
+        record_id = cursors[0].current
+        while record_id is not None and len(found) < max_candidates:
+            for cursor in cursors[1:]:
+                other_id = cursor.seek(record_id)
+                if other_id != record_id:
+                    break
+            else:
+                found.append(record_id)
+                record_id = cursors[0].next()
+                continue
+            record_id = None if other_id is None else cursors[0].seek(other_id)
+        return found
+
+    def save(self, first_id=None):
+        """
+        Saves the index (on a writer thread) - postings of records older than the log's oldest record are dropped
+        :param first_id: the id of the oldest record in the chat log, None to keep all the postings
+        """
+        with self.lock:
+            if first_id is not None and first_id > self.first_id:
+                self._prune(first_id)
+            temp_path = self.path + TEMP_SUFFIX
+            with open(temp_path, 'wb') as saved:
+                saved.write(FILE_HEADER.pack(INDEX_VERSION, -1 if self.last_id is None else self.last_id,
+                                             self.first_id, len(self.words)))
+                for (room, word), postings in self.words.iteritems():
+                    room, word = room.encode('utf-8'), word.encode('utf-8')
+                    saved.write(WORD_HEADER.pack(len(room), len(word), postings.count, postings.last,
+                                                 len(postings.blocks)))
+                    saved.write(room + word)
+                    for first, data, size in zip(postings.firsts, postings.blocks, postings.sizes):
+                        saved.write(BLOCK_HEADER.pack(first, size, len(data)))
+                        saved.write(data)
+            if os.name == 'nt' and os.path.exists(self.path):
+                os.remove(self.path)
+            os.rename(temp_path, self.path)
+            self.unsaved = 0
+
+    def _prune(self, first_id):
+        """
+        Drops the postings of the records before an id (the lock should be held)
+        :param first_id: the oldest record id to keep
+        """
+        for key, postings in self.words.items():
+            postings.drop_before(first_id)
+            if not postings.count:
+                del self.words[key]
+        self.first_id = first_id
+
+    def load(self):
+        """
+        Loads the saved index - a missing or damaged file leaves the index empty (it is rebuilt from the log)
+        """
+        try:
+            with open(self.path, 'rb') as saved:
+                data = saved.read()
+        except IOError:
+            return
+        words = dict()
+        try:
+            version, last_id, first_id, count = FILE_HEADER.unpack_from(data, 0)
+            if version != INDEX_VERSION:
+                return
+            offset = FILE_HEADER.size
+            for _ in xrange(count):
+                room_size, size, postings_count, last, block_count = WORD_HEADER.unpack_from(data, offset)
+                offset += WORD_HEADER.size
+                room = data[offset:offset + room_size].decode('utf-8')
+                offset += room_size
+                word = data[offset:offset + size].decode('utf-8')
+                offset += size
+                postings = words[(room, word)] = Postings()
+                for _ in xrange(block_count):
+                    first, block_size, data_size = BLOCK_HEADER.unpack_from(data, offset)
+                    offset += BLOCK_HEADER.size
+                    postings.add_block(first, bytearray(data[offset:offset + data_size]), block_size)
+                    offset += data_size
+                postings.count, postings.last = postings_count, last
+        except (struct.error, UnicodeDecodeError):
+            return
+        self.words = words
+        self.last_id = None if last_id < 0 else last_id
+        self.first_id = first_id
@@ -0,0 +1,276 @@
+"""
+This module is used by the server
+It contains the upload store, which keeps the uploaded files by their content hashes
+The contents are stored once in sharded directories (objects/ab/cd/abcd...), and an index maps the names of the files
+to their content hashes - a file uploaded twice (under any names) is stored once, and of an upload whose content is
+already stored only one chunk is transferred, as the proof that the uploader has the content (see Challenge)
+The index keeps a file per name (names/<name>), replaced atomically, so the workers of a cluster can share the store
+A content is deleted once no name refers to it (reference counting, verified against the index on the disk)
+"""
+import collections
+import itertools
+import os
+import random
+import threading
+
+from essentials import download_manager, manifests
+
+OBJECTS_DIR = 'objects'
+NAMES_DIR = 'names'
+TEMP_DIR = 'tmp'
+SHARD_DEPTH = 2  # the number of directory levels above the contents
+SHARD_WIDTH = 2  # the number of hash characters which name a directory level
+INVALID_NAMES = ('', os.curdir, os.pardir)
+
+
+class Store(object):
+    """
+    This class is a content addressed store of files
+    """
+    def __init__(self, root):
+        """
+        The class constructor
+        Files found directly in the root (stored before there was a store) are moved into the store
+        :param root: the store's directory
+        """
+        self.root = os.path.abspath(root)
+        self.objects_dir = os.path.join(self.root, OBJECTS_DIR)
+        self.names_dir = os.path.join(self.root, NAMES_DIR)
+        self.temp_dir = os.path.join(self.root, TEMP_DIR)  # the uploads are written here
+        for directory in (self.objects_dir, self.names_dir, self.temp_dir):
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+        self.lock = threading.RLock()  # the writer threads store files while the event loop looks them up
+        self.refs = collections.Counter(self._read_index().itervalues())  # the number of names of each content
+        self._import_loose_files()
+
+    def object_path(self, digest):
+        """
+        :param digest: a content hash
+        :return: the path of the content
+        :raises ValueError: if the content hash is invalid (content hashes may come from the clients' manifests)
+        """
+        if not manifests.DIGEST_PATTERN.match(digest or ''):
+            raise ValueError('Invalid content hash: {!r}'.format(digest))
+        shards = [digest[i * SHARD_WIDTH:(i + 1) * SHARD_WIDTH] for i in xrange(SHARD_DEPTH)]
+        path = os.path.join(self.objects_dir, *(shards + [digest]))
+        if not path.startswith(self.objects_dir + os.sep):
+            raise ValueError('Invalid content hash: {!r}'.format(digest))
+        return path
+
+    def _name_path(self, name):
+        if name in INVALID_NAMES or os.path.basename(name) != name:
+            raise ValueError('Invalid file name: {!r}'.format(name))
+        return os.path.join(self.names_dir, name)
+
+    def lookup(self, name):
+        """
+        Gets the content hash of a file
+        :param name: the file's name
+        :return: the content hash, None if there is no such file
+        """
+        try:
+            with open(self._name_path(name), 'rb') as index:
+                digest = index.read().strip()
+        except (IOError, ValueError):
+            return None
+        return digest if manifests.DIGEST_PATTERN.match(digest) else None
+
+    def path(self, name):
+        """
+        Gets the path of a file's content
+        :param name: the file's name
+        :return: the path, None if there is no such file
+        """
+        digest = self.lookup(name)
+        return self.object_path(digest) if digest else None
+
+    def has(self, digest):
+        """
+        :param digest: a content hash
+        :return: True if the content is stored, False otherwise
+        """
+        try:
+            return os.path.isfile(self.object_path(digest))
+        except ValueError:
+            return False
+
+    def find(self, manifest):
+        """
+        Finds the stored content of a manifest (on a writer thread)
+        :param manifest: a manifests.Manifest object (sent by a client)
+        :return: the manifest kept with the content if it is the same manifest, None otherwise
+        """
+        try:
+            path = self.object_path(manifest.digest)
+        except ValueError:
+            return None
+        stored = manifests.load(path)
+        if stored and stored.file_id == manifest.file_id and os.path.isfile(path):
+            return stored
+        return None
+
+    def put(self, name, temp_path, digest=None, manifest=None):
+        """
+        Stores a received file - its content is moved into the store (or deleted if it is stored already)
+        :param name: the file's name
+        :param temp_path: the path of the received file
+        :param digest: the file's content hash, None to calculate it
+        :param manifest: the file's manifests.Manifest (kept next to the content), None if it has none
+        :return: the content hash
+        """
+        digest = digest or manifests.hash_file(temp_path)
+        target = self.object_path(digest)
+        with self.lock:
+            if os.path.isfile(target):
+                os.remove(temp_path)
+            else:
+                if not os.path.isdir(os.path.dirname(target)):
+                    os.makedirs(os.path.dirname(target))
+                os.rename(temp_path, target)
+            # the manifest is the client's, it is kept only if its content hash is the one calculated
+            if manifest and manifest.digest == digest and not os.path.isfile(target + manifests.MANIFEST_SUFFIX):
+                with open(target + manifests.MANIFEST_SUFFIX, 'wb') as kept:
+                    kept.write(manifest.encode())
+            self.link(name, digest)
+        return digest
+
+    def link(self, name, digest):
+        """
+        Points a name at a stored content (the content it pointed at loses a reference)
+        :param name: the file's name
+        :param digest: the content hash
+        :return: the content hash
+        """
+        with self.lock:
+            path = self._name_path(name)
+            if not self.has(digest):
+                raise IOError('The content {} is not stored'.format(digest))  # collected since it was looked up
+            old = self.lookup(name)
+            if old == digest:
+                return digest
+            temp_path = path + download_manager.TEMP_SUFFIX
+            with open(temp_path, 'wb') as index:
+                index.write(digest)
+            if os.name == 'nt' and os.path.exists(path):
+                os.remove(path)
+            os.rename(temp_path, path)
+            self.refs[digest] += 1
+            if old:
+                self._release(old)
+        return digest
+
+    def unlink(self, name):
+        """
+        Removes a file's name (its content is deleted if no other name refers to it)
+        :param name: the file's name
+        """
+        with self.lock:
+            old = self.lookup(name)
+            if old:
+                os.remove(self._name_path(name))
+                self._release(old)
+
+    def _release(self, digest):
+        """
+        Drops a reference to a content, and deletes the content once it has none
+        The other workers of a cluster may have added references, so the index is checked before the content is deleted
+        :param digest: the content hash
+        """
+        self.refs[digest] -= 1
+        if self.refs[digest] > 0:
+            return
+        del self.refs[digest]
+        if digest not in self._read_index().itervalues():
+            self._delete(digest)
+
+    def _delete(self, digest):
+        path = self.object_path(digest)
+        for garbage in (path, path + manifests.MANIFEST_SUFFIX):
+            try:
+                os.remove(garbage)
+            except OSError:
+                pass  # already deleted, or still open (on windows) - collect will get it
+
+    def _read_index(self):
+        """
+        :return: the content hashes of the files by their names
+        """
+        index = dict()
+        for name in os.listdir(self.names_dir):
+            if not name.endswith(download_manager.TEMP_SUFFIX):
+                digest = self.lookup(name)
+                if digest:
+                    index[name] = digest
+        return index
+
+    def collect(self):
+        """
+        Deletes the contents no name refers to (left behind by crashes)
+        :return: the number of contents deleted
+        """
+        with self.lock:
+            self.refs = collections.Counter(self._read_index().itervalues())
+            collected = 0
+            for _, _, files in os.walk(self.objects_dir):
+                for digest in files:
+                    if manifests.DIGEST_PATTERN.match(digest) and digest not in self.refs:
+                        self._delete(digest)
+                        collected += 1
+            return collected
+
+    def _import_loose_files(self):
+        """
+        Moves the files stored directly in the root into the store (their leftover temporary files are deleted)
+        """
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if not os.path.isfile(path):
+                continue
+            try:
+                if name.endswith((download_manager.TEMP_SUFFIX, download_manager.STATE_SUFFIX,
+                                  manifests.MANIFEST_SUFFIX)):
+                    os.remove(path)
+                else:
+                    self.put(name, path)
+            except (IOError, OSError):
+                pass  # moved by another worker
+
+
+class Challenge(object):
+    """
+    This class is the proof of possession asked of an upload whose content is stored already
+    The uploader skips all the chunks but one, picked at random, which must match the stored content's manifest -
+    the upload's name is linked to the stored content only once that chunk was verified
+    """
+    random = random.SystemRandom()
+
+    def __init__(self, manifest):
+        """
+        The class constructor
+        :param manifest: the manifests.Manifest kept with the stored content
+        """
+        self.manifest = manifest
+        self.index = self.random.randrange(manifest.chunk_count) if manifest.chunk_count else None
+        self.received = 0  # the number of chunks received
+        self.proven = self.index is None  # an empty content needs no proof
+
+    @property
+    def digest(self):
+        return self.manifest.digest
+
+    def skipped(self):
+        """
+        :return: the indexes of the chunks the uploader should not send
+        """
+        if self.index is None:
+            return xrange(self.manifest.chunk_count)
+        return itertools.chain(xrange(self.index), xrange(self.index + 1, self.manifest.chunk_count))
+
+    def check(self, data):
+        """
+        Verifies a received chunk - the proof holds if it is the only chunk, and it matches the chosen chunk
+        :param data: the chunk's data (a string or a memoryview)
+        """
+        self.received += 1
+        self.proven = self.received == 1 and self.index is not None and self.manifest.verify(self.index, data)
@@ -1,6 +1,8 @@
 """
-This module contains the user class.
+This module contains the user class and the registry of the connected users.
 """
+import collections
+import socket
 
 
 class User(object):
@@ -8,19 +10,198 @@ class User(object):
     This class is used by the server
     It is used to determine the nickname of the user (displayed in chat), their chatsocket socket,
     their server status (administrator/regular) and whether the user is muted or not
+    It also holds the user's upload state, so the server keeps a single record per user
     """
+    __slots__ = ('nickname', 'client', 'address', 'fd', 'display_name', 'is_admin', 'muted', 'connected',
+                 'room', 'downloads', 'uploads', 'upload_requests', 'write_backlog', 'limiter')
+
     def __init__(self, nickname, client, address):
         """
         The class constructor
         :param nickname: the user's nickname
+        :param client: the user's socket
+        :param address: the user's IP address
         """
         self.nickname = nickname
         self.client = client
         self.address = address
+        self.fd = None  # the socket's file descriptor, set once the user is registered
         # if the server changes needs to change the nickname
         # it will use the display name instead
         self.display_name = nickname
         self.is_admin = False
         self.muted = False
         self.connected = False
-        self.uploading = False
+        self.room = None  # the name of the user's room (see rooms.RoomRegistry)
+        self.downloads = None  # the files the user uploads (a download_manager.DownloadManager object)
+        self.uploads = set()  # the (stream id, file name) keys of the files the user is uploading
+        self.upload_requests = set()  # the names of the files the user was asked for and did not start sending
+        self.write_backlog = 0  # the bytes of the user's uploads which wait for the disk
+        self.limiter = None  # the user's rate limits (an admission.RateLimiter object)
+
+
+class UserRegistry(object):
+    """
+    This class holds the connected users, by their nicknames and by the file descriptors of their sockets
+    It keeps indexes of the admins, the muted users and the uploaders, which are updated as the users change -
+    so the users' status must be changed through the registry's methods
+    """
+    def __init__(self):
+        """
+        The class constructor
+        """
+        self.by_nick = dict()
+        self.by_fd = dict()
+        self.admins = set()  # the nicknames of the admins
+        self.muted = set()  # the nicknames of the muted users
+        self.uploaders = set()  # the nicknames of the users who are uploading files
+        self.uploading = collections.Counter()  # the names of the files being uploaded or requested
+
+    def __len__(self):
+        return len(self.by_nick)
+
+    def __iter__(self):
+        return self.by_nick.itervalues()
+
+    def __contains__(self, nickname):
+        return nickname in self.by_nick
+
+    def get(self, nickname):
+        """
+        :param nickname: a nickname
+        :return: the User object, None if there is no such user
+        """
+        return self.by_nick.get(nickname)
+
+    def find_client(self, client):
+        """
+        Finds the user of a socket
+        :param client: a socket
+        :return: the User object, None if the socket is not a user's (or is closed)
+        """
+        try:
+            user = self.by_fd.get(client.fileno())
+        except socket.error:
+            return None
+        return user if user is not None and user.client is client else None
+
+    def _registered(self, user):
+        return self.by_nick.get(user.nickname) is user
+
+    def add(self, user):
+        """
+        Registers a user
+        :param user: a User object
+        """
+        user.fd = user.client.fileno()
+        self.by_nick[user.nickname] = user
+        self.by_fd[user.fd] = user
+        if user.is_admin:
+            self.admins.add(user.nickname)
+        if user.muted:
+            self.muted.add(user.nickname)
+
+    def remove(self, user):
+        """
+        Unregisters a user (their uploads and upload requests are forgotten)
+        :param user: a User object
+        """
+        del self.by_nick[user.nickname]
+        if self.by_fd.get(user.fd) is user:
+            del self.by_fd[user.fd]
+        for _, name in user.uploads:
+            self._release_name(name)
+        for name in user.upload_requests:
+            self._release_name(name)
+        self.admins.discard(user.nickname)
+        self.muted.discard(user.nickname)
+        self.uploaders.discard(user.nickname)
+
+    def set_admin(self, user, is_admin):
+        """
+        Changes whether a user is an admin (admins' display names start with @)
+        Users of other workers are changed as well, though they are not indexed
+        :param user: a User object
+        :param is_admin: whether the user is an admin
+        """
+        if user.is_admin == is_admin:
+            return
+        user.is_admin = is_admin
+        user.display_name = '@' + user.display_name if is_admin else user.display_name[1:]
+        if self._registered(user):
+            (self.admins.add if is_admin else self.admins.discard)(user.nickname)
+
+    def set_muted(self, user, muted):
+        """
+        Changes whether a user is muted
+        :param user: a User object
+        :param muted: whether the user is muted
+        """
+        user.muted = muted
+        if self._registered(user):
+            (self.muted.add if muted else self.muted.discard)(user.nickname)
+
+    def rename(self, user, display_name):
+        """
+        Changes the name a user is displayed by
+        :param user: a User object
+        :param display_name: the new name
+        """
+        user.display_name = display_name
+
+    def _release_name(self, name):
+        self.uploading[name] -= 1
+        if self.uploading[name] <= 0:
+            del self.uploading[name]
+
+    def request_upload(self, user, name):
+        """
+        Records that a user was asked to upload a file
+        :param user: a User object
+        :param name: the file's name
+        """
+        if name not in user.upload_requests:
+            user.upload_requests.add(name)
+            self.uploading[name] += 1
+
+    def discard_request(self, user, name):
+        """
+        Forgets that a user was asked to upload a file
+        :param user: a User object
+        :param name: the file's name
+        """
+        if name in user.upload_requests:
+            user.upload_requests.discard(name)
+            self._release_name(name)
+
+    def add_upload(self, user, key):
+        """
+        Records an upload which has started (replacing its request)
+        :param user: a User object
+        :param key: the upload's (stream id, file name) key
+        """
+        self.discard_request(user, key[1])
+        if key not in user.uploads:
+            user.uploads.add(key)
+            self.uploading[key[1]] += 1
+            if self._registered(user):
+                self.uploaders.add(user.nickname)
+
+    def discard_upload(self, user, key):
+        """
+        Forgets an upload which has ended
+        :param user: a User object
+        :param key: the upload's (stream id, file name) key
+        """
+        if key in user.uploads:
+            user.uploads.discard(key)
+            self._release_name(key[1])
+            if not user.uploads:
+                self.uploaders.discard(user.nickname)
+
+    def is_uploading(self, name):
+        """
+        :param name: a file's name
+        :return: True if the file is being uploaded, or was requested from a user, False otherwise
+        """
+        return name in self.uploading
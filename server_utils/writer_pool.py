@@ -0,0 +1,79 @@
+"""
+This module is used by the server
+It contains the writer pool, which runs the disk work of uploads on a bounded number of threads
+Every file has its own queue of jobs which run in order, on one thread at a time, while different files are
+written in parallel - the results are handed back to the event loop, which never waits for the disk
+The pool runs the blocking commands as well (keyed by the users who run them, see commands.Router)
+"""
+import collections
+import Queue
+import threading
+
+DEF_WRITERS = 4
+STOP = object()  # stops a writer thread
+
+
+class WriterPool(object):
+    """
+    This class runs jobs on writer threads, in order per key
+    """
+    def __init__(self, post, writers=DEF_WRITERS):
+        """
+        The class constructor
+        :param post: schedules a callback on the event loop from another thread (EventLoop.call_soon_threadsafe)
+        :param writers: the number of writer threads
+        """
+        self.post = post
+        self.jobs = dict()  # deques of (func, args, callback, callback_args) tuples by keys
+        self.ready = Queue.Queue()  # the keys which have jobs and no thread running them
+        self.lock = threading.Lock()
+        self.threads = [threading.Thread(target=self._work) for _ in xrange(writers)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, key, func, args=(), callback=None, *callback_args):
+        """
+        Queues a job behind the other jobs of its key
+        :param key: the job's key (the jobs of a file share a key)
+        :param func: the function to run on a writer thread
+        :param args: the arguments of the function
+        :param callback: called on the event loop with the callback args, the function's result and the exception
+        it raised (None if it succeeded)
+        :param callback_args: additional arguments for the callback
+        """
+        with self.lock:
+            jobs = self.jobs.get(key)
+            if jobs is None:
+                jobs = self.jobs[key] = collections.deque()
+                self.ready.put(key)
+            jobs.append((func, args, callback, callback_args))
+
+    def _work(self):
+        """
+        Runs jobs until the pool is closed (the body of a writer thread)
+        """
+        while True:
+            key = self.ready.get()
+            if key is STOP:
+                return
+            with self.lock:
+                func, args, callback, callback_args = self.jobs[key].popleft()
+            try:
+                result, error = func(*args), None
+            except Exception as e:
+                result, error = None, e
+            if callback:
+                self.post(callback, *callback_args + (result, error))
+            with self.lock:
+                if self.jobs[key]:
+                    self.ready.put(key)
+                else:
+                    del self.jobs[key]
+
+    def close(self):
+        """
+        Stops the writer threads once the queued jobs are done
+        """
+        for _ in self.threads:
+            self.ready.put(STOP)